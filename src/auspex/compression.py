@@ -0,0 +1,118 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+"""Binary framing and compression codecs for DataStream messages.
+
+Arrays are framed as a small header (dtype and shape) followed by the raw buffer, so that
+no pickling is involved. Codecs are named by a spec string such as "zlib", "zlib:1",
+"shuffle+zlib:9" or "lz4". The optional "shuffle+" prefix byte-shuffles the buffer before
+compression, grouping the n-th bytes of every element together, which typically helps
+zlib on floating point data. "lz4" is only available if the lz4 package is installed."""
+
+import re
+import struct
+import zlib
+
+import numpy as np
+
+from auspex.log import logger
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# Compressors by name, each a pair of functions (compress(bytes, level), decompress(bytes))
+compressors = {}
+default_levels = {}
+
+# Codecs we have already constructed, by spec string
+codecs = {}
+
+def register_compressor(name, compress, decompress, default_level=None):
+    """Make a new compressor available to codec specs as name[:level]."""
+    compressors[name]    = (compress, decompress)
+    default_levels[name] = default_level
+
+register_compressor("zlib", lambda buf, level: zlib.compress(buf, level), zlib.decompress, default_level=6)
+if lz4_frame is not None:
+    register_compressor("lz4", lambda buf, level: lz4_frame.compress(buf, compression_level=level),
+                        lz4_frame.decompress, default_level=0)
+
+def encode_frame(data):
+    """Return the header and raw buffer of an array as (header bytes, contiguous array)."""
+    data = np.asarray(data)
+    data = np.ascontiguousarray(data).reshape(data.shape)
+    if data.dtype.hasobject:
+        raise TypeError("Cannot frame arrays of Python objects.")
+    dtype  = data.dtype.str.encode('ascii')
+    header = struct.pack('<B', len(dtype)) + dtype + struct.pack('<B{}Q'.format(data.ndim), data.ndim, *data.shape)
+    return header, data
+
+def decode_header(frame):
+    """Return the dtype, shape, and offset of the payload within a frame."""
+    dtype_len = frame[0]
+    dtype     = np.dtype(bytes(frame[1:1+dtype_len]).decode('ascii'))
+    offset    = 1 + dtype_len
+    ndim      = frame[offset]
+    shape     = struct.unpack_from('<{}Q'.format(ndim), frame, offset+1)
+    return dtype, shape, offset + 1 + 8*ndim
+
+def shuffle(data):
+    """Group together the n-th byte of every element of a contiguous array."""
+    if data.itemsize == 1:
+        return data.reshape(-1)
+    return np.ascontiguousarray(data.reshape(-1).view(np.uint8).reshape(-1, data.itemsize).T)
+
+def unshuffle(buf, dtype):
+    """Undo shuffle(), returning a flat array of the given dtype."""
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    if dtype.itemsize == 1:
+        return raw.view(dtype)
+    return np.ascontiguousarray(raw.reshape(dtype.itemsize, -1).T).view(dtype).reshape(-1)
+
+class Codec(object):
+    """Encodes arrays into compressed binary frames and back again."""
+    def __init__(self, spec):
+        self.spec    = spec
+        self.shuffle = spec.startswith("shuffle+")
+        name         = spec[len("shuffle+"):] if self.shuffle else spec
+        name, _, level = name.partition(":")
+        if name not in compressors:
+            raise ValueError("Unknown compressor '{}' in codec '{}'. Available compressors are {}.".format(
+                                name, spec, list(compressors.keys())))
+        self.compress_func, self.decompress_func = compressors[name]
+        self.level = int(level) if level else default_levels[name]
+
+    def encode(self, data):
+        header, data = encode_frame(data)
+        payload = shuffle(data) if self.shuffle else data.reshape(-1)
+        return header + self.compress_func(memoryview(payload).cast('B'), self.level)
+
+    def decode(self, frame):
+        dtype, shape, offset = decode_header(frame)
+        payload = self.decompress_func(memoryview(frame)[offset:])
+        if self.shuffle:
+            return unshuffle(payload, dtype).reshape(shape)
+        return np.frombuffer(payload, dtype=dtype).reshape(shape)
+
+    def __repr__(self):
+        return "<Codec(spec={})>".format(self.spec)
+
+def get_codec(spec):
+    """Return the (cached) codec for a spec string. Falls back to a fast zlib setting
+    if a compressor is requested that isn't installed, e.g. lz4."""
+    if spec not in codecs:
+        try:
+            codecs[spec] = Codec(spec)
+        except ValueError:
+            if "lz4" not in spec:
+                raise
+            logger.warning("The lz4 package is not installed, using zlib:1 for codec '%s' instead.", spec)
+            codecs[spec] = Codec(re.sub(r"lz4(:\d+)?", "zlib:1", spec))
+    return codecs[spec]
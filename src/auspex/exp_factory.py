@@ -462,6 +462,7 @@ class QubitExpFactory(object):
             filt_type = settings['x__class__']
 
             if filt_type in module_map:
+                # Generic Filter options, e.g. "execution": "thread", are passed along with the rest
                 filt = module_map[filt_type](**settings)
                 filt.name = name
                 filters[name] = filt
@@ -8,7 +8,6 @@
 
 import inspect
 import time
-import itertools
 import logging
 import asyncio
 import signal
@@ -26,9 +25,13 @@ from tqdm import tqdm, tqdm_notebook
 from auspex.instruments.instrument import Instrument
 from auspex.parameter import ParameterGroup, FloatParameter, IntParameter, Parameter
 from auspex.sweep import Sweeper
-from auspex.stream import DataStream, DataAxis, SweepAxis, DataStreamDescriptor, InputConnector, OutputConnector
+from auspex.compression import get_codec
+from auspex.loop_monitor import LoopLagMonitor
+from auspex.subgraph import ProcessSubgraph
+from auspex.stream import set_timestamps, DataStream, DataAxis, SweepAxis, DataStreamDescriptor, InputConnector, OutputConnector
 from auspex.filters.plot import Plotter, XYPlotter, MeshPlotter, ManualPlotter
 from auspex.filters.io import WriteToHDF5, DataBuffer
+from auspex.filters.filter import Filter, ProfiledRun, perf_clock
 from auspex.log import logger
 
 class ExpProgressBar(object):
@@ -138,6 +141,37 @@ class ExperimentGraph(object):
 
         self.dag = dag
 
+    def fusable_edges(self):
+        """Streams over which the consuming filter could be run inline by the producing one:
+        the producer is a filter and this is its only output stream, the consumer relies on the
+        generic Filter run loop, and the stream is a plain uncompressed queue."""
+        for edge in self.edges:
+            producer = edge.start_connector.parent
+            consumer = edge.end_connector.parent
+            if not isinstance(producer, Filter) or not isinstance(consumer, Filter) or not consumer.fusable():
+                continue
+            outputs = [s for oc in producer.output_connectors.values() for s in oc.output_streams]
+            if len(outputs) == 1 and edge.transport == "queue" and edge.compression == "none":
+                yield edge
+
+    def fused_nodes(self):
+        """Filters that are driven directly by their upstream filter rather than running on their own."""
+        return [edge.end_connector.parent for edge in self.edges if edge.transport == "direct"]
+
+    def fused_chains(self):
+        """Lists of filters, from the head that runs as a task down the filters it drives."""
+        direct = {edge.start_connector.parent: edge.end_connector.parent for edge in self.edges if edge.transport == "direct"}
+        driven = set(direct.values())
+        chains = []
+        for head in direct:
+            if head in driven:
+                continue
+            chain = [head]
+            while chain[-1] in direct:
+                chain.append(direct[chain[-1]])
+            chains.append(chain)
+        return chains
+
 class MetaExperiment(type):
     """Meta class to bake the instrument objects into a class description
     """
@@ -208,6 +242,15 @@ class Experiment(metaclass=MetaExperiment):
         # ExpProgressBar object to display progress bars
         self.progressbar = None
 
+        # Optional LoopLagMonitor, see monitor_loop_lag
+        self.lag_monitor = None
+
+        # Whether to time each filter, see enable_profiling
+        self.profiling = False
+
+        # Filters running in worker processes, see run_in_process
+        self.subgraphs = []
+
         # indicates whether the instruments are already connected
         self.instrs_connected = False
 
@@ -247,6 +290,9 @@ class Experiment(metaclass=MetaExperiment):
                 unique_nodes.append(ee.parent)
         self.nodes = unique_nodes
         self.graph = ExperimentGraph(edges, self.loop)
+        for subgraph in self.subgraphs:
+            subgraph.stop()
+        self.subgraphs = []
 
     def init_streams(self):
         """Establish the base descriptors for any internal data streams and connectors."""
@@ -277,9 +323,108 @@ class Experiment(metaclass=MetaExperiment):
         pass
 
     def set_stream_compression(self, compression="zlib"):
-        for oc in self.output_connectors.values():
+        """Compress the data leaving the experiment with the given codec spec (see
+        auspex.compression), e.g. "zlib:1" or "shuffle+zlib:9". A dictionary of
+        {output connector name: codec spec} selects a codec for each connector."""
+        for name, oc in self.output_connectors.items():
+            spec = compression.get(name, "none") if isinstance(compression, dict) else compression
+            if spec != "none":
+                spec = get_codec(spec).spec # Validate the spec, swapping out unavailable codecs
             for os in oc.output_streams:
-                os.compression = compression
+                os.compression = spec
+                os.reset_compression_stats()
+
+    def compression_report(self):
+        """Return the compression statistics of every compressed stream leaving the experiment."""
+        return {os.name: os.compression_stats() for oc in self.output_connectors.values()
+                    for os in oc.output_streams if os.compression != "none"}
+
+    def set_stream_transport(self, transport="ring", **kwargs):
+        """Switch every stream in the graph over to a different transport, e.g. the
+        preallocated "ring" buffer. Must be called after set_graph. Streams to and from worker
+        processes keep their shared memory transport."""
+        for edge in self.graph.edges:
+            if edge.transport != "shared":
+                edge.set_transport(transport, **kwargs)
+
+    def set_stream_limits(self, max_depth, unit="messages", policy="block"):
+        """Bound every stream in the graph to max_depth messages or bytes, with the given
+        policy ("block", "drop_oldest" or "coalesce") for pushes to a full stream. Individual
+        streams can be configured with DataStream.set_limits. Must be called after set_graph."""
+        for edge in self.graph.edges:
+            edge.set_limits(max_depth, unit, policy)
+
+    def fuse_chains(self, enabled=True):
+        """Run each linear chain of single-consumer filters as one node: every filter in the chain
+        is called directly by the one before it, without queue hops or separate coroutines. The
+        output is unchanged. The head of each chain still reads its input from a queue, so the
+        experiment itself never runs filter code. Must be called after set_graph, and returns the
+        fused chains as lists of filters. Pass enabled=False to restore separate nodes."""
+        for edge in self.graph.edges:
+            if edge.transport == "direct":
+                edge.set_transport("queue")
+        if enabled:
+            for edge in list(self.graph.fusable_edges()):
+                edge.set_transport("direct")
+        chains = self.graph.fused_chains()
+        for chain in chains:
+            logger.debug("Fused filters %s", " -> ".join(str(n) for n in chain))
+        return chains
+
+    def run_in_process(self, nodes, capacity=2**25, max_messages=256):
+        """Run the given filters, e.g. one qubit's channelizer, integrator, averager and writer, in
+        a worker process of their own. The streams between the worker and the rest of the graph
+        pass data through a ring of capacity bytes in shared memory, holding at most max_messages
+        unread messages, and carry events in order with the data just like any other stream.
+        The worker is forked by run_sweeps once the descriptors have been propagated, and serves
+        later runs until the graph or its configuration changes (see ProcessSubgraph). Must be
+        called after set_graph, and returns the ProcessSubgraph, whose stop() ends the worker."""
+        subgraph = ProcessSubgraph(self, nodes, capacity, max_messages)
+        self.subgraphs.append(subgraph)
+        return subgraph
+
+    def enable_profiling(self, enabled=True):
+        """Measure the wall and CPU time spent in each filter during run_sweeps, and log the
+        profile after the run, along with the time messages wait in each stream. The message,
+        point and byte counters of the streams are always kept, but timing every step of every
+        filter slows down fast pipelines noticeably."""
+        self.profiling = enabled
+
+    def monitor_loop_lag(self, enabled=True, interval=0.005, threshold=0.05):
+        """Measure the scheduling delay of the event loop during run_sweeps, sampling every
+        interval seconds. Whenever the loop is held for more than threshold seconds, the filter
+        or experiment method that was running is recorded, and a warning and the lag statistics
+        are added to the run summary. The statistics are available as lag_monitor.stats()."""
+        self.lag_monitor = LoopLagMonitor(self.loop, interval, threshold) if enabled else None
+        return self.lag_monitor
+
+    def profile(self):
+        """Performance counters of every filter in the last run (see Filter.profile), as a list
+        of dicts ranked by the wall time spent in each filter. The filter itself is under "filter"."""
+        nodes   = [n for n in self.nodes + self.extra_plotters if isinstance(n, Filter)]
+        remote  = {n: c for subgraph in self.subgraphs for n, c in subgraph.profiles.items()}
+        profile = []
+        for n in nodes:
+            counters = dict(remote[n]) if n in remote else n.profile()
+            counters["filter"] = n
+            counters["name"]   = n.name or n.__class__.__name__
+            profile.append(counters)
+        return sorted(profile, key=lambda c: c["wall_time"], reverse=True)
+
+    def format_profile(self, profile=None):
+        """Render the profile as a table."""
+        profile = self.profile() if profile is None else profile
+        lines = ["{:<24s} {:>9s} {:>11s} {:>10s} {:>10s} {:>13s} {:>12s}".format(
+                 "Filter", "Messages", "Points", "Wall (s)", "CPU (s)", "Wait/msg (ms)", "Bytes out")]
+        for c in profile:
+            wait = 1e3*c["queue_wait"]/c["messages"] if c["messages"] else 0.0
+            lines.append("{:<24s} {:>9d} {:>11d} {:>10.4f} {:>10.4f} {:>13.3f} {:>12d}".format(
+                         c["name"][:24], c["messages"], c["points"], c["wall_time"], c["cpu_time"], wait, c["bytes_out"]))
+        return "\n".join(lines)
+
+    def stream_high_water_marks(self):
+        """Return the high-water marks (in messages and bytes) of every stream in the graph."""
+        return {edge.name: edge.high_water_marks() for edge in self.graph.edges}
 
     def reset(self):
         for edge in self.graph.edges:
@@ -332,18 +477,16 @@ class Experiment(metaclass=MetaExperiment):
             if self.sweeper.is_adaptive():
                 # Add the new tuples to the stream descriptors
                 for oc in self.output_connectors.values():
-                    # Obtain the lists of values for any fixed
-                    # DataAxes and append them to them to the sweep_values
-                    # in preperation for finding all combinations. 
-                    vals = [a for a in oc.descriptor.data_axis_values()]
+                    # Obtain the values for any fixed DataAxes and prepend
+                    # the sweep_values (a single row each) in preperation for
+                    # finding all combinations.
+                    columns = [a.point_columns() for a in oc.descriptor.axes if not isinstance(a, SweepAxis)]
                     if sweep_values:
-                        vals  = [[v] for v in sweep_values] + vals
+                        columns = [np.array([v], dtype='f') for v in sweep_values] + columns
 
-                    # Find all coordinate tuples and update the list of 
+                    # Append all coordinate tuples to the columnar store of
                     # tuples that the experiment has probed.
-                    nested_list    = list(itertools.product(*vals))
-                    flattened_list = [tuple((val for sublist in line for val in sublist)) for line in nested_list]
-                    oc.descriptor.visited_tuples = oc.descriptor.visited_tuples + flattened_list
+                    oc.descriptor.add_visited_product(columns)
 
             # Run the procedure
             # logger.debug("Starting a new run.")
@@ -393,27 +536,20 @@ class Experiment(metaclass=MetaExperiment):
         if not self.instrs_connected:
             self.connect_instruments()
 
+        # Filters in worker processes are set up and run there
+        remote_nodes = [n for subgraph in self.subgraphs for n in subgraph.nodes]
+
         # Go find any writers
-        self.writers = [n for n in self.nodes if isinstance(n, WriteToHDF5)]
+        writers      = [n for n in self.nodes if isinstance(n, WriteToHDF5)]
+        self.writers = [w for w in writers if w not in remote_nodes]
         self.buffers = [n for n in self.nodes if isinstance(n, DataBuffer)]
         if self.name:
-            for w in self.writers:
+            for w in writers:
                 w.filename.value = os.path.join(os.path.dirname(w.filename.value), self.name)
+        for subgraph in self.subgraphs:
+            subgraph.check_filenames()
         self.filenames = [w.filename.value for w in self.writers]
-        self.files = []
-
-        # Check for redundancy in filenames, and share plot file objects
-        for filename in set(self.filenames):
-            wrs = [w for w in self.writers if w.filename.value == filename]
-
-            # Let the first writer with this filename create the file...
-            wrs[0].file = wrs[0].new_file()
-            self.files.append(wrs[0].file)
-
-            # Make the rest of the writers use this same file object
-            for w in wrs[1:]:
-                w.file = wrs[0].file
-                w.filename.value = wrs[0].filename.value
+        self.files = self.open_files(self.writers)
 
         # Go and find any plotters
         self.plotters = [n for n in self.nodes if isinstance(n, (Plotter, MeshPlotter, XYPlotter))]
@@ -430,7 +566,7 @@ class Experiment(metaclass=MetaExperiment):
             n.experiment = self
             n.loop       = self.loop
             # n.executor   = self.executor
-            if hasattr(n, 'final_init'):
+            if hasattr(n, 'final_init') and n not in remote_nodes:
                 n.final_init()
 
         # Launch the bokeh-server if necessary.
@@ -462,14 +598,58 @@ class Experiment(metaclass=MetaExperiment):
         other_nodes = self.nodes[:]
         other_nodes.extend(self.extra_plotters)
         other_nodes.remove(self)
-        tasks = [n.run() for n in other_nodes]
+        fused_nodes = self.graph.fused_nodes()
+        for n in other_nodes:
+            n.perf.reset()
+        perf_clock.enabled = self.profiling
+        set_timestamps(self.profiling)
+        running_nodes = [n for n in other_nodes if n not in fused_nodes and n not in remote_nodes]
+        if self.profiling:
+            tasks = [ProfiledRun(n.run(), n.perf) for n in running_nodes]
+        else:
+            tasks = [n.run() for n in running_nodes]
 
         tasks.append(self.sweep())
+
+        # Workers are forked before the loop (or the lag monitor thread) is running
+        for subgraph in self.subgraphs:
+            subgraph.prepare()
+            tasks.append(subgraph.wait())
+
+        if self.lag_monitor is not None:
+            self.lag_monitor.start()
         try:
             self.loop.run_until_complete(asyncio.gather(*tasks))
             self.loop.run_until_complete(asyncio.sleep(1))
         except Exception as e:
             logger.exception("message")
+            # A worker interrupted mid-run cannot be reused
+            for subgraph in self.subgraphs:
+                subgraph.stop()
+        finally:
+            if self.lag_monitor is not None:
+                self.lag_monitor.stop()
+        for subgraph in self.subgraphs:
+            self.filenames.extend(subgraph.filenames)
+
+        for edge in self.graph.edges:
+            logger.debug("Stream %s high-water marks: %s", edge.name, edge.high_water_marks())
+            if getattr(edge.queue, 'dropped_messages', 0) > 0:
+                logger.warning("Stream %s dropped %d messages (%d points) to stay within its limits.",
+                               edge.name, edge.queue.dropped_messages, edge.queue.dropped_points)
+        for name, stats in self.compression_report().items():
+            logger.info("Stream %s compressed %d bytes to %d (ratio %.2f) with %s, spending %.3f s compressing and %.3f s decompressing.",
+                        name, stats['raw_bytes'], stats['compressed_bytes'], stats['ratio'], stats['codec'],
+                        stats['compress_time'], stats['decompress_time'])
+
+        if self.lag_monitor is not None:
+            self.lag_monitor.report()
+
+        perf_clock.enabled = False
+        set_timestamps(False)
+        profile = self.profile()
+        if self.profiling and len(profile) > 0:
+            logger.info("Filter profile, slowest first:\n%s", self.format_profile(profile))
 
         for plot, callback in zip(self.manual_plotters, self.manual_plotter_callbacks):
             if callback:
@@ -477,6 +657,24 @@ class Experiment(metaclass=MetaExperiment):
 
         self.shutdown()
 
+    def open_files(self, writers, filenames=None):
+        """Create the data files of the given writers, and return them. Writers with the same
+        filename share one file object, writing to separate groups. The files are numbered
+        unless filenames maps the filename of the writers to the name of their file."""
+        files = []
+        for filename in set(w.filename.value for w in writers):
+            wrs = [w for w in writers if w.filename.value == filename]
+
+            # Let the first writer with this filename create the file...
+            wrs[0].file = wrs[0].new_file(filenames[filename] if filenames else None)
+            files.append(wrs[0].file)
+
+            # Make the rest of the writers use this same file object
+            for w in wrs[1:]:
+                w.file = wrs[0].file
+                w.filename.value = wrs[0].filename.value
+        return files
+
     def shutdown(self):
         logger.debug("Shutting Down!")
 
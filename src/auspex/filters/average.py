@@ -9,13 +9,12 @@
 __all__ = ['Averager']
 
 import time
-import itertools
 import numpy as np
 
 from .filter import Filter
 from auspex.log import logger
 from auspex.parameter import Parameter
-from auspex.stream import InputConnector, OutputConnector
+from auspex.stream import InputConnector, OutputConnector, RecordAssembler
 
 def view_fields(a, names):
     """
@@ -36,6 +35,14 @@ def view_fields(a, names):
     b = a.view(newdt)
     return b
 
+def block_moments(reshaped, mean_axis):
+    """Number of points, mean and sum of squared deviations over the averaged axes. A plain
+    function of its arguments so that it can be offloaded to a process pool."""
+    count = int(np.prod([reshaped.shape[a] for a in mean_axis]))
+    mean  = reshaped.mean(axis=mean_axis, keepdims=True)
+    m2    = (np.abs(reshaped - mean)**2).sum(axis=mean_axis)
+    return count, mean.squeeze(axis=mean_axis), m2
+
 def remove_fields(a, names):
     """
     `a` must be a numpy structured array.
@@ -50,17 +57,24 @@ def remove_fields(a, names):
 
 
 class Averager(Filter):
-    """Takes data and collapses along the specified axis."""
+    """Takes data and collapses along the specified axis, or along several axes in a single pass
+    when given a list of axis names (e.g. axis=["round_robins", "segments"]). By default partial
+    frames are kept in full until the final average and variance can be computed. With
+    accumulator="welford" only a running mean and sum of squared deviations are kept, which
+    yields the same outputs with O(avg_dims) state."""
 
     sink            = InputConnector()
     partial_average = OutputConnector()
     final_average   = OutputConnector()
     final_variance  = OutputConnector()
     axis            = Parameter()
+    accumulator     = Parameter(allowed_values=["frame", "welford"], default="frame")
 
-    def __init__(self, axis=None, **kwargs):
+    def __init__(self, axis=None, accumulator=None, **kwargs):
         super(Averager, self).__init__(**kwargs)
         self.axis.value = axis
+        if accumulator:
+            self.accumulator.value = accumulator
         self.points_before_final_average   = None
         self.points_before_partial_average = None
         self.sum_so_far = None
@@ -72,6 +86,12 @@ class Averager(Filter):
         self.last_update     = time.time()
         self.update_interval = 0.5
 
+    def averaged_axes(self):
+        """Names of the axes to average over, the axis parameter being a name or a list of names."""
+        if isinstance(self.axis.value, (list, tuple)):
+            return list(self.axis.value)
+        return [self.axis.value]
+
     def update_descriptors(self):
         logger.debug('Updating averager "%s" descriptors based on input descriptor: %s.', self.name, self.sink.descriptor)
         descriptor_in = self.sink.descriptor
@@ -82,27 +102,31 @@ class Averager(Filter):
         if self.axis.value is None:
             self.axis.value = descriptor_in.axes[0].name
 
-        # Convert named axes to an index
-        if self.axis.value not in names:
-            raise ValueError("Could not find axis {} within the DataStreamDescriptor {}".format(self.axis.value, descriptor_in))
-        self.axis_num = descriptor_in.axis_num(self.axis.value)
-        logger.debug("Averaging over axis #%d: %s", self.axis_num, self.axis.value)
-
-        self.data_dims = descriptor_in.data_dims()
-        if self.axis_num == len(descriptor_in.axes) - 1:
+        # Convert named axes to indices, outermost first
+        for name in self.averaged_axes():
+            if name not in names:
+                raise ValueError("Could not find axis {} within the DataStreamDescriptor {}".format(name, descriptor_in))
+        self.axis_nums = sorted(descriptor_in.axis_num(name) for name in self.averaged_axes())
+        self.axis_num  = self.axis_nums[0]
+        logger.debug("Averaging over axes #%s: %s", self.axis_nums, self.averaged_axes())
+
+        # Everything within the outermost averaged axis arrives together, so the inner
+        # dimensions are the full axis lengths (sweep axes included).
+        self.data_dims  = descriptor_in.data_dims()
+        dims            = descriptor_in.dims()
+        inner_dims      = dims[self.axis_num+1:]
+        self.avg_dims   = [d for i, d in enumerate(dims) if i > self.axis_num and i not in self.axis_nums]
+        if len(self.avg_dims) == 0:
             logger.debug("Performing scalar average!")
-            self.points_before_partial_average = 1
             self.avg_dims = [1]
-        else:
-            self.points_before_partial_average = descriptor_in.num_points_through_axis(self.axis_num+1)
-            self.avg_dims = self.data_dims[self.axis_num+1:]
 
-        # If we get multiple final average simultaneously
-        self.reshape_dims = self.data_dims[self.axis_num:]
-        if self.axis_num > 0:
-            self.reshape_dims = [-1] + self.reshape_dims
-        self.mean_axis = self.axis_num - len(self.data_dims)
+        # Frames and partial frames are reshaped so that all of the averaged axes
+        # can be reduced at once, given as negative indices from the innermost axis.
+        self.reshape_dims         = [-1, dims[self.axis_num]] + inner_dims
+        self.partial_reshape_dims = [-1] + inner_dims
+        self.mean_axis            = tuple(n - len(dims) for n in self.axis_nums)
 
+        self.points_before_partial_average = int(np.prod(inner_dims))
         self.points_before_final_average   = descriptor_in.num_points_through_axis(self.axis_num)
         logger.debug("Points before partial average: %s.", self.points_before_partial_average)
         logger.debug("Points before final average: %s.", self.points_before_final_average)
@@ -111,24 +135,27 @@ class Averager(Filter):
 
         # Define final axis descriptor
         descriptor = descriptor_in.copy()
-        self.num_averages = descriptor.pop_axis(self.axis.value).num_points()
-        logger.debug("Number of partial averages is %d", self.num_averages)
+        self.num_partial_averages = descriptor.pop_axis(names[self.axis_num]).num_points()
+        self.inner_averages       = 1
+        for n in self.axis_nums[1:]:
+            self.inner_averages *= descriptor.pop_axis(names[n]).num_points()
+        self.num_averages = self.num_partial_averages*self.inner_averages
+        logger.debug("Number of partial averages is %d, each of %d points", self.num_partial_averages, self.inner_averages)
 
         self.sum_so_far                 = np.zeros(self.avg_dims, dtype=descriptor.dtype)
-        self.current_avg_frame          = np.zeros(self.points_before_final_average, dtype=descriptor.dtype)
+        if self.accumulator.value == "welford":
+            # Running mean and sum of squared deviations, M2 being real even for complex data
+            self.mean_so_far       = np.zeros(self.avg_dims, dtype=descriptor.dtype)
+            self.m2_so_far         = np.zeros(self.avg_dims, dtype=np.zeros(0, dtype=descriptor.dtype).real.dtype)
+            self.current_avg_frame = None
+        else:
+            self.current_avg_frame = np.zeros(self.points_before_final_average, dtype=descriptor.dtype)
         self.partial_average.descriptor = descriptor
         self.final_average.descriptor   = descriptor
 
-        # We can update the visited_tuples upfront if none
-        # of the sweeps are adaptive...
-        desc_out_dtype = descriptor_in.axis_data_type(with_metadata=True, excluding_axis=self.axis.value)
-        if not descriptor_in.is_adaptive():
-            vals           = [a.points_with_metadata() for a in descriptor_in.axes if a.name != self.axis.value]
-            nested_list    = list(itertools.product(*vals))
-            flattened_list = [tuple((val for sublist in line for val in sublist)) for line in nested_list]
-            descriptor.visited_tuples = np.core.records.fromrecords(flattened_list, dtype=desc_out_dtype)
-        else:
-            descriptor.visited_tuples = np.empty((0), dtype=desc_out_dtype)
+        # If none of the sweeps are adaptive the output tuples follow from the
+        # remaining axes on demand, otherwise they are filled in as we go.
+        descriptor.visited_tuples = []
 
         for stream in self.partial_average.output_streams + self.final_average.output_streams:
             stream.set_descriptor(descriptor)
@@ -137,16 +164,14 @@ class Averager(Filter):
         # Define variance axis descriptor
         descriptor_var = descriptor_in.copy()
         descriptor_var.data_name = "Variance"
-        descriptor_var.pop_axis(self.axis.value)
+        for name in self.averaged_axes():
+            descriptor_var.pop_axis(name)
         if descriptor_var.unit:
             descriptor_var.unit = descriptor_var.unit + "^2"
         descriptor_var.metadata["num_averages"] = self.num_averages
         self.final_variance.descriptor= descriptor_var
 
-        if not descriptor_in.is_adaptive():
-            descriptor_var.visited_tuples = np.core.records.fromrecords(flattened_list, dtype=desc_out_dtype)
-        else:
-            descriptor_var.visited_tuples = np.empty((0), dtype=desc_out_dtype)
+        descriptor_var.visited_tuples = []
 
         for stream in self.final_variance.output_streams:
             stream.set_descriptor(descriptor_var)
@@ -161,7 +186,16 @@ class Averager(Filter):
         self.idx_global         = 0
         # We only need to accumulate up to the averaging axis
         # BUT we may get something longer at any given time!
-        self.carry = np.zeros(0, dtype=self.final_average.descriptor.dtype)
+        self.assembler = RecordAssembler(self.points_before_partial_average)
+
+    def merge(self, count, mean, m2):
+        """Merge the moments of a block of partial frames into the running Welford mean and M2
+        (Chan et al.)."""
+        previous   = self.completed_averages*self.inner_averages
+        total      = previous + count
+        delta      = mean - self.mean_so_far
+        self.mean_so_far += delta*(count/total)
+        self.m2_so_far   += m2 + np.abs(delta)**2*(previous*count/total)
 
     async def process_data(self, data):
 
@@ -172,82 +206,91 @@ class Averager(Filter):
         elif not isinstance(data, np.ndarray) and (data.size == 1):
             data = np.array([data])
 
-        if self.carry.size > 0:
-            data = np.concatenate((self.carry, data))
-            self.carry = np.zeros(0, dtype=self.final_average.descriptor.dtype)
+        # Work through whole partial frames only, carrying the rest over to the next message
+        for frames in self.assembler.assemble(data):
+            await self.process_frames(frames.ravel())
 
+    async def process_frames(self, data):
+        """Average a flat array holding a whole number of partial frames."""
         idx       = 0
         while idx < data.size:
             #check whether we have enough data to fill an averaging frame
-            if data.size - idx >= self.points_before_final_average:
+            if self.completed_averages == 0 and data.size - idx >= self.points_before_final_average:
                 # How many chunks can we process at once?
                 num_chunks = int((data.size - idx)/self.points_before_final_average)
                 new_points = num_chunks*self.points_before_final_average
                 reshaped   = data[idx:idx+new_points].reshape(self.reshape_dims)
-                averaged   = reshaped.mean(axis=self.mean_axis)
+                count, averaged, m2 = await self.offload(block_moments, reshaped, self.mean_axis)
+                variance   = m2/(count - 1)
                 idx       += new_points
 
+                # Add to Visited tuples, once per distinct descriptor, keeping
+                # the first point along each of the averaged axes
                 if self.sink.descriptor.is_adaptive():
-                    new_tuples = self.sink.descriptor.tuples()[self.idx_global:self.idx_global + new_points]
-                    new_tuples_stripped = remove_fields(new_tuples, self.axis.value)
-                    take_axis = -1 if self.axis_num > 0 else 0
-                    reduced_tuples = new_tuples_stripped.reshape(self.reshape_dims).take((0,), axis=take_axis)
+                    reduced_tuples = self.sink.descriptor.tuples(start=self.idx_global, stop=self.idx_global + new_points)
+                    reduced_tuples = reduced_tuples.reshape(self.reshape_dims)
+                    for axis in self.mean_axis:
+                        reduced_tuples = reduced_tuples.take((0,), axis=axis)
                     self.idx_global += new_points
 
-                # Add to Visited tuples
-                if self.sink.descriptor.is_adaptive():
-                    for os in self.final_average.output_streams + self.final_variance.output_streams + self.partial_average.output_streams:
-                        os.descriptor.visited_tuples = np.append(os.descriptor.visited_tuples, reduced_tuples)
+                    streams     = self.final_average.output_streams + self.final_variance.output_streams + self.partial_average.output_streams
+                    descriptors = {id(os.descriptor): os.descriptor for os in streams}
+                    for descriptor in descriptors.values():
+                        descriptor.add_visited_tuples(reduced_tuples)
 
                 for os in self.final_average.output_streams:
                     await os.push(averaged)
 
                 for os in self.final_variance.output_streams:
-                    await os.push(reshaped.var(axis=self.mean_axis, ddof=1)) # N-1 in the denominator
+                    await os.push(variance) # N-1 in the denominator
 
                 for os in self.partial_average.output_streams:
                     await os.push(averaged)
 
             # Maybe we can fill a partial frame
             elif data.size - idx >= self.points_before_partial_average:
-                # How many chunks can we process at once?
+                # How many chunks can we process at once, without going past the final average?
                 num_chunks       = int((data.size - idx)/self.points_before_partial_average)
+                num_chunks       = min(num_chunks, self.num_partial_averages - self.completed_averages)
                 new_points       = num_chunks*self.points_before_partial_average
+                reshaped         = data[idx:idx+new_points].reshape(self.partial_reshape_dims)
 
-                # Find the appropriate dimensions for the partial
-                partial_reshape_dims = self.reshape_dims[:]
-                partial_reshape_dims[self.mean_axis] = -1
-                partial_reshape_dims = partial_reshape_dims[self.mean_axis:]
-
-                reshaped         = data[idx:idx+new_points].reshape(partial_reshape_dims)
-                summed           = reshaped.sum(axis=self.mean_axis)
-                self.sum_so_far += summed
-
-                self.current_avg_frame[self.idx_frame:self.idx_frame+new_points] = data[idx:idx+new_points]
+                if self.current_avg_frame is None:
+                    self.merge(*(await self.offload(block_moments, reshaped, self.mean_axis)))
+                else:
+                    self.sum_so_far += reshaped.sum(axis=self.mean_axis)
+                    self.current_avg_frame[self.idx_frame:self.idx_frame+new_points] = data[idx:idx+new_points]
+                    self.idx_frame  += new_points
                 idx             += new_points
-                self.idx_frame  += new_points
 
                 self.completed_averages += num_chunks
 
                 # If we now have enoough for the final average, push to both partial and final...
-                if self.completed_averages == self.num_averages:
-                    reshaped = self.current_avg_frame.reshape(partial_reshape_dims)
+                if self.completed_averages == self.num_partial_averages:
+                    if self.current_avg_frame is None:
+                        averaged = self.mean_so_far.copy()
+                        variance = self.m2_so_far/(self.num_averages - 1) # N-1 in the denominator
+                        self.mean_so_far[:] = 0.0
+                        self.m2_so_far[:]   = 0.0
+                    else:
+                        count, averaged, m2 = await self.offload(block_moments,
+                                                    self.current_avg_frame.reshape(self.partial_reshape_dims), self.mean_axis)
+                        variance = m2/(count - 1)
+                        self.sum_so_far[:]        = 0.0
+                        self.current_avg_frame[:] = 0.0
+                        self.idx_frame            = 0
                     for os in self.final_average.output_streams + self.partial_average.output_streams:
-                        await os.push(reshaped.mean(axis=self.mean_axis))
+                        await os.push(averaged)
                     for os in self.final_variance.output_streams:
-                        await os.push(reshaped.var(axis=self.mean_axis, ddof=1)) # N-1 in the denominator
-                    self.sum_so_far[:]        = 0.0
-                    self.current_avg_frame[:] = 0.0
+                        await os.push(variance)
                     self.completed_averages   = 0
-                    self.idx_frame            = 0
                 else:
                     # Emit a partial average since we've accumulated enough data
                     if (time.time() - self.last_update >= self.update_interval):
+                        if self.current_avg_frame is None:
+                            partial = self.mean_so_far.copy()
+                        else:
+                            partial = self.sum_so_far/(self.completed_averages*self.inner_averages)
                         for os in self.partial_average.output_streams:
-                            await os.push(self.sum_so_far/self.completed_averages)
+                            await os.push(partial)
                         self.last_update = time.time()
-
-            # otherwise just add it to the carry
-            else:
-                self.carry = data[idx:]
-                break
@@ -6,10 +6,11 @@
 #
 #    http://www.apache.org/licenses/LICENSE-2.0
 
-__all__ = ['Channelizer']
+__all__ = ['Channelizer', 'ChannelizerBank', 'PolyphaseDecimator', 'FFTDecimator']
 
 import os
 import platform
+import functools
 from copy import deepcopy
 
 import numpy as np
@@ -17,7 +18,7 @@ import scipy.signal
 
 from .filter import Filter
 from auspex.parameter import Parameter, IntParameter, FloatParameter
-from auspex.stream import  DataStreamDescriptor, InputConnector, OutputConnector
+from auspex.stream import  DataStreamDescriptor, InputConnector, OutputConnector, RecordAssembler
 from auspex.log import logger
 
 try:
@@ -40,8 +41,334 @@ except:
     load_fallback = True
 
 
+def split_complex(decimate):
+    """Run a real decimator over the real and imaginary parts of complex records as one stack."""
+    def wrapper(self, records):
+        if not np.iscomplexobj(records):
+            return decimate(self, records)
+        num_records = records.shape[0]
+        result = decimate(self, np.concatenate((records.real, records.imag)))
+        return result[:num_records] + 1j*result[num_records:]
+    return wrapper
+
+class PolyphaseDecimator(object):
+    """Causal FIR filter followed by decimation, computing only the retained outputs, i.e.
+    lfilter(taps, 1, records)[:, ::decim_factor] for a 2-D array of records.
+
+    Outputs are produced block_size at a time: every block depends on a window of
+    (block_size-1)*D + num_taps input samples, so the overlapping windows of all records
+    are gathered into one matrix and multiplied by a banded (window, block_size) matrix
+    of taps in a single BLAS call."""
+    def __init__(self, taps, decim_factor, block_size=None):
+        super(PolyphaseDecimator, self).__init__()
+        self.taps         = np.asarray(taps)
+        self.decim_factor = decim_factor
+        num_taps = len(self.taps)
+        if block_size is None:
+            block_size = max(8, 2*((num_taps + decim_factor - 1)//decim_factor))
+        self.block_size  = block_size
+        self.window      = (block_size - 1)*decim_factor + num_taps
+        self.block_taps  = np.zeros((self.window, block_size), dtype=self.taps.dtype)
+        for j in range(block_size):
+            self.block_taps[j*decim_factor:j*decim_factor + num_taps, j] = self.taps[::-1]
+
+    def windows(self, records):
+        """Return the (records*blocks, window) matrix of input windows, along with the number of
+        blocks and outputs per record."""
+        num_records, record_length = records.shape
+        num_taps   = len(self.taps)
+        num_out    = (record_length + self.decim_factor - 1)//self.decim_factor
+        num_blocks = (num_out + self.block_size - 1)//self.block_size
+        hop        = self.block_size*self.decim_factor
+
+        # Zero history before each record and zero padding after it
+        padded = np.zeros((num_records, num_taps - 1 + num_blocks*hop), dtype=records.dtype)
+        padded[:, num_taps-1:num_taps-1+record_length] = records
+        windows = np.lib.stride_tricks.as_strided(padded, shape=(num_records, num_blocks, self.window),
+                        strides=(padded.strides[0], hop*padded.strides[1], padded.strides[1]))
+        return windows.reshape(num_records*num_blocks, self.window), num_blocks, num_out
+
+    @split_complex
+    def __call__(self, records):
+        windows, num_blocks, num_out = self.windows(records)
+        result = np.dot(windows, self.block_taps.astype(records.dtype))
+        return result.reshape(records.shape[0], num_blocks*self.block_size)[:, :num_out]
+
+    def mix(self, records, phases, scales):
+        """Filter and decimate real records mixed with each of the references
+        scales[c]*exp(1j*phases[c]*n), for sample index n and phases in radians/sample,
+        returning a (channels, records, samples) complex array.
+
+        Since exp(1j*phase*(n0 + t)) = exp(1j*phase*n0)*exp(1j*phase*t), the mixing within a
+        window folds into the tap matrix of each channel, and all channels are computed from the
+        same windows by a single matrix product, leaving one phase rotation per block."""
+        num_records = records.shape[0]
+        num_taps    = len(self.taps)
+        num_chans   = len(phases)
+        hop         = self.block_size*self.decim_factor
+        phases      = np.asarray(phases, dtype=np.float64)
+        windows, num_blocks, num_out = self.windows(records)
+
+        # Taps of every channel side by side, real parts followed by imaginary parts
+        offsets    = np.arange(self.window) - (num_taps - 1)
+        mixed_taps = np.exp(1j*np.outer(offsets, phases))[:, :, np.newaxis] * self.block_taps[:, np.newaxis, :]
+        mixed_taps = mixed_taps.reshape(self.window, num_chans*self.block_size)
+        stacked    = np.hstack((mixed_taps.real, mixed_taps.imag)).astype(records.dtype)
+
+        result = np.dot(windows, stacked).reshape(num_records, num_blocks, 2, num_chans, self.block_size)
+        result = result[:, :, 0] + 1j*result[:, :, 1]
+
+        # Phase of the mixer at the start of each block
+        rotation = np.asarray(scales)[np.newaxis, :]*np.exp(1j*np.outer(hop*np.arange(num_blocks), phases))
+        result  *= rotation.astype(np.complex64)[np.newaxis, :, :, np.newaxis]
+        result   = result.transpose(2, 0, 1, 3).reshape(num_chans, num_records, num_blocks*self.block_size)
+        return result[:, :, :num_out]
+
+class FFTDecimator(object):
+    """Causal FIR filter followed by decimation, as PolyphaseDecimator, but filtering whole records
+    at once in the frequency domain. Cheaper than the polyphase form for long filters relative to
+    the decimation factor, since the cost no longer grows with the number of taps."""
+    def __init__(self, taps, decim_factor):
+        super(FFTDecimator, self).__init__()
+        self.taps         = np.asarray(taps)
+        self.decim_factor = decim_factor
+        self.responses    = {}
+
+    @split_complex
+    def __call__(self, records):
+        num_records, record_length = records.shape
+        nfft = 2**int(np.ceil(np.log2(record_length + len(self.taps) - 1)))
+        if nfft not in self.responses:
+            self.responses[nfft] = np.fft.rfft(self.taps, nfft)
+        filtered = np.fft.irfft(np.fft.rfft(records, nfft, axis=1)*self.responses[nfft], nfft, axis=1)
+        return filtered[:, :record_length:self.decim_factor].astype(records.dtype)
+
+def design_stages(n_frequency, n_bandwidth, decimation_factor):
+    """Design the three stage filter pipeline for a channel at n_frequency with n_bandwidth, both
+    normalized to the Nyquist interval. Returns the decimation factor, Chebyshev (b,a) coefficients
+    and cutoff of each stage, with None for the coefficients and cutoff of skipped stages."""
+
+    # arbitrarily decide on three stage filter pipeline
+    # 1. first stage decimating filter on real data
+    # 2. second stage decimating filter on mixed product to boost n_bandwidth
+    # 3. final channel selecting filter at n_bandwidth/2
+
+    # anecdotally don't decimate more than a factor of eight for stability
+
+    decim_factors = [1]*3
+    filters = [None]*3
+    cutoffs = [None]*3
+
+    # first stage decimating filter
+    # maximize first stage decimation:
+    #     * minimize subsequent stages time taken
+    #     * filter and decimate while signal is still real
+    #     * first stage decimation cannot be too large or then 2omega signal from mixing will alias
+    d1 = 1
+    while (d1 < 8) and (2*n_frequency <= 0.8/d1) and (d1 < decimation_factor):
+        d1 *= 2
+        n_bandwidth *= 2
+        n_frequency *= 2
+
+    if d1 > 1:
+        # create an anti-aliasing filter
+        # pass-band to 0.8 * decimation factor; anecdotally single precision needs order <= 4 for stability
+        b,a = scipy.signal.cheby1(4, 3, 0.8/d1)
+        decim_factors[0] = d1
+        filters[0] = (np.float32(b), np.float32(a))
+        cutoffs[0] = 0.8/d1
+
+    # second stage filter to bring n_bandwidth/2 up
+    # decimation cannot be too large or will impinge on channel bandwidth (keep n_bandwidth/2 <= 0.8)
+    d2 = 1
+    while (d2 < 8) and ((d1*d2) < decimation_factor) and (n_bandwidth/2 <= 0.8):
+        d2 *= 2
+        n_bandwidth *= 2
+        n_frequency *= 2
+
+    if d2 > 1:
+        # create an anti-aliasing filter
+        # pass-band to 0.8 * decimation factor; anecdotally single precision needs order <= 4 for stability
+        b,a = scipy.signal.cheby1(4, 3, 0.8/d2)
+        decim_factors[1] = d2
+        filters[1] = (np.float32(b), np.float32(a))
+        cutoffs[1] = 0.8/d2
+
+    # final channel selection filter
+    if n_bandwidth < 0.1:
+        raise ValueError("Insufficient decimation to achieve stable filter")
+
+    b,a = scipy.signal.cheby1(4, 3, n_bandwidth/2)
+    decim_factors[2] = decimation_factor // (d1*d2)
+    filters[2] = (np.float32(b), np.float32(a))
+    cutoffs[2] = n_bandwidth/2
+
+    return decim_factors, filters, cutoffs
+
+def decimate_descriptor(descriptor, decimation_factor):
+    """Return the complex descriptor of channelized output for an input descriptor."""
+    decimated_descriptor = DataStreamDescriptor()
+    decimated_descriptor.axes = descriptor.axes[:]
+    decimated_descriptor.axes[-1] = deepcopy(descriptor.axes[-1])
+    decimated_descriptor.axes[-1].points = descriptor.axes[-1].points[decimation_factor-1::decimation_factor]
+    decimated_descriptor.axes[-1].original_points = decimated_descriptor.axes[-1].points
+    decimated_descriptor.exp_src = descriptor.exp_src
+    decimated_descriptor.dtype = np.complex64
+    return decimated_descriptor
+
+def channel_library(engine, execution="inline"):
+    """Validate a channelizer engine name, picking the default if it is None, and return it along
+    with the library that provides filter_records_iir for the IIR engines."""
+    if engine is None:
+        engine = "numpy" if load_fallback else "ipp"
+    if engine not in Channelizer.engines:
+        raise ValueError("Unknown channelizer engine '{}', choose from {}".format(engine, Channelizer.engines))
+    if engine == "ipp" and load_fallback:
+        raise ValueError("The ipp channelizer engine requires libchannelizer, which could not be loaded.")
+    if engine == "ipp" and execution == "process":
+        raise ValueError("The ipp channelizer engine can not be sent to a process pool, use thread execution or another engine.")
+    return engine, LibChannelizerFallback() if engine == "lfilter" else libipp
+
+def fir_decimator(cutoff, decim_factor, iir, frequency=0.0):
+    """FIR stand-in for a Chebyshev stage, with cutoff normalized to the Nyquist frequency. The
+    taps are scaled to the gain of the IIR filter at the given frequency (in radians/sample), so
+    that all engines produce the same amplitudes."""
+    num_taps = 8*int(np.ceil(1.0/cutoff)) + 1
+    taps     = scipy.signal.firwin(num_taps, cutoff)
+    iir_gain = np.abs(scipy.signal.freqz(iir[0], iir[1], worN=[frequency])[1][0])
+    fir_gain = np.abs(scipy.signal.freqz(taps, 1, worN=[frequency])[1][0])
+    taps     = np.float32(taps*iir_gain/fir_gain)
+    if num_taps > 128*decim_factor:
+        return FFTDecimator(taps, decim_factor)
+    return PolyphaseDecimator(taps, decim_factor)
+
+def read_only(array):
+    """Flag an array that is shared through the plan cache as read-only."""
+    array.flags.writeable = False
+    return array
+
+class ChannelizerPlan(object):
+    """Everything a channelizer designs up front for a set of channel frequencies: the decimation
+    factors, the Chebyshev coefficients (also stacked as libchannelizer expects them), the FIR
+    decimators of the numpy engine, and the mixing references. Plans are shared between filters
+    through channelizer_plan, so their arrays are read-only.
+
+    A single channel is designed for its own (signed) frequency, several channels for the one of
+    largest magnitude, so that they can share the first stage."""
+    def __init__(self, frequencies, bandwidth, decimation_factor, time_step, record_length, start_time=0.0):
+        super(ChannelizerPlan, self).__init__()
+        self.frequencies = np.array(frequencies, dtype=np.float64)
+
+        # convert bandwidth and frequencies normalized to Nyquist interval
+        n_bandwidth   = bandwidth * time_step * 2
+        n_frequencies = self.frequencies * time_step * 2
+        n_frequency   = n_frequencies[0] if len(n_frequencies) == 1 else np.abs(n_frequencies).max()
+
+        self.decim_factors, self.filters, cutoffs = design_stages(n_frequency, n_bandwidth, decimation_factor)
+        self.stacked_coeffs = [read_only(np.concatenate(f)) if f is not None else None for f in self.filters]
+
+        # stacked references for mixing down all channels at once
+        d1 = self.decim_factors[0]
+        time_pts = start_time + time_step*np.arange(0, record_length, d1)
+        self.references  = read_only(np.exp(2j*np.pi * np.outer(self.frequencies, time_pts), dtype=np.complex64))
+        self.reference_r = read_only(np.ascontiguousarray(self.references.real))
+        self.reference_i = read_only(np.ascontiguousarray(self.references.imag))
+        self.phases      = read_only(2*np.pi * self.frequencies * time_step * d1) # in radians/sample
+
+        self.decimators = [None]*3
+        for ct, cutoff in enumerate(cutoffs):
+            if cutoff is not None:
+                self.decimators[ct] = fir_decimator(cutoff, self.decim_factors[ct], self.filters[ct])
+
+        # The shared first stage FIR is scaled for DC, so correct the gain of each channel to
+        # match the IIR filter at its frequency.
+        if self.decimators[0] is not None:
+            b, a = self.filters[0]
+            iir_gain = np.abs(scipy.signal.freqz(b, a, worN=np.pi*n_frequencies)[1])
+            fir_gain = np.abs(scipy.signal.freqz(self.decimators[0].taps, 1, worN=np.pi*n_frequencies)[1])
+            self.fir_references = read_only(self.references * np.float32(iir_gain/fir_gain)[:, np.newaxis])
+        else:
+            self.fir_references = self.references
+
+    def channelize(self, records):
+        """Channelize a 2-D array of records into a (channels, records, samples) array with the FIR
+        stages of the numpy engine."""
+        num_records = records.shape[0]
+        filtered = records
+        if self.decimators[0] is not None:
+            filtered = self.decimators[0](filtered)
+
+        # The first channel selection stage mixes down all channels as part of its filtering
+        decimators = [d for d in self.decimators[1:] if d is not None]
+        if isinstance(decimators[0], PolyphaseDecimator):
+            filtered = decimators.pop(0).mix(filtered, self.phases, self.fir_references[:, 0])
+            filtered = filtered.reshape(-1, filtered.shape[-1])
+        else:
+            filtered = (self.fir_references[:, np.newaxis, :] * filtered).reshape(-1, filtered.shape[-1])
+        for decimator in decimators:
+            filtered = decimator(filtered)
+        return filtered.reshape(len(self.frequencies), num_records, -1)
+
+    def channelize_iir(self, lib, records):
+        """Channelize a 2-D array of records into a (channels, records, samples) array with the
+        Chebyshev stages, using lib.filter_records_iir."""
+        num_records = records.shape[0]
+
+        # shared first stage decimating filter
+        filtered = records
+        if self.filters[0] is not None:
+            filtered = np.empty_like(records)
+            lib.filter_records_iir(self.stacked_coeffs[0], self.filters[0][0].size-1, records, records.shape[-1], num_records, filtered)
+            if self.decim_factors[0] > 1:
+                filtered = filtered[:, ::self.decim_factors[0]]
+
+        # mix with every reference, stacking the channels along the records
+        # keep real and imaginary separate for filtering below
+        samples = filtered.shape[-1]
+        filtered_r = (self.reference_r[:, np.newaxis, :] * filtered).reshape(-1, samples)
+        filtered_i = (self.reference_i[:, np.newaxis, :] * filtered).reshape(-1, samples)
+
+        # channel selection filters
+        for ct in [1,2]:
+            if self.filters[ct] is None:
+                continue
+
+            out_r = np.empty_like(filtered_r)
+            out_i = np.empty_like(filtered_i)
+            lib.filter_records_iir(self.stacked_coeffs[ct], self.filters[ct][0].size-1, filtered_r, filtered_r.shape[-1], filtered_r.shape[0], out_r)
+            lib.filter_records_iir(self.stacked_coeffs[ct], self.filters[ct][0].size-1, filtered_i, filtered_i.shape[-1], filtered_i.shape[0], out_i)
+
+            # decimate
+            if self.decim_factors[ct] > 1:
+                filtered_r = np.copy(out_r[:, ::self.decim_factors[ct]], order="C")
+                filtered_i = np.copy(out_i[:, ::self.decim_factors[ct]], order="C")
+            else:
+                filtered_r = out_r
+                filtered_i = out_i
+
+        filtered = filtered_r + 1j*filtered_i
+        return filtered.reshape(len(self.frequencies), num_records, -1)
+
+@functools.lru_cache(maxsize=64)
+def cached_plan(frequencies, bandwidth, decimation_factor, time_step, record_length, start_time):
+    return ChannelizerPlan(frequencies, bandwidth, decimation_factor, time_step, record_length, start_time)
+
+def channelizer_plan(frequencies, bandwidth, decimation_factor, time_pts):
+    """Return the ChannelizerPlan for channels at the given frequencies and records sampled at
+    time_pts, from a least-recently-used cache shared by every channelizer, so that rebuilding
+    a graph with the same settings does not redesign its filters. See cached_plan.cache_info()."""
+    time_pts = np.asarray(time_pts, dtype=np.float64)
+    return cached_plan(tuple(float(f) for f in frequencies), float(bandwidth), int(decimation_factor),
+                       float(time_pts[1] - time_pts[0]), len(time_pts), float(time_pts[0]))
+
 class Channelizer(Filter):
-    """Digital demodulation and filtering to select a particular frequency multiplexed channel"""
+    """Digital demodulation and filtering to select a particular frequency multiplexed channel.
+
+    The "ipp" engine runs Chebyshev IIR filters in libchannelizer, and "lfilter" runs the same
+    filters through scipy. The "numpy" engine runs FIR equivalents over all records at once, as
+    PolyphaseDecimators that only compute the samples that survive decimation, or as FFTDecimators
+    for filters that are long compared to their decimation factor. By default "ipp" is used when
+    libchannelizer loads and "numpy" otherwise."""
 
     sink              = InputConnector()
     source            = OutputConnector()
@@ -49,8 +376,11 @@ class Channelizer(Filter):
     frequency         = FloatParameter(value_range=(-5e9,5e9), increment=1.0e6, default=-9e6)
     bandwidth         = FloatParameter(value_range=(0.00, 100e6), increment=0.1e6, default=5e6)
 
-    def __init__(self, frequency=None, bandwidth=None, decimation_factor=None, **kwargs):
+    engines = ("ipp", "lfilter", "numpy")
+
+    def __init__(self, frequency=None, bandwidth=None, decimation_factor=None, engine=None, **kwargs):
         super(Channelizer, self).__init__(**kwargs)
+        self.engine, self.lib = channel_library(engine, self.execution)
         if frequency:
             self.frequency.value = frequency
         if bandwidth:
@@ -66,138 +396,111 @@ class Channelizer(Filter):
         time_pts = self.sink.descriptor.axes[-1].points
         self.record_length = len(time_pts)
         self.time_step = time_pts[1] - time_pts[0]
+        self.assembler = RecordAssembler(self.record_length)
         logger.debug("Channelizer time_step = {}".format(self.time_step))
 
-        # convert bandwidth normalized to Nyquist interval
-        n_bandwidth = self.bandwidth.value * self.time_step * 2
-        n_frequency = self.frequency.value * self.time_step * 2
-
-        # arbitrarily decide on three stage filter pipeline
-        # 1. first stage decimating filter on real data
-        # 2. second stage decimating filter on mixed product to boost n_bandwidth
-        # 3. final channel selecting filter at n_bandwidth/2
-
-        # anecdotally don't decimate more than a factor of eight for stability
-
-        self.decim_factors = [1]*3
-        self.filters = [None]*3
-
-        # first stage decimating filter
-        # maximize first stage decimation:
-        #     * minimize subsequent stages time taken
-        #     * filter and decimate while signal is still real
-        #     * first stage decimation cannot be too large or then 2omega signal from mixing will alias
-        d1 = 1
-        while (d1 < 8) and (2*n_frequency <= 0.8/d1) and (d1 < self.decimation_factor.value):
-            d1 *= 2
-            n_bandwidth *= 2
-            n_frequency *= 2
-
-        if d1 > 1:
-            # create an anti-aliasing filter
-            # pass-band to 0.8 * decimation factor; anecdotally single precision needs order <= 4 for stability
-            b,a = scipy.signal.cheby1(4, 3, 0.8/d1)
-            b = np.float32(b)
-            a = np.float32(a)
-            self.decim_factors[0] = d1
-            self.filters[0]  = (b,a)
-
-        # store decimated reference for mix down
-        ref = np.exp(2j*np.pi * self.frequency.value * time_pts[::d1], dtype=np.complex64)
-        self.reference_r = np.real(ref)
-        self.reference_i = np.imag(ref)
-
-        # second stage filter to bring n_bandwidth/2 up
-        # decimation cannot be too large or will impinge on channel bandwidth (keep n_bandwidth/2 <= 0.8)
-        d2 = 1
-        while (d2 < 8) and ((d1*d2) < self.decimation_factor.value) and (n_bandwidth/2 <= 0.8):
-            d2 *= 2
-            n_bandwidth *= 2
-            n_frequency *= 2
-
-        if d2 > 1:
-            # create an anti-aliasing filter
-            # pass-band to 0.8 * decimation factor; anecdotally single precision needs order <= 4 for stability
-            b,a = scipy.signal.cheby1(4, 3, 0.8/d2)
-            b = np.float32(b)
-            a = np.float32(a)
-            self.decim_factors[1] = d2
-            self.filters[1]  = (b,a)
-
-
-        # final channel selection filter
-        if n_bandwidth < 0.1:
-            raise ValueError("Insufficient decimation to achieve stable filter")
-
-        b,a = scipy.signal.cheby1(4, 3, n_bandwidth/2)
-        b = np.float32(b)
-        a = np.float32(a)
-        self.decim_factors[2] = self.decimation_factor.value // (d1*d2)
-        self.filters[2]  = (b,a)
+        self.plan = channelizer_plan([self.frequency.value], self.bandwidth.value, self.decimation_factor.value, time_pts)
+        self.decim_factors = self.plan.decim_factors
+        self.filters       = self.plan.filters
+        self.decimators    = self.plan.decimators
+        self.reference     = self.plan.references[0]
 
         # update output descriptors
-        decimated_descriptor = DataStreamDescriptor()
-        decimated_descriptor.axes = self.sink.descriptor.axes[:]
-        decimated_descriptor.axes[-1] = deepcopy(self.sink.descriptor.axes[-1])
-        decimated_descriptor.axes[-1].points = self.sink.descriptor.axes[-1].points[self.decimation_factor.value-1::self.decimation_factor.value]
-        decimated_descriptor.axes[-1].original_points = decimated_descriptor.axes[-1].points
-        decimated_descriptor.exp_src = self.sink.descriptor.exp_src
-        decimated_descriptor.dtype = np.complex64
+        decimated_descriptor = decimate_descriptor(self.sink.descriptor, self.decimation_factor.value)
         for os in self.source.output_streams:
             os.set_descriptor(decimated_descriptor)
             if os.end_connector is not None:
                 os.end_connector.update_descriptors()
 
     async def process_data(self, data):
-        # Assume for now we get a integer number of records at a time
-        # TODO: handle partial records
-        num_records = data.size // self.record_length
-        reshaped_data = np.reshape(data, (num_records, self.record_length), order="C")
+        for records in self.assembler.assemble(data):
+            await self.process_records(records)
 
-        # first stage decimating filter
-        if self.filters[0] is not None:
-            stacked_coeffs = np.concatenate(self.filters[0])
-            # filter
-            filtered = np.empty_like(reshaped_data)
-            libipp.filter_records_iir(stacked_coeffs, self.filters[0][0].size-1, reshaped_data, self.record_length, num_records, filtered)
+    async def process_records(self, reshaped_data):
+        """Channelize a 2-D array of whole records and push the result."""
+        if self.engine == "numpy":
+            filtered = (await self.offload(self.plan.channelize, reshaped_data))[0]
+        else:
+            filtered = (await self.offload(self.plan.channelize_iir, self.lib, reshaped_data))[0]
 
-            # decimate
-            if self.decim_factors[0] > 1:
-                filtered = filtered[:, ::self.decim_factors[0]]
+        # recover gain from selecting single sideband
+        filtered *= 2
 
-        # mix with reference
-        # keep real and imaginary separate for filtering below
-        filtered_r = self.reference_r * filtered
-        filtered_i = self.reference_i * filtered
+        # push to ouptut connectors
+        for os in self.source.output_streams:
+            await os.push(filtered)
 
-        # channel selection filters
-        for ct in [1,2]:
-            if self.filters[ct] == None:
-                continue
+class ChannelizerBank(Filter):
+    """Channelize several frequency multiplexed channels of the same raw stream, with one output
+    connector per frequency, named channel_0, channel_1, ... unless names are given. The first
+    stage filter and decimation of the real signal is shared by all channels, which are then mixed
+    down and filtered together as a single stack of records. The first stage is designed for the
+    highest channel frequency, so every channel uses the same decimation factors."""
 
-            coeffs = self.filters[ct]
-            stacked_coeffs = np.concatenate(self.filters[ct])
-            out_r = np.empty_like(filtered_r)
-            out_i = np.empty_like(filtered_i)
-            libipp.filter_records_iir(stacked_coeffs, self.filters[ct][0].size-1, filtered_r, filtered_r.shape[-1], num_records, out_r)
-            libipp.filter_records_iir(stacked_coeffs, self.filters[ct][0].size-1, filtered_i, filtered_i.shape[-1], num_records, out_i)
+    sink              = InputConnector()
+    decimation_factor = IntParameter(value_range=(1,100), default=2, snap=1)
+    bandwidth         = FloatParameter(value_range=(0.00, 100e6), increment=0.1e6, default=5e6)
 
-            # decimate
-            if self.decim_factors[ct] > 1:
-                filtered_r = np.copy(out_r[:, ::self.decim_factors[ct]], order="C")
-                filtered_i = np.copy(out_i[:, ::self.decim_factors[ct]], order="C")
-            else:
-                filtered_r = out_r
-                filtered_i = out_i
+    def __init__(self, frequencies=None, bandwidth=None, decimation_factor=None, names=None, engine=None, **kwargs):
+        super(ChannelizerBank, self).__init__(**kwargs)
+        self.engine, self.lib = channel_library(engine, self.execution)
+        self.frequencies = [float(f) for f in frequencies] if frequencies is not None else []
+        if names is None:
+            names = ["channel_{}".format(i) for i in range(len(self.frequencies))]
+        if len(names) != len(self.frequencies):
+            raise ValueError("ChannelizerBank needs one name per frequency, got {} names for {} frequencies".format(
+                             len(names), len(self.frequencies)))
+        if bandwidth:
+            self.bandwidth.value = bandwidth
+        if decimation_factor:
+            self.decimation_factor.value = decimation_factor
+        self.quince_parameters = [self.decimation_factor, self.bandwidth]
 
-        filtered = filtered_r + 1j*filtered_i
+        # One output connector per channel, in the order of the frequencies
+        self.channels = []
+        for name in names:
+            oc = OutputConnector(name=name, parent=self)
+            self.output_connectors[name] = oc
+            setattr(self, name, oc)
+            self.channels.append(oc)
+
+    def update_descriptors(self):
+        logger.debug('Updating ChannelizerBank "%s" descriptors based on input descriptor: %s.', self.name, self.sink.descriptor)
+
+        # extract record time sampling
+        time_pts = self.sink.descriptor.axes[-1].points
+        self.record_length = len(time_pts)
+        self.time_step = time_pts[1] - time_pts[0]
+        self.assembler = RecordAssembler(self.record_length)
+
+        self.plan = channelizer_plan(self.frequencies, self.bandwidth.value, self.decimation_factor.value, time_pts)
+        self.decim_factors = self.plan.decim_factors
+        self.filters       = self.plan.filters
+
+        decimated_descriptor = decimate_descriptor(self.sink.descriptor, self.decimation_factor.value)
+        for oc in self.channels:
+            for os in oc.output_streams:
+                os.set_descriptor(decimated_descriptor)
+                if os.end_connector is not None:
+                    os.end_connector.update_descriptors()
+
+    async def process_data(self, data):
+        for records in self.assembler.assemble(data):
+            await self.process_records(records)
+
+    async def process_records(self, reshaped_data):
+        """Channelize a 2-D array of whole records into every channel and push the results."""
+        if self.engine == "numpy":
+            filtered = (await self.offload(self.plan.channelize, reshaped_data))
+        else:
+            filtered = (await self.offload(self.plan.channelize_iir, self.lib, reshaped_data))
 
         # recover gain from selecting single sideband
         filtered *= 2
 
-        # push to ouptut connectors
-        for os in self.source.output_streams:
-            await os.push(filtered)
+        for oc, channel in zip(self.channels, filtered):
+            for os in oc.output_streams:
+                await os.push(channel)
 
 class LibChannelizerFallback(object):
     @staticmethod
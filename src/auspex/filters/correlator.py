@@ -6,8 +6,9 @@
 #
 #    http://www.apache.org/licenses/LICENSE-2.0
 
-__all__ = ['Correlator']
+__all__ = ['Correlator', 'CorrelatorBank']
 
+import itertools
 import numpy as np
 
 from auspex.stream import InputConnector, OutputConnector
@@ -24,3 +25,93 @@ class Correlator(ElementwiseFilter):
 
     def unit(self, base_unit):
         return base_unit + "^{}".format(len(self.sink.input_streams))
+
+class CorrelatorBank(ElementwiseFilter):
+    """Compute many correlators (elementwise products) of the same aligned input streams in one
+    node, with one output connector per correlator. Correlators are tuples of indices into the
+    input streams, in the order they were connected, given explicitly or as "pairs", "triples",
+    or "all" (every product of two or more streams) of num_streams streams. Output connectors
+    are named e.g. correlator_0_2 unless names are given.
+
+    Products of the same order are computed together over the stacked streams, each from the
+    product of one lower order that shares its leading indices, so that no product is computed
+    twice."""
+
+    sink        = InputConnector()
+    filter_name = "CorrelatorBank"
+
+    def __init__(self, correlators="pairs", num_streams=None, names=None, **kwargs):
+        super(CorrelatorBank, self).__init__(**kwargs)
+        if isinstance(correlators, str):
+            orders = {"pairs": [2], "triples": [3]}
+            if correlators not in orders and correlators != "all":
+                raise ValueError("Unknown correlators '{}', choose from pairs, triples, all or give a list of index tuples".format(correlators))
+            if num_streams is None:
+                raise ValueError("CorrelatorBank needs num_streams to compute {} correlators".format(correlators))
+            orders = orders.get(correlators, range(2, num_streams+1))
+            correlators = [c for order in orders for c in itertools.combinations(range(num_streams), order)]
+        self.correlators = [tuple(sorted(int(i) for i in c)) for c in correlators]
+        if names is None:
+            names = ["correlator_" + "_".join(str(i) for i in c) for c in self.correlators]
+        if len(names) != len(self.correlators):
+            raise ValueError("CorrelatorBank has {} names for {} correlators".format(len(names), len(self.correlators)))
+
+        # Every product needed, including the intermediate ones, grouped by order. Each product
+        # is the product of its leading indices times the stream of its last index.
+        products = set()
+        for c in self.correlators:
+            products.update(c[:k] for k in range(2, len(c)+1))
+        self.orders = []
+        for order in range(2, max([len(c) for c in self.correlators] + [1]) + 1):
+            level = sorted(p for p in products if len(p) == order)
+            prefixes = [p[:-1] for p in level]
+            if order > 2:
+                previous = {p: i for i, p in enumerate(self.orders[-1][0])}
+                prefixes = [previous[p] for p in prefixes]
+            else:
+                prefixes = [p[0] for p in prefixes]
+            self.orders.append((level, np.array(prefixes, dtype=int), np.array([p[-1] for p in level], dtype=int)))
+
+        # One output connector per correlator
+        self.correlator_sources = []
+        for name in names:
+            oc = OutputConnector(name=name, parent=self)
+            self.output_connectors[name] = oc
+            setattr(self, name, oc)
+            self.correlator_sources.append(oc)
+
+    def update_descriptors(self):
+        logger.debug('Updating %s "%s" descriptors based on input descriptor: %s.', self.filter_name, self.name, self.sink.descriptor)
+
+        # Sometimes not all of the input descriptors have been updated... pause here until they are:
+        if None in [ss.descriptor for ss in self.sink.input_streams]:
+            logger.debug('%s "%s" waiting for all input streams to be updated.', self.filter_name, self.name)
+            return
+
+        num_streams = len(self.sink.input_streams)
+        if any(i >= num_streams for c in self.correlators for i in c):
+            raise ValueError("CorrelatorBank correlators {} refer to more than the {} connected streams".format(self.correlators, num_streams))
+
+        for c, oc in zip(self.correlators, self.correlator_sources):
+            descriptor = self.sink.descriptor.copy()
+            descriptor.data_name = oc.name
+            if descriptor.unit:
+                descriptor.unit = descriptor.unit + "^{}".format(len(c))
+            oc.descriptor = descriptor
+            oc.update_descriptors()
+
+    def products(self, stacked):
+        """Return a dict of every product needed by the correlators, keyed by index tuple, for a
+        (streams, points) stack of aligned data."""
+        products = {(i,): stacked[i] for i in range(stacked.shape[0])}
+        lower = stacked
+        for level, prefixes, last in self.orders:
+            lower = lower[prefixes] * stacked[last]
+            products.update(zip(level, lower))
+        return products
+
+    async def process_aligned(self, data):
+        products = self.products(np.stack(data))
+        for c, oc in zip(self.correlators, self.correlator_sources):
+            for os in oc.output_streams:
+                await os.push(products[c])
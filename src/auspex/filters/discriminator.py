@@ -0,0 +1,150 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+__all__ = ['Discriminator']
+
+import numpy as np
+
+from .filter import Filter
+from auspex.parameter import FloatParameter, BoolParameter
+from auspex.stream import DataAxis, InputConnector, OutputConnector, RecordAssembler
+from auspex.log import logger
+
+def unpack_states(packed, num_bits):
+    """Undo the bit packing of a Discriminator: return 0/1 states of shape (..., num_bits) from the
+    uint8 bytes along the last axis. num_bits is stored as "packed_bits" in the descriptor metadata."""
+    packed = np.asarray(packed, dtype=np.uint8)
+    return np.unpackbits(packed, axis=-1)[..., :num_bits]
+
+class Discriminator(Filter):
+    """Threshold single-shot values into qubit states. Each shot x is projected on the direction
+    given by angle (in radians), and is in state 1 when Re(x*exp(-1j*angle)) > threshold, so that
+    an angle of zero is a plain linear threshold on the real part.
+
+    States are emitted as uint8, packed eight shots to a byte along the innermost axis unless
+    packed is False. The packed axis is renamed "<name>_packed" and the number of shots it holds
+    is recorded as "packed_bits" in the descriptor metadata.
+
+    If an axis carries calibration metadata (cal_labels, "0" and "1" by default, as for segment
+    axes with calibration points), the running confusion matrix P(measured|prepared) is pushed
+    to the confusion connector once per pass through that axis. With calibrate set, the angle
+    and threshold are also learned from the means of the calibration shots."""
+
+    sink      = InputConnector()
+    source    = OutputConnector()
+    confusion = OutputConnector()
+    threshold = FloatParameter(default=0.0)
+    angle     = FloatParameter(default=0.0)
+    packed    = BoolParameter(default=True)
+    calibrate = BoolParameter(default=False)
+
+    def __init__(self, threshold=None, angle=None, packed=None, calibrate=None, cal_labels=("0", "1"), **kwargs):
+        super(Discriminator, self).__init__(**kwargs)
+        if threshold is not None:
+            self.threshold.value = threshold
+        if angle is not None:
+            self.angle.value = angle
+        if packed is not None:
+            self.packed.value = packed
+        if calibrate is not None:
+            self.calibrate.value = calibrate
+        self.cal_labels = [str(label) for label in cal_labels]
+        self.quince_parameters = [self.threshold, self.angle, self.packed, self.calibrate]
+
+    def calibration_axis(self, descriptor):
+        """Index of the axis whose metadata holds both calibration labels, or None."""
+        for i, axis in enumerate(descriptor.axes):
+            if axis.metadata_enum is not None and all(l in axis.metadata_enum for l in self.cal_labels):
+                return i
+        return None
+
+    def update_descriptors(self):
+        logger.debug('Updating Discriminator "%s" descriptors based on input descriptor: %s.', self.name, self.sink.descriptor)
+        descriptor_in = self.sink.descriptor
+        if len(descriptor_in.axes) == 0:
+            raise ValueError("Discriminator needs at least one axis to discriminate along.")
+        self.shots = descriptor_in.axes[-1].num_points()
+
+        # Frames run through the calibration axis, so that each holds whole sets of cal shots
+        self.cal_axis = self.calibration_axis(descriptor_in)
+        if self.cal_axis is None:
+            frame_length = self.shots
+            self.cal_masks = None
+        else:
+            axis         = descriptor_in.axes[self.cal_axis]
+            frame_length = descriptor_in.num_points_through_axis(self.cal_axis)
+            inner_points = frame_length // axis.num_points()
+            labels       = np.repeat(axis.metadata_enum[axis.metadata], inner_points)
+            self.cal_masks = [labels == l for l in self.cal_labels]
+        self.assembler = RecordAssembler(frame_length)
+        self.cal_sums   = np.zeros(2, dtype=np.complex128)
+        self.cal_counts = np.zeros(2, dtype=np.int64)
+        self.counts     = np.zeros((2, 2), dtype=np.int64)
+
+        descriptor = descriptor_in.copy()
+        descriptor.dtype    = np.uint8
+        descriptor.metadata = dict(descriptor_in.metadata)
+        if self.packed.value:
+            inner = descriptor_in.axes[-1]
+            descriptor.axes = descriptor.axes[:-1] + [DataAxis("{}_packed".format(inner.name), np.arange((self.shots + 7)//8))]
+            descriptor.metadata["packed_bits"] = self.shots
+            descriptor.metadata["bit_order"] = "big"
+        for os in self.source.output_streams:
+            os.set_descriptor(descriptor)
+            os.end_connector.update_descriptors()
+
+        descriptor = descriptor_in.copy()
+        descriptor.dtype    = np.float64
+        descriptor.metadata = dict(descriptor_in.metadata)
+        outer_axes = descriptor_in.axes[:self.cal_axis] if self.cal_axis is not None else []
+        descriptor.axes     = outer_axes + [DataAxis("prepared", [0, 1]), DataAxis("measured", [0, 1])]
+        for os in self.confusion.output_streams:
+            os.set_descriptor(descriptor)
+            os.end_connector.update_descriptors()
+
+    def learn_threshold(self, frames):
+        """Update the angle and threshold from the running means of the calibration shots."""
+        for i, mask in enumerate(self.cal_masks):
+            self.cal_sums[i]   += frames[:, mask].sum()
+            self.cal_counts[i] += frames.shape[0]*np.count_nonzero(mask)
+        ground, excited = self.cal_sums/self.cal_counts
+        self.angle.value     = np.angle(excited - ground)
+        self.threshold.value = np.real(0.5*(ground + excited)*np.exp(-1j*self.angle.value))
+
+    async def process_data(self, data):
+        for frames in self.assembler.assemble(data):
+            await self.process_frames(frames)
+
+    async def process_frames(self, frames):
+        """Discriminate a 2-D array of whole frames and push the states."""
+        if self.cal_masks is not None and self.calibrate.value:
+            self.learn_threshold(frames)
+
+        angle  = self.angle.value
+        states = np.real(frames)*np.cos(angle) + np.imag(frames)*np.sin(angle) > self.threshold.value
+
+        shots = states.reshape(-1, self.shots)
+        if self.packed.value:
+            output = np.packbits(shots, axis=-1)
+        else:
+            output = shots.astype(np.uint8)
+        for os in self.source.output_streams:
+            await os.push(output.ravel())
+
+        if self.cal_masks is not None:
+            # Running confusion matrix after each frame, rows being the prepared states
+            counts = np.empty((frames.shape[0], 2, 2), dtype=np.int64)
+            for i, mask in enumerate(self.cal_masks):
+                excited = np.count_nonzero(states[:, mask], axis=-1)
+                counts[:, i, 1] = excited
+                counts[:, i, 0] = np.count_nonzero(mask) - excited
+            counts = np.cumsum(counts, axis=0) + self.counts
+            self.counts = counts[-1]
+            confusion = counts/counts.sum(axis=-1, keepdims=True)
+            for os in self.confusion.output_streams:
+                await os.push(confusion.ravel())
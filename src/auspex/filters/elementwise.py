@@ -13,15 +13,50 @@ import h5py
 import itertools
 import numpy as np
 import os.path
-import pickle
 import time
-import zlib
 
 from auspex.parameter import Parameter, FilenameParameter
 from auspex.stream import DataStreamDescriptor, InputConnector, OutputConnector
 from auspex.log import logger
-from .filter import Filter
-
+from .filter import Filter, ProfiledRun, perf_clock
+
+
+class AlignmentBuffer(object):
+    """Preallocated buffer holding the data of one stream until the other streams catch up.
+    Appends copy into free space at the end, which is reclaimed by moving the unconsumed data
+    back to the front (or growing the buffer) only when it runs out, so that peek() always
+    returns a contiguous view."""
+    def __init__(self, dtype=None, capacity=1024):
+        super(AlignmentBuffer, self).__init__()
+        self.buffer = np.empty(capacity, dtype=dtype or np.float64)
+        self.start  = 0
+        self.stop   = 0
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def append(self, data):
+        data  = np.asarray(data).ravel()
+        dtype = np.promote_types(self.buffer.dtype, data.dtype)
+        if self.stop + data.size > self.buffer.size or dtype != self.buffer.dtype:
+            size = len(self)
+            if size + data.size > self.buffer.size//2 or dtype != self.buffer.dtype:
+                buffer = np.empty(max(2*self.buffer.size, 2*(size + data.size)), dtype=dtype)
+            else:
+                buffer = self.buffer
+            buffer[:size] = self.buffer[self.start:self.stop]
+            self.buffer, self.start, self.stop = buffer, 0, size
+        self.buffer[self.stop:self.stop+data.size] = data
+        self.stop += data.size
+
+    def peek(self, num):
+        """View of the oldest num points, valid until the next append."""
+        return self.buffer[self.start:self.start+num]
+
+    def consume(self, num):
+        self.start += num
+        if self.start == self.stop:
+            self.start = self.stop = 0
 
 class ElementwiseFilter(Filter):
     """Asynchronously perform elementwise operations on multiple streams:
@@ -61,75 +96,74 @@ class ElementwiseFilter(Filter):
         self.source.descriptor = self.descriptor
         self.source.update_descriptors()
 
-    async def run(self):
-        streams = self.sink.input_streams
-
-        for s in streams[1:]:
-            if not np.all(s.descriptor.expected_tuples() == streams[0].descriptor.expected_tuples()):
-                raise ValueError("Multiple streams connected to correlator must have matching descriptors.")
-
-        # Buffers for stream data
-        stream_data = {s: np.zeros(0, dtype=self.sink.descriptor.dtype) for s in streams}
-
-        # Store whether streams are done
-        stream_done = {s: False for s in streams}
-
-        while True:
-            # Wait for all of the acquisition to complete
-            # Against at least some peoples rational expectations, asyncio.wait doesn't return Futures
-            # in the order of the iterable it was passed, but perhaps just in order of completion. So,
-            # we construct a dictionary in order that that can be mapped back where we need them:
-
-            futures = {
-                asyncio.ensure_future(stream.queue.get()): stream
-                for stream in streams
-            }
-
-            # Deal with non-equal number of messages using timeout
-            responses, pending = await asyncio.wait(futures, return_when=asyncio.FIRST_COMPLETED, timeout=2.0)
-
-            # Construct the inverse lookup, results in {stream: result}
-            stream_results = {futures[res]: res.result() for res in list(responses)}
-
-            # Cancel the futures
-            for pend in list(pending):
-                pend.cancel()
-
-            # Add any new data to the
-            for stream, message in stream_results.items():
+    async def read_stream(self, stream, buffer):
+        """Persistent reader for one input stream: copies data into the stream's buffer as soon
+        as it arrives and wakes up the run loop, until the stream is done."""
+        try:
+            while True:
+                message = await stream.queue.get()
                 message_type = message['type']
-                message_data = message['data']
-                message_comp = message['compression']
-                message_data = pickle.loads(zlib.decompress(message_data)) if message_comp == 'zlib' else message_data
-                message_data = message_data if hasattr(message_data, 'size') else np.array([message_data])
+                message_data = stream.unpack(message)
                 if message_type == 'event':
                     if message['event_type'] == 'done':
-                        stream_done[stream] = True
+                        return
                     elif message['event_type'] == 'refine':
                         logger.warning("Correlator doesn't handle refinement yet!")
-
                 elif message_type == 'data':
-                    stream_data[stream] = np.concatenate((stream_data[stream], message_data.flatten()))
-
-            if False not in stream_done.values():
-                for oc in self.output_connectors.values():
-                    for os in oc.output_streams:
-                        await os.push_event("done")
-                logger.debug('%s "%s" is done', self.__class__.__name__, self.name)
-                break
-
-            # Now process the data with the elementwise operation
-            smallest_length = min([d.size for d in stream_data.values()])
-            new_data = [d[:smallest_length] for d in stream_data.values()]
-            result = new_data[0]
-            for nd in new_data[1:]:
-                result = self.operation()(result, nd)
-            if result.size > 0:
-                await self.source.push(result)
-
-            # Add data to carry_data if necessary
-            for stream in stream_data.keys():
-                if stream_data[stream].size > smallest_length:
-                    stream_data[stream] = stream_data[stream][smallest_length:]
-                else:
-                    stream_data[stream] = np.zeros(0, dtype=self.sink.descriptor.dtype)
+                    message_data = message_data if hasattr(message_data, 'size') else np.array([message_data])
+                    buffer.append(message_data)
+                    self.data_ready.set()
+        finally:
+            self.data_ready.set()
+
+    async def process_aligned(self, data):
+        """Combine the aligned data of all streams (a list of arrays of equal length, valid only
+        until the next await) with the elementwise operation and push the result."""
+        result = data[0] if len(data) > 1 else data[0].copy()
+        for d in data[1:]:
+            result = self.operation()(result, d)
+        await self.source.push(result)
+
+    async def run(self):
+        streams = self.sink.input_streams
+
+        for s in streams[1:]:
+            if not s.descriptor.same_axes(streams[0].descriptor):
+                raise ValueError("Multiple streams connected to correlator must have matching descriptors.")
+
+        # One buffer and one persistent reader per stream. The readers wake this loop
+        # whenever new data arrives, and it consumes whatever is aligned across all streams.
+        self.data_ready = asyncio.Event(loop=self.loop)
+        buffers = [AlignmentBuffer(dtype=self.sink.descriptor.dtype) for s in streams]
+        readers = [self.read_stream(s, b) for s, b in zip(streams, buffers)]
+        # The readers do the unpacking and copying, which is part of this filter's time
+        if perf_clock.enabled:
+            readers = [ProfiledRun(r, self.perf) for r in readers]
+        readers = [asyncio.ensure_future(r) for r in readers]
+
+        try:
+            while True:
+                await self.data_ready.wait()
+                self.data_ready.clear()
+
+                # Surface any errors from the readers rather than waiting forever
+                for reader in readers:
+                    if reader.done() and reader.exception() is not None:
+                        raise reader.exception()
+
+                # Now process the data with the elementwise operation
+                aligned = min(len(b) for b in buffers)
+                if aligned > 0:
+                    await self.process_aligned([b.peek(aligned) for b in buffers])
+                    for b in buffers:
+                        b.consume(aligned)
+
+                if all(reader.done() for reader in readers):
+                    for oc in self.output_connectors.values():
+                        for os in oc.output_streams:
+                            await os.push_event("done")
+                    logger.debug('%s "%s" is done', self.__class__.__name__, self.name)
+                    break
+        finally:
+            for reader in readers:
+                reader.cancel()
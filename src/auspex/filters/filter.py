@@ -9,16 +9,94 @@
 __all__ = ['Filter']
 
 import asyncio
-import zlib
-import pickle
 import copy
+import time
 import numpy as np
-from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, ProcessPoolExecutor
 
 from auspex.parameter import Parameter
 from auspex.stream import DataStream, InputConnector, OutputConnector
 from auspex.log import logger
 
+class PerfCounters(object):
+    """Wall and CPU time spent running the code of a filter."""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.wall_time = 0.0
+        self.cpu_time  = 0.0
+
+class PerfClock(object):
+    """Charges elapsed time to whichever PerfCounters are current. Only one coroutine runs at a
+    time on the event loop, so a single clock suffices: each step of a profiled run() switches
+    to its filter's counters, as does a fused filter called from within another one's step.
+    Switching costs about a microsecond, so it only happens while the clock is enabled (see
+    Experiment.enable_profiling)."""
+    def __init__(self):
+        self.enabled = False
+        self.current = None
+        self.wall    = 0.0
+        self.cpu     = 0.0
+
+    def switch(self, counters, perf_counter=time.perf_counter, process_time=time.process_time):
+        """Make counters current, charging the time since the last switch to the previous
+        counters, which are returned."""
+        wall     = perf_counter()
+        cpu      = process_time()
+        previous = self.current
+        if previous is not None:
+            previous.wall_time += wall - self.wall
+            previous.cpu_time  += cpu - self.cpu
+        self.current = counters
+        self.wall    = wall
+        self.cpu     = cpu
+        return previous
+
+perf_clock = PerfClock()
+
+class ProfiledRun(object):
+    """Awaitable wrapper of a filter's run() coroutine that charges each step of the coroutine
+    to the filter's counters. Works for any run(), including those overriding Filter.run."""
+    def __init__(self, coro, counters):
+        self.coro     = coro
+        self.counters = counters
+
+    def __await__(self):
+        return self
+    __iter__ = __await__
+
+    def __next__(self):
+        return self.send(None)
+
+    def send(self, value):
+        previous = perf_clock.switch(self.counters)
+        try:
+            return self.coro.send(value)
+        finally:
+            # Resume with whatever was running when we yielded, e.g. a fused filter
+            self.counters = perf_clock.switch(previous)
+
+    def throw(self, *args):
+        previous = perf_clock.switch(self.counters)
+        try:
+            return self.coro.throw(*args)
+        finally:
+            self.counters = perf_clock.switch(previous)
+
+    def close(self):
+        return self.coro.close()
+
+# Where Filter.offload runs its work, see the execution keyword of Filter
+EXECUTION_POLICIES = ("inline", "thread", "process")
+executors = {}
+
+def get_executor(policy):
+    """The pool shared by all filters with the given execution policy, created on first use."""
+    if policy not in executors:
+        executors[policy] = ThreadPoolExecutor() if policy == "thread" else ProcessPoolExecutor()
+    return executors[policy]
+
 class MetaFilter(type):
     """Meta class to bake the input/output connectors into a Filter class description
     """
@@ -55,6 +133,23 @@ class Filter(metaclass=MetaFilter):
         # For signaling to Quince that something is wrong
         self.out_of_spec = False
 
+        # Time spent in this filter, see profile()
+        self.perf = PerfCounters()
+
+        # Batching of data messages in the run loop: at most max_batch_size messages
+        # (None for no limit) are handed to process_batch at once, waiting up to
+        # max_batch_latency seconds for more to arrive. The default of 1 disables batching.
+        self.max_batch_size    = kwargs.get('max_batch_size', 1)
+        self.max_batch_latency = kwargs.get('max_batch_latency', 0.0)
+
+        # Where the CPU-heavy work handed to offload() runs: "inline" on the event loop,
+        # "thread" in a shared thread pool (NumPy releases the GIL in its kernels) or "process"
+        # in a shared process pool, for which the work and its arguments must be picklable.
+        self.execution = kwargs.get('execution', 'inline')
+        if self.execution not in EXECUTION_POLICIES:
+            raise ValueError("Unknown execution policy '{}' for {}, choose from {}".format(
+                             self.execution, self, EXECUTION_POLICIES))
+
         for ic in self._input_connectors:
             a = InputConnector(name=ic, parent=self)
             a.parent = self
@@ -74,6 +169,35 @@ class Filter(metaclass=MetaFilter):
     def __repr__(self):
         return "<{}(name={})>".format(self.__class__.__name__, self.name)
 
+    def profile(self):
+        """Performance counters of the last run: the messages and points received, the time
+        messages waited in the input streams, the bytes pushed downstream, and the wall and CPU
+        time spent running this filter (for the generic run loop, essentially process_data).
+        The times are only measured when profiling is enabled, and are zero otherwise. CPU time
+        is that of the whole process, so work offloaded to the thread pool is charged to whichever
+        filter is running on the loop meanwhile, and work in the process pool is not counted."""
+        input_streams  = [s for ic in self.input_connectors.values() for s in ic.input_streams]
+        output_streams = [s for oc in self.output_connectors.values() for s in oc.output_streams]
+        counters = {"messages": 0, "points": 0, "queue_wait": 0.0}
+        for stream in input_streams:
+            for k, v in stream.perf_counters().items():
+                if k in counters:
+                    counters[k] += v
+        counters["bytes_out"] = sum(s.bytes_pushed for s in output_streams)
+        counters["wall_time"] = self.perf.wall_time
+        counters["cpu_time"]  = self.perf.cpu_time
+        return counters
+
+    async def offload(self, func, *args):
+        """Return func(*args), computed according to the execution policy of the filter. Other
+        filters and the socket readers keep running on the loop while a pool does the work.
+        Callers await the result before pushing it, so outputs keep their order and each filter
+        has at most one piece of work in flight, with the pools bounding the total."""
+        if self.execution == "inline":
+            return func(*args)
+        loop = getattr(self, 'loop', None) or asyncio.get_event_loop()
+        return await loop.run_in_executor(get_executor(self.execution), func, *args)
+
     def update_descriptors(self):
         """This method is called whenever the connectivity of the graph changes. This may have implications
         for the internal functioning of the filter, in which case update_descriptors should be overloaded.
@@ -105,18 +229,40 @@ class Filter(metaclass=MetaFilter):
         logger.debug('Running "%s" run loop', self.name)
 
         input_stream = getattr(self, self._input_connectors[0]).input_streams[0]
+        batching     = self.max_batch_size != 1
+        message      = None
 
         while True:
 
-            message = await input_stream.queue.get()
+            # We may already hold a message that ended the previous batch
+            if message is None:
+                message = await input_stream.queue.get()
+
+            if batching and message['type'] == 'data':
+                message_data = input_stream.unpack(message)
+                if not hasattr(message_data, 'size'):
+                    message_data = np.array([message_data])
+                batch, message = await self.drain_batch(input_stream, message_data.ravel())
+                await self.process_batch(batch)
+                continue
+
+            if await self.handle_message(input_stream, message):
+                break
+            message = None
+
+    async def handle_message(self, input_stream, message):
+        """Act on a single message from the input stream, returning True once the stream is done.
+        Called by run, or directly by the upstream filter when this one is fused into its chain."""
+        # A fused filter runs within another one's run loop, so it takes over the clock
+        fused = perf_clock.enabled and perf_clock.current is not self.perf
+        if fused:
+            previous = perf_clock.switch(self.perf)
+        try:
             message_type = message['type']
-            message_data = message['data']
-            message_comp = message['compression']
+            message_data = input_stream.unpack(message)
 
-            if message_comp == 'zlib':
-                message_data = pickle.loads(zlib.decompress(message_data))
             # If we receive a message
-            if message['type'] == 'event':
+            if message_type == 'event':
                 logger.debug('%s "%s" received event "%s"', self.__class__.__name__, self.name, message_data)
 
                 # Propagate along the graph
@@ -128,20 +274,79 @@ class Filter(metaclass=MetaFilter):
                 # Check to see if we're done
                 if message['event_type'] == 'done':
                     await self.on_done()
-                    break
+                    return True
                 elif message['event_type'] == 'refined':
                     await self.refine(message_data)
 
-            elif message['type'] == 'data':
+            elif message_type == 'data':
                 if not hasattr(message_data, 'size'):
                     message_data = np.array([message_data])
                 logger.debug('%s "%s" received %d points.', self.__class__.__name__, self.name, message_data.size)
                 logger.debug("Now has %d of %d points.", input_stream.points_taken, input_stream.num_points())
-                await self.process_data(message_data.flatten())
+                await self.process_data(message_data.ravel())
 
-            elif message['type'] == 'data_direct':
+            elif message_type == 'data_direct':
                 await self.process_direct(message_data)
 
+            return False
+        finally:
+            if fused:
+                perf_clock.switch(previous)
+
+    def fusable(self):
+        """Whether this filter can be run inline by the filter feeding it (see
+        Experiment.fuse_chains): it must rely on the generic run loop with a single input
+        stream and no batching."""
+        input_streams = [s for ic in self.input_connectors.values() for s in ic.input_streams]
+        return type(self).run is Filter.run and len(input_streams) == 1 and self.max_batch_size == 1
+
+    async def drain_batch(self, input_stream, data):
+        """Gather any further data messages waiting on the input stream into a batch that starts
+        with `data`. Stops at max_batch_size messages, at the first non-data message, or once
+        nothing has arrived for max_batch_latency seconds. Returns the list of flattened arrays
+        and the message that ended the batch (or None), which the caller must handle next."""
+        # Views into a ring buffer stream are released by the next get(), so copy those as
+        # they arrive. Other transports hand over data that nothing else writes to.
+        copy         = input_stream.transport == 'ring'
+        batch        = [data.copy() if copy else data]
+        num_messages = 1
+        deadline     = time.time() + self.max_batch_latency
+
+        while self.max_batch_size is None or num_messages < self.max_batch_size:
+            if input_stream.queue.empty():
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                getter = asyncio.ensure_future(input_stream.queue.get())
+                done, _ = await asyncio.wait([getter], timeout=timeout)
+                if not done:
+                    getter.cancel()
+                    break
+                message = getter.result()
+            else:
+                message = input_stream.queue.get_nowait()
+
+            if message['type'] != 'data':
+                return batch, message
+
+            message_data = input_stream.unpack(message)
+            if not hasattr(message_data, 'size'):
+                message_data = np.array([message_data])
+            batch.append(message_data.ravel().copy() if copy else message_data.ravel())
+            num_messages += 1
+
+        logger.debug('%s "%s" batched %d messages.', self.__class__.__name__, self.name, num_messages)
+        return batch, None
+
+    async def process_batch(self, batch):
+        """Process a list of flattened data arrays drained from the input stream in one go. Only
+        called when batching is enabled. By default the batch is concatenated and handed to
+        process_data; filters can override this to work on the list directly."""
+        if len(batch) == 1:
+            await self.process_data(batch[0])
+        else:
+            await self.process_data(np.concatenate(batch))
+
     async def process_data(self, data):
         """Process data coming through the filter pipeline"""
         pass
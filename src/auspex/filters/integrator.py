@@ -8,13 +8,32 @@
 
 __all__ = ['KernelIntegrator']
 
+import ast
+
 import numpy as np
 
 from .filter import Filter
 from auspex.parameter import Parameter, FloatParameter, IntParameter, BoolParameter
-from auspex.stream import DataStreamDescriptor, InputConnector, OutputConnector
+from auspex.stream import DataAxis, DataStreamDescriptor, InputConnector, OutputConnector, RecordAssembler
 from auspex.log import logger
 
+def load_kernel(kernel):
+    """Return a kernel as a 2-D complex array with one kernel per row. Accepts an array or
+    nested list, the path of a .npy file, or a string holding a Python literal such as
+    "[1, 1j, 0]". Strings are parsed with ast.literal_eval rather than evaluated."""
+    if isinstance(kernel, str):
+        if kernel.endswith(".npy"):
+            kernel = np.load(kernel)
+        else:
+            try:
+                kernel = ast.literal_eval(kernel)
+            except (ValueError, SyntaxError):
+                raise ValueError("Could not parse kernel '{}': expected a .npy file or a list of numbers.".format(kernel))
+    kernel = np.array(kernel, dtype=np.complex128)
+    if kernel.ndim > 2 or kernel.size == 0:
+        raise ValueError("Kernels must be a 1-D array or a 2-D array of one kernel per row, got shape {}".format(kernel.shape))
+    return np.atleast_2d(kernel)
+
 class KernelIntegrator(Filter):
 
     sink   = InputConnector()
@@ -26,24 +45,29 @@ class KernelIntegrator(Filter):
     box_car_stop = FloatParameter()
     frequency = FloatParameter()
 
-    """Integrate with a given kernel. Kernel will be padded/truncated to match record length"""
-    def __init__(self, **kwargs):
+    """Integrate with a given kernel. Kernel will be padded/truncated to match record length.
+
+    The kernel may also be a 2-D array (or .npy file) of several kernels, one per row, in which
+    case all of them are applied with a single matrix product per batch of records. The source
+    then carries a trailing "kernel" axis, and if kernel_names are given each kernel also gets an
+    output connector of that name."""
+    def __init__(self, kernel_names=None, **kwargs):
         super(KernelIntegrator, self).__init__(**kwargs)
-        if len(kwargs) > 0:
-            self.kernel.value = kwargs['kernel']
-            self.bias.value = kwargs['bias']
-            self.simple_kernel.value = kwargs['simple_kernel']
-            self.box_car_start.value = kwargs['box_car_start']
-            self.box_car_stop.value = kwargs['box_car_stop']
-            self.frequency.value = kwargs['frequency']
-            if "pre_integration_operation" in kwargs:
-                self.pre_int_op = kwargs["pre_integration_operation"]
-            else:
-                self.pre_int_op = None
-            if "post_integration_operation" in kwargs:
-                self.post_int_op = kwargs["post_integration_operation"]
-            else:
-                self.post_int_op = None
+        self.kernel_names = list(kernel_names) if kernel_names is not None else []
+        self.kernel_sources = []
+        for name in self.kernel_names:
+            oc = OutputConnector(name=name, parent=self)
+            self.output_connectors[name] = oc
+            setattr(self, name, oc)
+            self.kernel_sources.append(oc)
+        self.kernel.value = kwargs.get('kernel')
+        self.bias.value = kwargs.get('bias', 0.0)
+        self.simple_kernel.value = kwargs.get('simple_kernel', False)
+        self.box_car_start.value = kwargs.get('box_car_start', 0.0)
+        self.box_car_stop.value = kwargs.get('box_car_stop', 0.0)
+        self.frequency.value = kwargs.get('frequency', 0.0)
+        self.pre_int_op = kwargs.get('pre_integration_operation')
+        self.post_int_op = kwargs.get('post_integration_operation')
 
     def update_descriptors(self):
         if self.kernel.value is None:
@@ -61,13 +85,19 @@ class KernelIntegrator(Filter):
             kernel[sample_start:sample_stop] = 1.0
             # add modulation
             kernel *= np.exp(2j * np.pi * self.frequency.value * time_step * time_pts)
+            kernels = kernel[np.newaxis, :]
         else:
-            kernel = eval(self.kernel.value.encode('unicode_escape'))
-        # pad or truncate the kernel to match the record length
-        if kernel.size < record_length:
-            self.aligned_kernel = np.append(kernel, np.zeros(record_length-kernel.size, dtype=np.complex128))
-        else:
-            self.aligned_kernel = np.resize(kernel, record_length)
+            kernels = load_kernel(self.kernel.value)
+        if self.kernel_names and len(self.kernel_names) != kernels.shape[0]:
+            raise ValueError("KernelIntegrator has {} kernel names for {} kernels".format(len(self.kernel_names), kernels.shape[0]))
+
+        # pad or truncate the kernels to match the record length
+        self.kernels = np.zeros((kernels.shape[0], record_length), dtype=np.complex128)
+        self.kernels[:, :min(record_length, kernels.shape[1])] = kernels[:, :record_length]
+        self.aligned_kernel = self.kernels[0]
+        # Transposed once here so that every batch is a single GEMM
+        self.kernel_matrix = np.ascontiguousarray(self.kernels.T)
+        self.assembler = RecordAssembler(record_length)
 
         # Integrator reduces and removes axis on output stream
         # update output descriptors
@@ -76,18 +106,33 @@ class KernelIntegrator(Filter):
         output_descriptor.axes = self.sink.descriptor.axes[:-1]
         output_descriptor.exp_src = self.sink.descriptor.exp_src
         output_descriptor.dtype = np.complex128
+        for oc in self.kernel_sources:
+            for os in oc.output_streams:
+                os.set_descriptor(output_descriptor)
+                os.end_connector.update_descriptors()
+
+        # Several kernels are stacked along a new innermost axis
+        if self.kernels.shape[0] > 1:
+            output_descriptor = output_descriptor.copy()
+            output_descriptor.axes = output_descriptor.axes + [DataAxis("kernel", list(range(self.kernels.shape[0])))]
         for os in self.source.output_streams:
             os.set_descriptor(output_descriptor)
             os.end_connector.update_descriptors()
 
     async def process_data(self, data):
+        for records in self.assembler.assemble(data):
+            await self.process_records(records)
 
-        # TODO: handle variable partial records
+    async def process_records(self, records):
+        """Integrate a 2-D array of whole records and push the result."""
         if self.pre_int_op:
-            data = self.pre_int_op(data)
-        filtered = np.inner(np.reshape(data, (-1, len(self.aligned_kernel))), self.aligned_kernel)
+            records = self.pre_int_op(records)
+        filtered = await self.offload(np.dot, records, self.kernel_matrix)
         if self.post_int_op:
             filtered = self.post_int_op(filtered)
         # push to ouptut connectors
         for os in self.source.output_streams:
-            await os.push(filtered)
+            await os.push(filtered if filtered.shape[1] > 1 else filtered[:, 0])
+        for ct, oc in enumerate(self.kernel_sources):
+            for os in oc.output_streams:
+                await os.push(np.ascontiguousarray(filtered[:, ct]))
@@ -11,8 +11,6 @@ __all__ = ['WriteToHDF5', 'DataBuffer', 'ProgressBar']
 import asyncio, concurrent
 import itertools
 import h5py
-import pickle
-import zlib
 import numpy as np
 import os.path
 import time
@@ -45,6 +43,7 @@ class WriteToHDF5(Filter):
         self.file = None
         self.group = None
         self.store_tuples = store_tuples
+        self.tuple_chunk_size = 2**20 # Points of the non-adaptive tuples to compute and write at a time
         self.create_group = True
         self.up_to_date = False
         self.sink.max_input_streams = 100
@@ -81,8 +80,9 @@ class WriteToHDF5(Filter):
         i = max(filenums) + 1 if filenums else 0
         return "{}-{:04d}{}".format(basename,i,ext)
 
-    def new_file(self):
-        """ Open a new data file to write """
+    def new_file(self, filename=None):
+        """ Open a new data file to write, numbered after those already in its folder unless
+        a filename is given """
         # Close the current file, if any
         if self.file is not None:
             try:
@@ -91,7 +91,7 @@ class WriteToHDF5(Filter):
                 logger.error("Encounter exception: {}".format(e))
                 logger.error("Cannot close file '{}'. File may be damaged.".format(self.file.filename))
         # Get new file name
-        self.filename.value = self.new_filename()
+        self.filename.value = filename if filename is not None else self.new_filename()
         head = os.path.dirname(self.filename.value)
         head = os.path.normpath(head)
         dirs = head.split(os.sep)
@@ -119,7 +119,7 @@ class WriteToHDF5(Filter):
         stream     = streams[0]
 
         for s in streams[1:]:
-            if not np.all(s.descriptor.expected_tuples() == streams[0].descriptor.expected_tuples()):
+            if not s.descriptor.same_axes(streams[0].descriptor):
                 raise ValueError("Multiple streams connected to writer must have matching descriptors.")
 
         desc       = stream.descriptor
@@ -133,9 +133,6 @@ class WriteToHDF5(Filter):
         if desc.is_adaptive() and not self.store_tuples:
             raise Exception("Cannot omit writing tuples with an adaptive sweep... please enabled store_tuples.")
 
-        if self.store_tuples:
-            # All of the combinations for the present values of the sweep parameters only
-            tuples          = desc.expected_tuples(with_metadata=True, as_structured_array=True)
         expected_length = desc.expected_num_points()
 
         compression = 'gzip' if self.compress else None
@@ -158,6 +155,10 @@ class WriteToHDF5(Filter):
             dset.attrs['is_data'] = True
             dset.attrs['store_tuples'] = self.store_tuples
             dset.attrs['name'] = stream.descriptor.data_name
+            # Bit-packed streams (e.g. from a Discriminator) record how to unpack them
+            for k in ('packed_bits', 'bit_order'):
+                if k in stream.descriptor.metadata:
+                    dset.attrs[k] = stream.descriptor.metadata[k]
             dset_for_streams[stream] = dset
 
         # Write params into attrs
@@ -244,11 +245,13 @@ class WriteToHDF5(Filter):
                     dset.attrs['name'] = name + "_metadata"
                     tuple_dset_for_axis_name[name + "_metadata"] = dset
 
-        # Write all the tuples if this isn't adaptive
+        # Write all the tuples if this isn't adaptive, a chunk at a time
         if self.store_tuples:
             if not desc.is_adaptive():
-                for i, a in enumerate(axis_names):
-                    tuple_dset_for_axis_name[a][:] = tuples[a]
+                for start in range(0, expected_length, self.tuple_chunk_size):
+                    tuples = desc.coordinates(start, start + self.tuple_chunk_size)
+                    for a in axis_names:
+                        tuple_dset_for_axis_name[a][start:start+len(tuples)] = tuples[a]
 
         # Write pointer
         w_idx = 0
@@ -304,9 +307,7 @@ class WriteToHDF5(Filter):
 
             
             elif message_type == 'data':
-                message_data = [message['data'] for message in messages]
-                message_comp = [message['compression'] for message in messages]
-                message_data = [pickle.loads(zlib.decompress(dat)) if comp == 'zlib' else dat for comp, dat in zip(message_comp, message_data)]
+                message_data = [stream.unpack(message) for stream, message in zip(streams, messages)]
                 message_data = [dat if hasattr(dat, 'size') else np.array([dat]) for dat in message_data]  # Convert single values to arrays
 
                 for ii in range(len(message_data)):
@@ -328,9 +329,9 @@ class WriteToHDF5(Filter):
                 # Write the coordinate tuples
                 if self.store_tuples:
                     if desc.is_adaptive():
-                        tuples = desc.tuples()
+                        tuples = desc.tuples(start=w_idx, stop=w_idx+d.size)
                         for axis_name in axis_names:
-                            tuple_dset_for_axis_name[axis_name][w_idx:w_idx+d.size] = tuples[axis_name][w_idx:w_idx+d.size]
+                            tuple_dset_for_axis_name[axis_name][w_idx:w_idx+d.size] = tuples[axis_name]
 
                 self.file.flush()
                 w_idx += message_data[0].size
@@ -358,13 +359,13 @@ class DataBuffer(Filter):
         streams = self.sink.input_streams
 
         for s in streams[1:]:
-            if not np.all(s.descriptor.expected_tuples() == streams[0].descriptor.expected_tuples()):
+            if not s.descriptor.same_axes(streams[0].descriptor):
                 raise ValueError("Multiple streams connected to DataBuffer must have matching descriptors.")
 
         self.descriptor = streams[0].descriptor
 
         # Buffers for stream data
-        stream_data = {s: np.zeros(0, dtype=self.sink.descriptor.dtype) for s in streams}
+        stream_data = {s: np.zeros(0, dtype=s.descriptor.dtype) for s in streams}
 
         # Store whether streams are done
         stream_done = {s: False for s in streams}
@@ -389,9 +390,7 @@ class DataBuffer(Filter):
             # Add any new data to the
             for stream, message in stream_results.items():
                 message_type = message['type']
-                message_data = message['data']
-                message_comp = message['compression']
-                message_data = pickle.loads(zlib.decompress(message_data)) if message_comp == 'zlib' else message_data
+                message_data = stream.unpack(message)
                 message_data = message_data if hasattr(message_data, 'size') else np.array([message_data])
                 if message_type == 'event':
                     if message['event_type'] == 'done':
@@ -433,7 +432,7 @@ class DataBuffer(Filter):
         data = np.empty(self.buffers[streams[0]].size, dtype=dtype)
 
         if self.store_tuples:
-            tuples = desc.tuples(as_structured_array=True)
+            tuples = desc.coordinates(0, data.size)
             for a in desc.axis_names(with_metadata=True):
                 data[a] = tuples[a]
         for stream in streams:
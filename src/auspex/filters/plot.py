@@ -271,9 +271,7 @@ class XYPlotter(Filter):
                     break
 
             elif message_type == 'data':
-                message_data = [message['data'] for message in messages]
-                message_comp = [message['compression'] for message in messages]
-                message_data = [pickle.loads(zlib.decompress(dat)) if comp == 'zlib' else dat for comp, dat in zip(message_comp, message_data)]
+                message_data = [self.stream_x.unpack(message_x), self.stream_y.unpack(message_y)]
                 message_data = [dat if hasattr(dat, 'size') and dat.size != 1 else np.array([dat]) for dat in message_data]  # Convert single values to arrays
 
                 data_x, data_y = message_data
@@ -0,0 +1,166 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+__all__ = ['SpectrumAnalyzer']
+
+import time
+import numpy as np
+import scipy.signal
+
+from .filter import Filter
+from auspex.parameter import Parameter, IntParameter, BoolParameter
+from auspex.stream import DataAxis, InputConnector, OutputConnector, RecordAssembler
+from auspex.log import logger
+
+class SpectrumAnalyzer(Filter):
+    """Welch estimate of the spectral density along the last axis. Each record is cut into
+    segments of nperseg points overlapping by noverlap (nperseg//2 by default), which are
+    detrended, windowed and Fourier transformed, and their periodograms averaged. This matches
+    scipy.signal.welch with the default constant detrending.
+
+    source:          the spectrum of every record, the last axis replaced by a frequency axis.
+    partial_average: the running Welch average over all records so far, pushed at most every
+                     update_interval seconds so long acquisitions can be watched live.
+    final_average:   the Welch average over all of the records, pushed once at the end.
+
+    Real data gives one-sided spectra from real FFTs, complex data gives two-sided spectra
+    with the frequencies in increasing order. Only the running sum of the periodograms is
+    kept, so memory use does not grow with the length of the acquisition."""
+
+    sink            = InputConnector()
+    source          = OutputConnector()
+    partial_average = OutputConnector()
+    final_average   = OutputConnector()
+    nperseg         = IntParameter(default=256)
+    noverlap        = IntParameter()
+    window          = Parameter(default="hann")
+    scaling         = Parameter(allowed_values=["density", "spectrum"], default="density")
+    detrend         = BoolParameter(default=True)
+
+    def __init__(self, nperseg=None, noverlap=None, window=None, scaling=None, detrend=None, **kwargs):
+        super(SpectrumAnalyzer, self).__init__(**kwargs)
+        if nperseg is not None:
+            self.nperseg.value = nperseg
+        if noverlap is not None:
+            self.noverlap.value = noverlap
+        if window is not None:
+            self.window.value = window
+        if scaling is not None:
+            self.scaling.value = scaling
+        if detrend is not None:
+            self.detrend.value = detrend
+        self.quince_parameters = [self.nperseg, self.noverlap, self.window, self.scaling]
+
+        # Rate limiting for partial averages
+        self.last_update     = time.time()
+        self.update_interval = 0.5
+
+    def update_descriptors(self):
+        logger.debug('Updating SpectrumAnalyzer "%s" descriptors based on input descriptor: %s.', self.name, self.sink.descriptor)
+        descriptor_in = self.sink.descriptor
+        time_axis     = descriptor_in.axes[-1]
+        record_length = time_axis.num_points()
+        time_pts      = np.asarray(time_axis.points, dtype=np.float64)
+        fs            = 1.0/(time_pts[1] - time_pts[0]) if time_pts.size > 1 else 1.0
+
+        nperseg  = min(self.nperseg.value, record_length)
+        noverlap = self.noverlap.value if self.noverlap.value is not None else nperseg//2
+        if not 0 <= noverlap < nperseg:
+            raise ValueError("SpectrumAnalyzer needs 0 <= noverlap < nperseg, got {} and {}".format(noverlap, nperseg))
+        self.segment_length = nperseg
+        self.step           = nperseg - noverlap
+        self.num_segments   = (record_length - noverlap)//self.step
+
+        # Preallocated window and scaling, folded together so each segment takes one multiply
+        window = scipy.signal.get_window(self.window.value, nperseg)
+        if self.scaling.value == "density":
+            scale = 1.0/(fs*np.sum(window**2))
+        else:
+            scale = 1.0/np.sum(window)**2
+        self.window_array = np.sqrt(scale)*window
+
+        self.complex = np.issubdtype(np.dtype(descriptor_in.dtype), np.complexfloating)
+        if self.complex:
+            frequencies = np.fft.fftshift(np.fft.fftfreq(nperseg, 1.0/fs))
+            self.one_sided = None
+        else:
+            frequencies = np.fft.rfftfreq(nperseg, 1.0/fs)
+            # Fold the negative frequencies onto the positive ones, except DC and Nyquist
+            self.one_sided = np.full(frequencies.size, 2.0)
+            self.one_sided[0] = 1.0
+            if nperseg % 2 == 0:
+                self.one_sided[-1] = 1.0
+
+        self.assembler   = RecordAssembler(record_length)
+        self.buffer      = None
+        self.psd_sum     = np.zeros(frequencies.size)
+        self.num_records = 0
+        self.expected_records = descriptor_in.num_points()//record_length
+
+        frequency_axis = DataAxis("frequency", frequencies, unit="Hz")
+        descriptor = descriptor_in.copy()
+        descriptor.axes  = descriptor_in.axes[:-1] + [frequency_axis]
+        descriptor.dtype = np.float64
+        for os in self.source.output_streams:
+            os.set_descriptor(descriptor)
+            os.end_connector.update_descriptors()
+
+        descriptor = descriptor_in.copy()
+        descriptor.axes  = [frequency_axis]
+        descriptor.dtype = np.float64
+        for os in self.partial_average.output_streams + self.final_average.output_streams:
+            os.set_descriptor(descriptor)
+            os.end_connector.update_descriptors()
+
+    def spectra(self, records):
+        """Welch spectra of a 2-D array of whole records, one row per record."""
+        num_records = records.shape[0]
+        segments = np.lib.stride_tricks.as_strided(records,
+                        shape=(num_records, self.num_segments, self.segment_length),
+                        strides=(records.strides[0], self.step*records.strides[1], records.strides[1]))
+
+        # Reuse the windowed segment buffer between batches of the same size
+        if self.buffer is None or self.buffer.shape[0] < num_records or self.buffer.dtype != records.dtype:
+            self.buffer = np.empty((num_records, self.num_segments, self.segment_length), dtype=records.dtype)
+        windowed = self.buffer[:num_records]
+        if self.detrend.value:
+            np.subtract(segments, segments.mean(axis=-1, keepdims=True), out=windowed)
+            windowed *= self.window_array
+        else:
+            np.multiply(segments, self.window_array, out=windowed)
+
+        if self.complex:
+            spectrum = np.fft.fftshift(np.fft.fft(windowed, axis=-1), axes=-1)
+        else:
+            spectrum = np.fft.rfft(windowed, axis=-1)
+        power = spectrum.real**2 + spectrum.imag**2
+        psd   = power.mean(axis=1)
+        if self.one_sided is not None:
+            psd *= self.one_sided
+        return psd
+
+    async def process_data(self, data):
+        for records in self.assembler.assemble(data):
+            await self.process_records(records)
+
+    async def process_records(self, records):
+        """Compute the spectra of whole records, push them, and update the running average."""
+        psd = self.spectra(records)
+        for os in self.source.output_streams:
+            await os.push(psd.ravel())
+
+        self.psd_sum     += psd.sum(axis=0)
+        self.num_records += psd.shape[0]
+        average = self.psd_sum/self.num_records
+        if self.num_records >= self.expected_records:
+            for os in self.final_average.output_streams + self.partial_average.output_streams:
+                await os.push(average)
+        elif time.time() - self.last_update >= self.update_interval:
+            for os in self.partial_average.output_streams:
+                await os.push(average)
+            self.last_update = time.time()
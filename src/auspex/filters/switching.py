@@ -0,0 +1,121 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+__all__ = ['SwitchingCounter']
+
+import numpy as np
+
+from .filter import Filter
+from auspex.parameter import Parameter, FloatParameter
+from auspex.stream import DataAxis, InputConnector, OutputConnector, RecordAssembler
+from auspex.log import logger
+
+class SwitchingCounter(Filter):
+    """Count switching events online instead of writing the raw voltages. The sink carries
+    (..., attempt, state) data where the innermost state axis holds the initial and final
+    readout of each attempt. Every sweep point, i.e. every pass through the attempt axis, yields:
+
+    counts:      the 2x2 matrix of attempts going from the initial to the final state.
+    probability: the mean of the Beta(1 + switched, 1 + not switched) posterior of the switching
+                 probability for each start state, as computed by analysis.switching.switching_phase.
+    error:       the standard deviation of that posterior.
+
+    Voltages above the threshold are in state 1. If no threshold is given it is learned as the
+    midpoint of a running two-means clustering of all the voltages seen so far."""
+
+    sink        = InputConnector()
+    counts      = OutputConnector()
+    probability = OutputConnector()
+    error       = OutputConnector()
+    threshold   = FloatParameter()
+    state_axis   = Parameter(default="state")
+    attempt_axis = Parameter(default="attempt")
+
+    def __init__(self, threshold=None, state_axis=None, attempt_axis=None, **kwargs):
+        super(SwitchingCounter, self).__init__(**kwargs)
+        if threshold is not None:
+            self.threshold.value = threshold
+        if state_axis is not None:
+            self.state_axis.value = state_axis
+        if attempt_axis is not None:
+            self.attempt_axis.value = attempt_axis
+        self.adaptive = threshold is None
+        self.quince_parameters = [self.threshold, self.state_axis, self.attempt_axis]
+
+    def update_descriptors(self):
+        logger.debug('Updating SwitchingCounter "%s" descriptors based on input descriptor: %s.', self.name, self.sink.descriptor)
+        descriptor_in = self.sink.descriptor
+        names = [a.name for a in descriptor_in.axes]
+        if names[-2:] != [self.attempt_axis.value, self.state_axis.value]:
+            raise ValueError("SwitchingCounter needs '{}' and '{}' as the two innermost axes, got {}".format(
+                             self.attempt_axis.value, self.state_axis.value, names))
+        if descriptor_in.axes[-1].num_points() != 2:
+            raise ValueError("SwitchingCounter needs an initial and a final readout along '{}'".format(self.state_axis.value))
+
+        self.attempts  = descriptor_in.axes[-2].num_points()
+        self.assembler = RecordAssembler(2*self.attempts)
+        self.sums    = np.zeros(2)
+        self.nums    = np.zeros(2)
+        self.centers = None
+
+        outer_axes = descriptor_in.axes[:-2]
+        descriptors = {}
+        descriptors[self.counts] = descriptor_in.copy()
+        descriptors[self.counts].axes  = outer_axes + [DataAxis("initial_state", [0, 1]), DataAxis("final_state", [0, 1])]
+        descriptors[self.counts].dtype = np.int64
+        for oc in [self.probability, self.error]:
+            descriptors[oc] = descriptor_in.copy()
+            descriptors[oc].axes  = outer_axes + [DataAxis("start_state", [0, 1])]
+            descriptors[oc].dtype = np.float64
+
+        for oc, descriptor in descriptors.items():
+            for os in oc.output_streams:
+                os.set_descriptor(descriptor)
+                os.end_connector.update_descriptors()
+
+    def learn_threshold(self, values, iterations=5):
+        """Refine the two cluster centers with this batch of voltages and move the threshold
+        to their midpoint. Sums over earlier batches are kept so the centers are running means."""
+        if self.centers is None:
+            self.centers = np.percentile(values, [25, 75])
+        for i in range(iterations):
+            upper = values > self.centers.mean()
+            sums  = self.sums + [values[~upper].sum(), values[upper].sum()]
+            nums  = self.nums + [values.size - np.count_nonzero(upper), np.count_nonzero(upper)]
+            self.centers = np.where(nums > 0, sums/np.maximum(nums, 1), self.centers)
+        self.sums, self.nums = sums, nums
+        self.threshold.value = self.centers.mean()
+
+    async def process_data(self, data):
+        for frames in self.assembler.assemble(data):
+            await self.process_frames(frames)
+
+    async def process_frames(self, frames):
+        """Count the transitions of a 2-D array of whole sweep points and push the results."""
+        if self.adaptive:
+            self.learn_threshold(np.real(frames).ravel())
+        states  = (np.real(frames) > self.threshold.value).reshape(frames.shape[0], self.attempts, 2)
+        initial = states[:, :, 0]
+        final   = states[:, :, 1]
+
+        counts = np.empty((frames.shape[0], 2, 2), dtype=np.int64)
+        for i in range(2):
+            started = initial == i
+            counts[:, i, 1] = np.count_nonzero(started & final, axis=-1)
+            counts[:, i, 0] = np.count_nonzero(started, axis=-1) - counts[:, i, 1]
+
+        # Beta posteriors with a flat prior, switched meaning the final state differs from the start
+        switched = counts[:, [0, 1], [1, 0]]
+        a = 1.0 + switched
+        b = 1.0 + counts.sum(axis=-1) - switched
+        mean  = a/(a + b)
+        error = np.sqrt(a*b/((a + b)**2*(a + b + 1)))
+
+        for oc, result in [(self.counts, counts), (self.probability, mean), (self.error, error)]:
+            for os in oc.output_streams:
+                await os.push(result.ravel())
@@ -0,0 +1,148 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+"""Scheduling lag monitor for the asyncio loop that runs the experiment.
+
+Digitizer sockets are drained by reader callbacks on the same loop as the filters and the
+sweep, so anything that holds the loop delays them. The monitor schedules a callback every
+`interval` seconds and records how late it runs. A watchdog thread notices when the loop has
+been held for longer than `threshold`, and takes a snapshot of the stack of the loop's thread
+so that the culprit can be named while it is still running."""
+
+import asyncio
+import bisect
+import sys
+import threading
+import time
+import traceback
+
+from auspex.log import logger
+
+# Upper edges of the lag histogram bins, in seconds
+LAG_BINS = [1e-4, 3e-4, 1e-3, 3e-3, 1e-2, 3e-2, 1e-1, 3e-1, 1.0, float('inf')]
+
+def describe_callback(callback):
+    """Name of a callback run by the loop, e.g. the coroutine of a task or the instrument
+    method a socket reader was registered with."""
+    owner = getattr(callback, '__self__', None)
+    if isinstance(owner, asyncio.Task):
+        coro = getattr(owner, '_coro', None)
+        return getattr(coro, '__qualname__', repr(owner))
+    if owner is not None:
+        return "{}.{}".format(owner, getattr(callback, '__name__', callback))
+    return getattr(callback, '__qualname__', repr(callback))
+
+def describe_stack(frame, depth=4):
+    """The innermost filter, instrument or experiment method on the stack, and the innermost few
+    frames. The walk stops at the loop callback being run, which is named instead if none of its
+    frames belong to such a method: the frames further out belong to whoever runs the loop."""
+    from auspex.experiment import Experiment
+    from auspex.filters.filter import Filter
+    from auspex.instruments.instrument import Instrument
+    node = None
+    f = frame
+    while f is not None:
+        owner = f.f_locals.get('self')
+        if isinstance(owner, (Filter, Instrument, Experiment)):
+            node = "{}.{}".format(owner, f.f_code.co_name)
+            break
+        if isinstance(owner, asyncio.Handle) and f.f_code.co_name == '_run':
+            node = describe_callback(owner._callback)
+            break
+        f = f.f_back
+    frames = ["{}:{} in {}".format(s.filename, s.lineno, s.name) for s in traceback.extract_stack(frame)[-depth:]]
+    return {"node": node, "frames": frames}
+
+class LoopLagMonitor(object):
+    """Measure the scheduling delay of the loop and capture what was running during stalls."""
+
+    def __init__(self, loop, interval=0.005, threshold=0.05):
+        self.loop      = loop
+        self.interval  = interval
+        self.threshold = threshold
+        self.running   = False
+        self.handle    = None
+        self.thread    = None
+        self.reset()
+
+    def reset(self):
+        self.counts    = [0]*len(LAG_BINS)
+        self.num_ticks = 0
+        self.total_lag = 0.0
+        self.max_lag   = 0.0
+        self.stalls    = []
+        self.snapshot  = None
+
+    def start(self):
+        """Start measuring. Must be called from the loop's own thread."""
+        self.reset()
+        self.running     = True
+        self.loop_thread = threading.get_ident()
+        self.heartbeat   = time.perf_counter()
+        self.expected    = self.loop.time() + self.interval
+        self.handle      = self.loop.call_at(self.expected, self.tick)
+        self.thread      = threading.Thread(target=self.watch, name="LoopLagMonitor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def tick(self):
+        now = self.loop.time()
+        lag = max(0.0, now - self.expected)
+        self.counts[bisect.bisect_left(LAG_BINS, lag)] += 1
+        self.num_ticks += 1
+        self.total_lag += lag
+        self.max_lag    = max(self.max_lag, lag)
+        if lag > self.threshold:
+            stall = {"lag": lag, "node": None, "frames": []}
+            if self.snapshot is not None:
+                stall.update(self.snapshot)
+            self.stalls.append(stall)
+        # Beat first, or the watchdog could take the stall just ended for a new one
+        self.heartbeat = time.perf_counter()
+        self.snapshot  = None
+        if self.running:
+            self.expected = now + self.interval
+            self.handle   = self.loop.call_at(self.expected, self.tick)
+
+    def watch(self):
+        # Runs in its own thread: snapshot the loop's stack once per stall
+        while self.running:
+            time.sleep(self.interval)
+            if self.snapshot is None and time.perf_counter() - self.heartbeat > self.interval + self.threshold:
+                frame = sys._current_frames().get(self.loop_thread)
+                if frame is not None:
+                    self.snapshot = describe_stack(frame)
+
+    def stats(self):
+        """Summary of the lags seen so far: the number of samples, mean, maximum and histogram
+        (counts per bin, with the upper bin edges in seconds), and the stalls over the threshold
+        with the node and innermost frames that were running at the time."""
+        return {"samples": self.num_ticks,
+                "mean_lag": self.total_lag/self.num_ticks if self.num_ticks else 0.0,
+                "max_lag": self.max_lag,
+                "histogram": (list(LAG_BINS), list(self.counts)),
+                "stalls": list(self.stalls)}
+
+    def report(self):
+        """Log the lag statistics, with a warning for every stall over the threshold."""
+        stats = self.stats()
+        logger.info("Event loop lag over %d samples: mean %.2f ms, max %.2f ms.",
+                    stats["samples"], 1e3*stats["mean_lag"], 1e3*stats["max_lag"])
+        for stall in stats["stalls"]:
+            logger.warning("Event loop was blocked for %.1f ms (threshold %.1f ms) by %s: %s",
+                           1e3*stall["lag"], 1e3*self.threshold, stall["node"] or "unknown code",
+                           " <- ".join(reversed(stall["frames"])) or "no stack captured")
+        return stats
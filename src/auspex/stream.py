@@ -9,35 +9,176 @@
 import asyncio
 import logging
 import numbers
-import itertools
-import zlib
-import pickle
 import time
 import datetime
+import collections
+import weakref
 
 import numpy as np
 from functools import reduce
 
 from auspex.log import logger
+from auspex.compression import get_codec
+
+# Bumped whenever an axis changes shape or a descriptor changes its axes. Descriptors
+# compare it against the value at which they cached their shape metadata.
+shape_generation = 0
+
+def invalidate_shapes():
+    """Invalidate the cached shape metadata of every DataStreamDescriptor."""
+    global shape_generation
+    shape_generation += 1
+
+# Whether data messages carry the time they were pushed, from which the consumer's queue wait
+# time is measured. Only needed for profiling, see Experiment.enable_profiling.
+timestamps = False
+
+def set_timestamps(enabled):
+    global timestamps
+    timestamps = enabled
+
+# Rings of every RingBuffer by id, so that views into them can be recognised (see in_ring)
+ring_allocations = weakref.WeakValueDictionary()
+
+def in_ring(data):
+    """Whether data is a view into the ring of a RingBuffer, which is only valid until the
+    consumer that received it gets its next message."""
+    base = data
+    while isinstance(base, np.ndarray) and base.base is not None:
+        base = base.base
+    return ring_allocations.get(id(base)) is base
+
+def fill_product(fields, columns):
+    """Fill the 1-D arrays in `fields` with the cartesian product of the 2-D blocks in `columns`
+    (one block per axis, one column per field), the first block varying slowest. This is a
+    mixed-radix construction: the values of block i repeat every prod(sizes[i+1:]) points and
+    cycle prod(sizes[:i]) times, so each field is written in place as an (outer, size, inner) broadcast."""
+    sizes  = [len(c) for c in columns]
+    fields = iter(fields)
+    for i, cols in enumerate(columns):
+        outer, inner = int(np.prod(sizes[:i])), int(np.prod(sizes[i+1:]))
+        for col in np.asarray(cols).T:
+            next(fields).reshape(outer, sizes[i], inner)[...] = col[None,:,None]
 
 def cartesian(arrays, out=None, dtype='f'):
-    """http://stackoverflow.com/questions/28684492/numpy-equivalent-of-itertools-product"""
+    """Cartesian product of 1-D arrays as an (N, len(arrays)) array, with the first array varying slowest."""
 
-    arrays = [np.asarray(x) for x in arrays]
-    # dtype = arrays[0].dtype
+    arrays = [np.asarray(x).ravel() for x in arrays]
 
-    n = np.prod([x.size for x in arrays])
+    n = int(np.prod([x.size for x in arrays]))
     if out is None:
-        out = np.zeros([n, len(arrays)], dtype=dtype)
-
-    m = int(n / arrays[0].size)
-    out[:,0] = np.repeat(arrays[0], m)
-    if arrays[1:]:
-        cartesian(arrays[1:], out=out[0:m,1:])
-        for j in range(1, arrays[0].size):
-            out[j*m:(j+1)*m,1:] = out[0:m,1:]
+        out = np.empty([n, len(arrays)], dtype=dtype)
+
+    fill_product([out[:,j] for j in range(len(arrays))], [x[:,None] for x in arrays])
     return out
 
+class TupleStore(object):
+    """Columnar store of the coordinate tuples visited by a sweep, with one growable array per
+    field. Appends are amortized O(1) per tuple, and slices only copy the requested range."""
+    def __init__(self, dtype, capacity=1024):
+        super(TupleStore, self).__init__()
+        self.dtype   = np.dtype(dtype)
+        self.size    = 0
+        self.columns = [np.empty(capacity, dtype=self.dtype[i]) for i in range(len(self.dtype))]
+
+    def reserve(self, num):
+        """Grow the columns as needed and return views of the next num rows of each column."""
+        capacity = len(self.columns[0]) if self.columns else 0
+        if self.size + num > capacity:
+            capacity = max(2*capacity, self.size + num)
+            for i, column in enumerate(self.columns):
+                self.columns[i] = np.empty(capacity, dtype=column.dtype)
+                self.columns[i][:self.size] = column[:self.size]
+        rows = [column[self.size:self.size+num] for column in self.columns]
+        self.size += num
+        return rows
+
+    def append(self, tuples):
+        """Append a structured array (by field name, ignoring extra fields), a 2-D array with
+        one column per field, or a list of tuples."""
+        if isinstance(tuples, np.ndarray) and tuples.dtype.names is not None:
+            values = [tuples[name].ravel() for name in self.dtype.names]
+        else:
+            values = np.asarray(tuples, dtype='f').reshape(-1, len(self.columns)).T
+        for row, value in zip(self.reserve(len(values[0])), values):
+            row[:] = value
+
+    def append_product(self, columns):
+        """Append the cartesian product of the 2-D blocks in columns (see fill_product)."""
+        fill_product(self.reserve(int(np.prod([len(c) for c in columns]))), columns)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.columns[self.dtype.names.index(key)][:self.size]
+        start, stop, step = key.indices(self.size)
+        out = np.empty(len(range(start, stop, step)), dtype=self.dtype)
+        for name, column in zip(self.dtype.names, self.columns):
+            out[name] = column[start:stop:step]
+        return out.view(np.recarray)
+
+    def __repr__(self):
+        return "<TupleStore(fields={}, size={})>".format(self.dtype.names, self.size)
+
+class RecordAssembler(object):
+    """Assembles whole records of record_length points from messages of arbitrary size. Points
+    left over after the last whole record of a message are copied into a preallocated carry
+    buffer, which is completed by the next message, so that nothing is concatenated. A second
+    buffer is swapped in when a completed carry record is handed out along with a new remainder.
+
+    assemble() returns the available records as a list of at most two (num_records, record_length)
+    arrays: the completed carry record, followed by a view of the whole records in the new data.
+    Both are only valid until the next call, since the carry buffer is reused and the data may
+    be a view into the ring buffer of a stream."""
+    def __init__(self, record_length, dtype=None):
+        super(RecordAssembler, self).__init__()
+        self.record_length = int(record_length)
+        self.dtype         = dtype
+        self.carry         = None
+        self.spare         = None
+        self.carry_size    = 0
+
+    def reset(self):
+        """Drop any partial record."""
+        self.carry_size = 0
+
+    def assemble(self, data):
+        data = np.asarray(data).ravel()
+        if self.carry is None or (self.carry_size == 0 and self.dtype is None and self.carry.dtype != data.dtype):
+            self.carry = np.empty(self.record_length, dtype=self.dtype or data.dtype)
+            self.spare = None
+
+        records = []
+        idx = 0
+        if self.carry_size > 0:
+            idx = min(self.record_length - self.carry_size, data.size)
+            self.carry[self.carry_size:self.carry_size+idx] = data[:idx]
+            self.carry_size += idx
+            if self.carry_size < self.record_length:
+                return records
+            records.append(self.carry.reshape(1, self.record_length))
+            self.carry_size = 0
+
+        num_records = (data.size - idx)//self.record_length
+        stop = idx + num_records*self.record_length
+        if num_records > 0:
+            records.append(data[idx:stop].reshape(num_records, self.record_length))
+
+        # Copy the remainder, though not into the carry record we are about to hand out
+        if stop < data.size:
+            if records and records[0].base is self.carry:
+                if self.spare is None:
+                    self.spare = np.empty_like(self.carry)
+                self.carry, self.spare = self.spare, self.carry
+            self.carry_size = data.size - stop
+            self.carry[:self.carry_size] = data[stop:]
+        return records
+
+    def __repr__(self):
+        return "<RecordAssembler(record_length={}, carry={})>".format(self.record_length, self.carry_size)
+
 class DataAxis(object):
     """An axis in a data stream"""
     def __init__(self, name, points=[], unit=None, metadata=None, dtype=np.float32):
@@ -74,6 +215,24 @@ class DataAxis(object):
         if self.unstructured and len(name) != len(points[0]):
             raise ValueError("DataAxis points length {} and names length {} must match.".format(len(points[0]), len(name)))
 
+    @property
+    def points(self):
+        return self._points
+
+    @points.setter
+    def points(self, points):
+        self._points = points
+        invalidate_shapes()
+
+    @property
+    def original_points(self):
+        return self._original_points
+
+    @original_points.setter
+    def original_points(self, points):
+        self._original_points = points
+        invalidate_shapes()
+
     def set_metadata(self, metadata):
         # Convert the metadata to an enum
         self.metadata_enum, self.metadata = np.unique(metadata, return_inverse=True)
@@ -100,6 +259,15 @@ class DataAxis(object):
             return [tuple(self.original_points[i]) for i in range(len(self.original_points))]
         return [(self.original_points[i],) for i in range(len(self.original_points))]
 
+    def point_columns(self):
+        """Return the original points, followed by the metadata if there is any, as a 2-D array
+        with one column per tuple field."""
+        points  = np.asarray(self.original_points)
+        columns = points.reshape(len(points), points.shape[1] if points.ndim > 1 else 1)
+        if self.metadata is not None:
+            columns = np.column_stack((columns, self.metadata))
+        return columns
+
     def tuple_width(self):
         if self.unstructured:
             width = len(name)
@@ -128,11 +296,13 @@ class DataAxis(object):
         self.num_new_points = len(points)
         self.points = np.append(self.points, points, axis=0)
         self.has_been_extended = True
+        invalidate_shapes()
 
     def reset(self):
         self.points = self.original_points
         self.has_been_extended = False
         self.num_new_points = 0
+        invalidate_shapes()
 
     def __repr__(self):
         return "<DataAxis(name={}, points={}, unit={})>".format(
@@ -237,9 +407,30 @@ class DataStreamDescriptor(object):
         self.dtype = dtype
         self.metadata = {}
 
+        # Shape metadata (num_points, dims, ...) cached until shape_generation changes
+        self.cache = {}
+        self.cache_generation = shape_generation
+
         # Keep track of the parameter permutations we have actually used...
         self.visited_tuples = []
 
+    @property
+    def axes(self):
+        # Modifying this list in place bypasses the shape cache, use add_axis/pop_axis
+        return self._axes
+
+    @axes.setter
+    def axes(self, axes):
+        self._axes = axes
+        invalidate_shapes()
+
+    def shape_cache(self):
+        """Returns the dictionary of cached shape metadata, emptied if any axis has changed since."""
+        if self.cache_generation != shape_generation:
+            self.cache = {}
+            self.cache_generation = shape_generation
+        return self.cache
+
     def is_adaptive(self):
         return True in [a.refine_func is not None for a in self.axes]
 
@@ -248,6 +439,7 @@ class DataStreamDescriptor(object):
         if isinstance(axis, DataAxis):
             logger.debug("Adding DataAxis into DataStreamDescriptor: {}".format(axis))
             self.axes.insert(0, axis)
+            invalidate_shapes()
         else:
             raise TypeError("Failed adding axis. Object is not DataAxis: {}".format(axis))
 
@@ -260,24 +452,19 @@ class DataStreamDescriptor(object):
 
     def data_dims(self):
         # Return dimension (length) of the data axes, exclude sweep axes (return 1 for each)
-        dims = []
-
-        for a in self.axes:
-            if isinstance(a, SweepAxis):
-                dims.append(1)
-            else:
-                dims.append(len(a.points))
-        return dims
+        cache = self.shape_cache()
+        if 'data_dims' not in cache:
+            cache['data_dims'] = [1 if isinstance(a, SweepAxis) else len(a.points) for a in self.axes]
+        return list(cache['data_dims'])
 
     def tuple_width(self):
         return sum([a.tuple_width() for a in self.axes])
 
     def dims(self):
-        dims = []
-
-        for a in self.axes:
-                dims.append(len(a.points))
-        return [a.num_points() for a in self.axes]
+        cache = self.shape_cache()
+        if 'dims' not in cache:
+            cache['dims'] = [a.num_points() for a in self.axes]
+        return list(cache['dims'])
 
     def axes_done(self):
         # The axis is considered done when all of the sub-axes are done
@@ -289,16 +476,22 @@ class DataStreamDescriptor(object):
         return np.all([a.done for a in self.axes])
 
     def num_points(self):
-        if len(self.axes)>0:
-            return reduce(lambda x,y: x*y, [a.num_points() for a in self.axes])
-        else:
-            return 0
+        cache = self.shape_cache()
+        if 'num_points' not in cache:
+            if len(self.axes)>0:
+                cache['num_points'] = reduce(lambda x,y: x*y, [a.num_points() for a in self.axes])
+            else:
+                cache['num_points'] = 0
+        return cache['num_points']
 
     def expected_num_points(self):
-        if len(self.axes)>0:
-            return reduce(lambda x,y: x*y, [len(a.original_points) for a in self.axes])
-        else:
-            return 0
+        cache = self.shape_cache()
+        if 'expected_num_points' not in cache:
+            if len(self.axes)>0:
+                cache['expected_num_points'] = reduce(lambda x,y: x*y, [len(a.original_points) for a in self.axes])
+            else:
+                cache['expected_num_points'] = 0
+        return cache['expected_num_points']
 
     def last_data_axis(self):
         # Return the outer most data axis but not sweep axis
@@ -316,49 +509,123 @@ class DataStreamDescriptor(object):
                 dtype.extend(a.data_type(with_metadata=with_metadata))
         return dtype
 
-    def tuples(self, as_structured_array=True):
-        """Returns a list of all tuples visited by the sweeper. Should only
-        be used with adaptive sweeps."""
+    def add_visited_tuples(self, tuples):
+        """Record tuples visited by the sweeper (see TupleStore.append)."""
+        self.visited_tuple_store().append(tuples)
+
+    def add_visited_product(self, columns):
+        """Record the cartesian product of the given blocks of axis values as visited."""
+        self.visited_tuple_store().append_product(columns)
+
+    def visited_tuple_store(self):
+        if not isinstance(self.visited_tuples, TupleStore):
+            store = TupleStore(self.axis_data_type(with_metadata=True))
+            if len(self.visited_tuples) > 0:
+                store.append(self.tuples())
+            self.visited_tuples = store
+        return self.visited_tuples
+
+    def tuples(self, as_structured_array=True, start=None, stop=None):
+        """Returns the tuples visited by the sweeper, optionally only those in range(start, stop).
+        Should only be used with adaptive sweeps."""
         if len(self.visited_tuples) == 0:
             self.visited_tuples = self.expected_tuples(with_metadata=True)
 
+        if isinstance(self.visited_tuples, TupleStore):
+            tuples = self.visited_tuples[start:stop]
+            if as_structured_array:
+                return tuples
+            return np.column_stack([tuples[name] for name in tuples.dtype.names])
+
+        tuples = self.visited_tuples[start:stop]
         if as_structured_array:
             # If we already have a structured array
-            if type(self.visited_tuples) is np.ndarray and type(self.visited_tuples.dtype.names) is tuple:
-                return self.visited_tuples
-            elif type(self.visited_tuples) is np.ndarray:
-                return np.rec.fromarrays(self.visited_tuples.T, dtype=self.axis_data_type(with_metadata=True))
-            return np.core.records.fromrecords(self.visited_tuples, dtype=self.axis_data_type(with_metadata=True))
-        return self.visited_tuples
+            if type(tuples) is np.ndarray and type(tuples.dtype.names) is tuple:
+                return tuples
+            elif type(tuples) is np.ndarray:
+                return np.rec.fromarrays(tuples.T, dtype=self.axis_data_type(with_metadata=True))
+            return np.core.records.fromrecords(tuples, dtype=self.axis_data_type(with_metadata=True))
+        return tuples
 
     def expected_tuples(self, with_metadata=False, as_structured_array=True):
-        """Returns a list of tuples representing the cartesian product of the axis values. Should only
-        be used with non-adaptive sweeps."""
-        vals           = [a.points_with_metadata() for a in self.axes]
-
-        #
-        # TODO: avoid this slow list comprehension
-        simple = True
-        if True in [a.unstructured for a in self.axes]:
-            simple = False
-        if True in [a.metadata is not None for a in self.axes]:
-            simple = False
-        if self.axes == []:
-            simple = False
-
-        if simple:
-            # flattened_list = [tuple((val for sublist in line for val in sublist)) for line in nested_list]
-            flattened_list = cartesian(vals)
-        else:
-            nested_list    = itertools.product(*vals)
-            flattened_list = [tuple((val for sublist in line for val in sublist)) for line in nested_list]
-            # flattened_list = np.array(list(nested_list)).reshape(-1, self.tuple_width())
+        """Returns the cartesian product of the axis values (and metadata), either as a structured array
+        or as a 2-D array with one column per field. Should only be used with non-adaptive sweeps."""
+        columns = [a.point_columns() for a in self.axes]
+        dtype   = np.dtype(self.axis_data_type(with_metadata=True))
+        n       = int(np.prod([len(c) for c in columns])) if len(columns) > 0 else 0
 
         if as_structured_array:
-            if simple:
-                return np.rec.fromarrays(flattened_list.T, dtype=self.axis_data_type(with_metadata=True))
-            return np.rec.fromrecords(flattened_list, dtype=self.axis_data_type(with_metadata=True))
-        return flattened_list
+            out = np.empty(n, dtype=dtype)
+            fill_product([out[name] for name in dtype.names], columns)
+            return out.view(np.recarray)
+
+        out = np.empty((n, len(dtype.names)), dtype='f')
+        fill_product([out[:,i] for i in range(len(dtype.names))], columns)
+        return out
+
+    def coordinates(self, start=0, stop=None):
+        """Returns the tuples (with metadata) for the flat point indices in range(start, stop) as a
+        structured array. For non-adaptive sweeps these are computed on demand by a mixed-radix
+        decomposition of the indices, without building the full cartesian product."""
+        if self.is_adaptive():
+            return self.tuples(start=start, stop=stop)
+
+        start, stop, _ = slice(start, stop).indices(self.expected_num_points())
+        dtype   = np.dtype(self.axis_data_type(with_metadata=True))
+        out     = np.empty(max(stop - start, 0), dtype=dtype)
+        indices = np.arange(start, max(start, stop))
+
+        # Peel off the digits starting from the innermost (fastest varying) axis
+        fields = list(dtype.names)
+        for a in self.axes[::-1]:
+            columns = a.point_columns()
+            digits  = indices % len(columns)
+            indices = indices // len(columns)
+            names   = fields[len(fields)-columns.shape[1]:]
+            fields  = fields[:len(fields)-columns.shape[1]]
+            for name, column in zip(names, columns.T):
+                out[name] = column[digits]
+        return out.view(np.recarray)
+
+    def index_of(self, **coords):
+        """Returns the flat point index at which the named axes (or unstructured axis parameters)
+        take the given values, e.g. desc.index_of(field=0.1, freq=2.0)."""
+        names = self.axis_names()
+        if set(coords.keys()) != set(names):
+            raise ValueError("Coordinates {} do not match the axes {}.".format(list(coords.keys()), names))
+
+        if self.is_adaptive():
+            tuples = self.tuples()
+            match  = np.ones(len(tuples), dtype=bool)
+            for name, value in coords.items():
+                match &= np.isclose(tuples[name], value)
+            if not np.any(match):
+                raise ValueError("Coordinates {} were not visited.".format(coords))
+            return int(np.argmax(match))
+
+        index  = 0
+        fields = iter(names)
+        for a in self.axes:
+            points = np.asarray(a.original_points)
+            points = points.reshape(len(points), -1)
+            match  = np.ones(len(points), dtype=bool)
+            for column in points.T:
+                match &= np.isclose(column, coords[next(fields)])
+            if not np.any(match):
+                raise ValueError("Coordinates {} are not on axis {}.".format(coords, a.name))
+            index = index*len(points) + int(np.argmax(match))
+        return index
+
+    def same_axes(self, other):
+        """Whether another descriptor has the same axes, points, and metadata as this one."""
+        if len(self.axes) != len(other.axes):
+            return False
+        for a, b in zip(self.axes, other.axes):
+            if a.name != b.name or a.num_points() != b.num_points():
+                return False
+            if not np.array_equal(a.point_columns(), b.point_columns()):
+                return False
+        return True
 
     def axis_names(self, with_metadata=False):
         """Returns all axis names included those from unstructured axes"""
@@ -392,6 +659,7 @@ class DataStreamDescriptor(object):
         newone = type(self)()
         newone.__dict__.update(self.__dict__)
         newone.axes = self.axes[:]
+        newone.cache = {}
         return newone
 
     def copy(self):
@@ -401,15 +669,24 @@ class DataStreamDescriptor(object):
         return self.axes[self.axis_num(axis_name)]
 
     def axis_num(self, axis_name):
-        names = [a.name for a in self.axes]
-        return names.index(axis_name)
+        cache = self.shape_cache()
+        if 'axis_nums' not in cache:
+            cache['axis_nums'] = {}
+            for i, a in enumerate(self.axes):
+                cache['axis_nums'].setdefault(str(a.name), i)
+        try:
+            return cache['axis_nums'][str(axis_name)]
+        except KeyError:
+            raise ValueError("{} is not in list".format(axis_name))
 
     def pop_axis(self, axis_name):
         # Pop the time axis (which should be here)
         names = [a.name for a in self.axes]
         if axis_name not in names:
             raise Exception("Couldn't pop axis {} from descriptor, it probably doesn't exist.".format(axis_name))
-        return self.axes.pop(names.index(axis_name))
+        axis = self.axes.pop(names.index(axis_name))
+        invalidate_shapes()
+        return axis
 
     def num_points_through_axis(self, axis_name):
         if type(axis_name) is int:
@@ -420,12 +697,16 @@ class DataStreamDescriptor(object):
         # if False in [a.refine_func is None for a in self.axes[axis_num:]]:
         #     raise Exception("Cannot call num_points_through_axis with interior adaptive sweeps.")
 
-        if axis_num >= len(self.axes):
-            return 0
-        elif len(self.axes) == 1:
-            return self.axes[0].num_points()
-        else:
-            return reduce(lambda x,y: x*y, [a.num_points() for a in self.axes[axis_num:]])
+        cache = self.shape_cache()
+        key   = ('num_points_through_axis', axis_num)
+        if key not in cache:
+            if axis_num >= len(self.axes):
+                cache[key] = 0
+            elif len(self.axes) == 1:
+                cache[key] = self.axes[0].num_points()
+            else:
+                cache[key] = reduce(lambda x,y: x*y, [a.num_points() for a in self.axes[axis_num:]])
+        return cache[key]
 
     def num_new_points_through_axis(self, axis_name):
         if type(axis_name) is int:
@@ -444,11 +725,347 @@ class DataStreamDescriptor(object):
         return "<DataStreamDescriptor(num_dims={}, num_points={})>".format(
             self.num_dims(), self.num_points())
 
+def message_nbytes(message):
+    """Number of bytes of data carried by a stream message."""
+    if 'parts' in message:
+        return message['nbytes']
+    data = message.get('data')
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    return getattr(data, 'nbytes', 0)
+
+class BoundedQueue(asyncio.Queue):
+    """asyncio.Queue whose depth can be limited to max_depth messages or bytes of data
+    (0 for no limit). What a push does when the queue is full depends on the policy:
+
+        "block":       the producer waits for the consumer to catch up (backpressure)
+        "drop_oldest": the oldest queued data messages are discarded to make room
+        "coalesce":    the new data is merged into the newest queued data message, which
+                       bounds the number of messages without losing any data, so it
+                       cannot be combined with a limit in bytes
+
+    Events are never dropped or merged. High-water marks of the depth are recorded."""
+
+    policies = ("block", "drop_oldest", "coalesce")
+    units    = ("messages", "bytes")
+
+    def __init__(self, max_depth=0, unit="messages", policy="block", loop=None):
+        self.set_limits(max_depth, unit, policy)
+        self.nbytes              = 0
+        self.high_water_messages = 0
+        self.high_water_bytes    = 0
+        self.dropped_messages    = 0
+        self.dropped_points      = 0
+        super(BoundedQueue, self).__init__(loop=loop)
+
+    def set_limits(self, max_depth=0, unit="messages", policy="block"):
+        if unit not in self.units:
+            raise ValueError("Queue depth unit must be one of {}, not '{}'".format(self.units, unit))
+        if policy not in self.policies:
+            raise ValueError("Queue policy must be one of {}, not '{}'".format(self.policies, policy))
+        if policy == "coalesce" and unit == "bytes":
+            raise ValueError("Coalescing keeps every byte queued, so it can only limit the depth in messages")
+        self.max_depth = max_depth
+        self.unit      = unit
+        self.policy    = policy
+
+    def depth(self):
+        return self.nbytes if self.unit == "bytes" else self.qsize()
+
+    def over_limit(self):
+        return self.max_depth > 0 and self.depth() > self.max_depth
+
+    def full(self):
+        # Only a blocking queue ever refuses a message. We accept one message once the queue is
+        # below its limit, so a single message larger than the limit can still get through.
+        if self.policy != "block" or self.max_depth <= 0 or self.empty():
+            return False
+        return self.depth() >= self.max_depth
+
+    def _put(self, item):
+        self._queue.append(item)
+        self.nbytes += message_nbytes(item)
+        if self.policy != "block" and item['type'] == 'data' and self.over_limit():
+            if self.policy == "drop_oldest":
+                self._drop_oldest()
+            else:
+                self._coalesce()
+        self.high_water_messages = max(self.high_water_messages, self.qsize())
+        self.high_water_bytes    = max(self.high_water_bytes, self.nbytes)
+
+    def _get(self):
+        item = self._queue.popleft()
+        self.nbytes -= message_nbytes(item)
+        if 'parts' in item:
+            item = {"type": "data", "compression": "none", "data": np.concatenate(item['parts']), "time": item.get('time')}
+        return item
+
+    def _drop_oldest(self):
+        # Never drop the message that was just added
+        while self.over_limit():
+            for i in range(len(self._queue) - 1):
+                if self._queue[i]['type'] == 'data':
+                    dropped = self._queue[i]
+                    del self._queue[i]
+                    self.nbytes           -= message_nbytes(dropped)
+                    self.dropped_messages += 1
+                    if 'parts' in dropped:
+                        self.dropped_points += sum(p.size for p in dropped['parts'])
+                    elif hasattr(dropped['data'], 'size'):
+                        self.dropped_points += dropped['data'].size
+                    break
+            else:
+                break
+
+    def _coalesce(self):
+        # Merge the newest message into the one before it if both are uncompressed data.
+        # The parts are only concatenated once the merged message is taken off the queue.
+        if len(self._queue) < 2:
+            return
+        last, previous = self._queue[-1], self._queue[-2]
+        if last['compression'] != 'none' or previous['type'] != 'data' or previous['compression'] != 'none':
+            return
+        self._queue.pop()
+        if 'parts' not in previous:
+            previous = {"type": "data", "compression": "none", "parts": [np.ravel(previous['data'])],
+                        "data": None, "nbytes": message_nbytes(previous), "time": previous.get('time')}
+            self._queue[-1] = previous
+        previous['parts'].append(np.ravel(last['data']))
+        previous['nbytes'] += message_nbytes(last)
+
+class RingBuffer(object):
+    """Preallocated ring of data slots that stands in for the asyncio.Queue of a DataStream.
+    Data pushed through the stream is copied straight into the ring, and the consumer
+    receives zero-copy views of the ring rather than the original arrays. Events, direct
+    data and compressed data are passed through untouched, in order with the data.
+
+    The ring is sized from the stream descriptor: `slots` times the number of points in the
+    innermost data axes (i.e. a record). It grows if a single push is larger than the whole
+    ring. A producer that finds the ring full waits until the consumer releases slots.
+
+    Views handed out by get() remain valid until the consumer awaits get() again, at which
+    point their slots are returned to the producer. Consumers that hold on to data across
+    calls to get() must copy it. Adjacent chunks are coalesced into a single message when
+    `coalesce` is true. By default this only happens if the consumer has a single input
+    stream, since multi-stream consumers (e.g. writers) expect messages in lockstep."""
+
+    def __init__(self, stream=None, slots=8, capacity=None, max_bytes=None, coalesce=None, loop=None):
+        super(RingBuffer, self).__init__()
+        self.stream    = stream
+        self.slots     = slots
+        self.capacity  = capacity
+        self.max_bytes = max_bytes
+        self.coalesce  = coalesce
+        self.buffer    = None
+
+        # Unread entries, either (start, stop) tuples pointing into the ring or message dicts
+        self.pending = collections.deque()
+        # The (start, stop) of every chunk that has not been released, in the order written.
+        # The first num_leased of these have been handed to the consumer.
+        self.live       = collections.deque()
+        self.num_leased = 0
+        # When each chunk in pending was written, for the queue wait time of the consumer
+        self.put_times  = collections.deque()
+        self.points_used         = 0
+        self.high_water_points   = 0
+        self.high_water_messages = 0
+
+        self.data_available  = asyncio.Event(loop=loop)
+        self.space_available = asyncio.Event(loop=loop)
+
+    def record_points(self):
+        """Number of points through the outermost data axis of the stream descriptor."""
+        desc = self.stream.descriptor if self.stream is not None else None
+        if desc is None or len(desc.axes) == 0:
+            return 1
+        data_axes = [i for i, a in enumerate(desc.axes) if not isinstance(a, SweepAxis)]
+        if len(data_axes) == 0:
+            return 1
+        return max(1, desc.num_points_through_axis(data_axes[0]))
+
+    def allocate(self, min_points, dtype):
+        """(Re)allocate the ring so that it holds at least min_points of the given dtype. Any
+        unread data is moved to the start of the new ring. Views held by the consumer keep
+        the old ring alive until they are released."""
+        capacity = self.capacity or self.slots*self.record_points()
+        if self.max_bytes:
+            capacity = max(1, self.max_bytes // np.dtype(dtype).itemsize)
+        if self.buffer is not None:
+            capacity = max(capacity, self.buffer.size)
+            if min_points > self.buffer.size:
+                capacity = max(capacity, 2*self.buffer.size)
+        capacity = max(capacity, min_points, 1)
+
+        old_buffer  = self.buffer
+        self.buffer = np.empty(capacity, dtype=dtype)
+        ring_allocations[id(self.buffer)] = self.buffer
+        logger.debug("Allocated ring buffer of %d points (%s) for stream '%s'", capacity, self.buffer.dtype,
+                        self.stream.name if self.stream is not None else None)
+
+        pending = collections.deque()
+        pos     = 0
+        for entry in self.pending:
+            if isinstance(entry, tuple):
+                start, stop = entry
+                self.buffer[pos:pos+stop-start] = old_buffer[start:stop]
+                entry = (pos, pos+stop-start)
+                pos   = entry[1]
+            pending.append(entry)
+        self.pending     = pending
+        self.live        = collections.deque(e for e in pending if isinstance(e, tuple))
+        self.num_leased  = 0
+        self.points_used = pos
+        self.space_available.set()
+
+    def reserve(self, size):
+        """Return the start of a contiguous free region of the given size, or None."""
+        if len(self.live) == 0:
+            return 0 if size <= self.buffer.size else None
+        first_start     = self.live[0][0]
+        last_start, end = self.live[-1]
+        if last_start >= first_start:
+            # Not wrapped: try the tail of the ring, then wrap around to the head
+            if size <= self.buffer.size - end:
+                return end
+            if size <= first_start:
+                return 0
+            return None
+        if size <= first_start - end:
+            return end
+        return None
+
+    def write_nowait(self, data):
+        """Copy data into the ring. Returns False if there is currently no room."""
+        if self.buffer is None or data.size > self.buffer.size or not np.can_cast(data.dtype, self.buffer.dtype):
+            dtype = data.dtype if self.buffer is None else np.result_type(self.buffer.dtype, data.dtype)
+            if self.buffer is None and self.stream is not None and self.stream.descriptor is not None:
+                dtype = np.result_type(self.stream.descriptor.dtype, data.dtype)
+            self.allocate(data.size, dtype)
+
+        start = self.reserve(data.size)
+        if start is None:
+            return False
+
+        stop = start + data.size
+        self.buffer[start:stop] = data
+        self.live.append((start, stop))
+        self.pending.append((start, stop))
+        self.put_times.append(time.perf_counter() if timestamps else None)
+        self.points_used += data.size
+        self.high_water_points   = max(self.high_water_points, self.points_used)
+        self.high_water_messages = max(self.high_water_messages, len(self.pending))
+        self.data_available.set()
+        return True
+
+    async def write(self, data):
+        data = np.asarray(data).ravel()
+        if data.size == 0:
+            self.put_nowait({"type": "data", "compression": "none", "data": data})
+            return
+        while not self.write_nowait(data):
+            self.space_available.clear()
+            await self.space_available.wait()
+
+    def release(self):
+        """Return the slots held by the consumer to the producer."""
+        if self.num_leased > 0:
+            for _ in range(self.num_leased):
+                start, stop = self.live.popleft()
+                self.points_used -= stop - start
+            self.num_leased = 0
+            self.space_available.set()
+
+    async def put(self, message):
+        if message['type'] == 'data' and message['compression'] == 'none':
+            await self.write(message['data'])
+        else:
+            self.put_nowait(message)
+
+    def put_nowait(self, message):
+        if message['type'] == 'data' and message['compression'] == 'none':
+            data = np.asarray(message['data']).ravel()
+            if data.size > 0:
+                if not self.write_nowait(data):
+                    raise asyncio.QueueFull
+                return
+        self.pending.append(message)
+        self.high_water_messages = max(self.high_water_messages, len(self.pending))
+        self.data_available.set()
+
+    async def get(self):
+        self.release()
+        while len(self.pending) == 0:
+            self.data_available.clear()
+            await self.data_available.wait()
+        return self.get_nowait()
+
+    def get_nowait(self):
+        if len(self.pending) == 0:
+            raise asyncio.QueueEmpty
+        entry = self.pending.popleft()
+        if not isinstance(entry, tuple):
+            return entry
+
+        start, stop      = entry
+        self.num_leased += 1
+        put_time = self.put_times.popleft()
+        coalesce = self.coalesce
+        if coalesce is None:
+            end = self.stream.end_connector if self.stream is not None else None
+            coalesce = end is not None and end.num_input_streams == 1
+        if coalesce:
+            while len(self.pending) > 0 and isinstance(self.pending[0], tuple) and self.pending[0][0] == stop:
+                stop = self.pending.popleft()[1]
+                self.num_leased += 1
+                self.put_times.popleft()
+        return {"type": "data", "compression": "none", "data": self.buffer[start:stop], "time": put_time}
+
+    def qsize(self):
+        return len(self.pending)
+
+    def empty(self):
+        return len(self.pending) == 0
+
+    def __repr__(self):
+        size = 0 if self.buffer is None else self.buffer.size
+        return "<RingBuffer(capacity={}, used={}, pending={})>".format(size, self.points_used, len(self.pending))
+
+class DirectQueue(object):
+    """Stand-in for the queue of a stream inside a fused chain of filters (see
+    Experiment.fuse_chains). Nothing is queued: each message is handed straight to the
+    consumer's handle_message, so the producer runs the consumer to completion inline."""
+
+    def __init__(self, stream, consumer):
+        self.stream   = stream
+        self.consumer = consumer
+        self.high_water_messages = 0
+        self.high_water_bytes    = 0
+
+    async def put(self, message):
+        await self.consumer.handle_message(self.stream, message)
+
+    async def get(self):
+        raise RuntimeError("Stream '{}' is fused into {} and cannot be read from.".format(self.stream.name, self.consumer))
+
+    def get_nowait(self):
+        raise asyncio.QueueEmpty()
+
+    def set_limits(self, max_depth=0, unit="messages", policy="block"):
+        pass
+
+    def qsize(self):
+        return 0
+
+    def empty(self):
+        return True
+
+    def __repr__(self):
+        return "<DirectQueue(consumer={})>".format(self.consumer)
+
 class DataStream(object):
     """A stream of data"""
-    def __init__(self, name=None, unit=None, loop=None, compression="none"):
+    def __init__(self, name=None, unit=None, loop=None, compression="none", transport="queue"):
         super(DataStream, self).__init__()
-        self.queue = asyncio.Queue(loop=loop)
         self.loop = loop
         self.name = name
         self.unit = unit
@@ -457,6 +1074,91 @@ class DataStream(object):
         self.start_connector = None
         self.end_connector = None
         self.compression = compression
+        self.reset_compression_stats()
+        self.reset_perf_counters()
+        self.limits = {"max_depth": 0, "unit": "messages", "policy": "block"}
+        self.set_transport(transport)
+
+    def set_transport(self, transport="queue", **kwargs):
+        """Select how messages are carried between the ends of the stream: "queue" for a
+        BoundedQueue, "ring" for a preallocated RingBuffer (extra kwargs are passed along),
+        "direct" to call the consuming filter in place (a DirectQueue), or "shared" for one end
+        of a stream between processes, given as the endpoint kwarg (see auspex.subgraph)."""
+        if transport == "queue":
+            self.queue = BoundedQueue(loop=self.loop, **self.limits)
+        elif transport == "ring":
+            self.queue = RingBuffer(self, loop=self.loop, **kwargs)
+        elif transport == "direct":
+            self.queue = DirectQueue(self, self.end_connector.parent)
+        elif transport == "shared":
+            self.queue = kwargs["endpoint"]
+        else:
+            raise ValueError("Unknown stream transport '{}'".format(transport))
+        self.transport = transport
+        if transport == "ring" and self.limits["max_depth"] > 0:
+            self.set_limits(**self.limits)
+
+    def set_limits(self, max_depth=0, unit="messages", policy="block"):
+        """Bound the depth of the stream to max_depth messages or bytes (0 for unbounded),
+        applying the given policy when a push finds it full (see BoundedQueue). A ring buffer
+        stream always blocks, and its size is taken from the limit instead."""
+        self.limits = {"max_depth": max_depth, "unit": unit, "policy": policy}
+        if self.transport == "ring":
+            if policy != "block":
+                raise ValueError("Ring buffer streams only support the 'block' policy.")
+            if unit == "bytes":
+                self.queue.max_bytes = max_depth or None
+            else:
+                self.queue.slots = max_depth or 8
+        else:
+            self.queue.set_limits(max_depth, unit, policy)
+
+    def high_water_marks(self):
+        """Largest number of messages and bytes of data that have been waiting in the stream."""
+        if self.transport == "ring":
+            itemsize = 0 if self.queue.buffer is None else self.queue.buffer.itemsize
+            return {"messages": self.queue.high_water_messages, "bytes": self.queue.high_water_points*itemsize}
+        return {"messages": self.queue.high_water_messages, "bytes": self.queue.high_water_bytes}
+
+    def reset_compression_stats(self):
+        self.raw_bytes        = 0
+        self.compressed_bytes = 0
+        self.compress_time    = 0.0
+        self.decompress_time  = 0.0
+
+    def reset_perf_counters(self):
+        self.messages_received = 0
+        self.points_received   = 0
+        self.queue_wait        = 0.0
+        self.bytes_pushed      = 0
+
+    def perf_counters(self):
+        """Messages and points taken off the stream by its consumer, the total time data messages
+        spent waiting in the stream, and the bytes of data pushed into it."""
+        return {"messages": self.messages_received, "points": self.points_received,
+                "queue_wait": self.queue_wait, "bytes": self.bytes_pushed}
+
+    def compression_stats(self):
+        """Bytes in and out of the codec for this stream, their ratio, and the CPU time
+        spent compressing and decompressing."""
+        ratio = self.raw_bytes/self.compressed_bytes if self.compressed_bytes else 1.0
+        return {"codec": self.compression, "raw_bytes": self.raw_bytes, "compressed_bytes": self.compressed_bytes,
+                "ratio": ratio, "compress_time": self.compress_time, "decompress_time": self.decompress_time}
+
+    def unpack(self, message):
+        """Return the data carried by a message, decoding it if it was compressed. Every consumer
+        unpacks each message it receives, so this is also where they are counted."""
+        self.messages_received += 1
+        data = message['data']
+        if timestamps and message.get('time') is not None:
+            self.queue_wait += time.perf_counter() - message['time']
+        if message['compression'] != 'none':
+            start = time.process_time()
+            data  = get_codec(message['compression']).decode(data)
+            self.decompress_time += time.process_time() - start
+        if message['type'] != 'event':
+            self.points_received += getattr(data, 'size', 1)
+        return data
 
     def set_descriptor(self, descriptor):
         if isinstance(descriptor,DataStreamDescriptor):
@@ -481,6 +1183,7 @@ class DataStream(object):
     def reset(self):
         self.descriptor.reset()
         self.points_taken = 0
+        self.reset_perf_counters()
         while not self.queue.empty():
             self.queue.get_nowait()
         if self.start_connector is not None:
@@ -493,6 +1196,7 @@ class DataStream(object):
     async def push(self, data):
         if hasattr(data, 'size'):
             self.points_taken += data.size
+            self.bytes_pushed += data.nbytes
         else:
             try:
                 self.points_taken += len(data)
@@ -502,13 +1206,27 @@ class DataStream(object):
                     self.points_taken += 1
                 except:
                     raise ValueError("Got data {} that is neither an array nor a float".format(data))
-        if self.compression == 'zlib':
-            message = {"type": "data", "compression": "zlib", "data": zlib.compress(pickle.dumps(data, -1))}
+            self.bytes_pushed += 8
+        if self.compression != 'none':
+            start = time.process_time()
+            frame = get_codec(self.compression).encode(data)
+            self.compress_time    += time.process_time() - start
+            self.raw_bytes        += np.asarray(data).nbytes
+            self.compressed_bytes += len(frame)
+            message = {"type": "data", "compression": self.compression, "data": frame,
+                       "time": time.perf_counter() if timestamps else None}
+        elif self.transport == 'ring':
+            await self.queue.write(data)
+            return
         else:
-            message = {"type": "data", "compression": "none", "data": data}
-
-        # This can be replaced with some other serialization method
-        # and also should support sending via zmq.
+            # Filters may forward the views they got from a ring, whose slots are reused as soon
+            # as they get their next message. Shared memory streams copy the data anyway.
+            if self.transport != 'shared' and in_ring(data):
+                data = data.copy()
+            message = {"type": "data", "compression": "none", "data": data,
+                       "time": time.perf_counter() if timestamps else None}
+
+        # Compressed frames are plain bytes, so they could also be sent via zmq.
         await self.queue.put(message)
 
     async def push_event(self, event_type, data=None):
@@ -0,0 +1,464 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+"""Filter subgraphs that run in a worker process, see Experiment.run_in_process.
+
+The streams that cross into or out of a subgraph are carried by a pair of endpoints: a
+SharedStreamWriter at the producing end and a SharedStreamReader at the consuming end. Data is
+copied once into a ring in shared memory (an anonymous mmap, inherited by the forked worker),
+and a small header naming the slot is sent over a pipe. Events, direct data and compressed
+data travel over the same pipe, so everything arrives in the order it was pushed. The consumer
+copies the data out of the ring, since filters such as Passthrough hand their input on to
+other streams, and releases the slots to the producer the next time it calls get()."""
+
+import asyncio
+import collections
+import mmap
+import multiprocessing
+import signal
+
+import numpy as np
+
+from auspex.filters.filter import Filter, ProfiledRun, executors, perf_clock
+from auspex.filters.io import WriteToHDF5
+from auspex.stream import set_timestamps
+from auspex.log import logger
+
+# Slots in the ring start on cache line boundaries
+ALIGNMENT = 64
+
+class SharedStreamWriter(object):
+    """Producing end of a stream between processes, standing in for the queue of the DataStream.
+    A push waits while the ring is full, or while max_messages are unread, which also keeps the
+    headers from filling the pipe."""
+
+    def __init__(self, conn, buffer, loop=None, max_messages=256):
+        self.conn         = conn
+        self.buffer       = buffer
+        self.loop         = loop
+        self.max_messages = max_messages
+        self.run_id       = 0
+        self.listening    = False
+        self.closed       = False
+        self.space_available = asyncio.Event(loop=loop)
+        self.reset()
+
+    def reset(self):
+        # Whether each unreleased message occupies the ring, and the (start, stop) of those that do
+        self.live       = collections.deque()
+        self.ranges     = collections.deque()
+        self.bytes_used = 0
+        self.high_water_messages = 0
+        self.high_water_bytes    = 0
+
+    def start_run(self, run_id):
+        """Forget the messages of the previous run. Releases for them may still be in flight, so
+        they are told apart by the run id."""
+        self.run_id = run_id
+        self.reset()
+        self.space_available.set()
+        if not self.listening:
+            self.loop.add_reader(self.conn.fileno(), self.receive)
+            self.listening = True
+
+    def close(self):
+        if self.listening:
+            self.loop.remove_reader(self.conn.fileno())
+            self.listening = False
+        self.conn.close()
+
+    def receive(self):
+        """Take the releases sent back by the consumer."""
+        try:
+            while self.conn.poll():
+                _, run_id, count = self.conn.recv()
+                if run_id != self.run_id:
+                    continue
+                for _ in range(count):
+                    if self.live.popleft():
+                        start, stop = self.ranges.popleft()
+                        self.bytes_used -= stop - start
+        except (EOFError, OSError):
+            self.closed = True
+            self.loop.remove_reader(self.conn.fileno())
+            self.listening = False
+        self.space_available.set()
+
+    def reserve(self, size):
+        """Return the start of a contiguous free region of the given size, or None."""
+        if len(self.live) >= self.max_messages:
+            return None
+        if len(self.ranges) == 0:
+            return 0
+        first_start     = self.ranges[0][0]
+        last_start, end = self.ranges[-1]
+        if last_start >= first_start:
+            # Not wrapped: try the tail of the ring, then wrap around to the head
+            if size <= self.buffer.size - end:
+                return end
+            if size <= first_start:
+                return 0
+            return None
+        if size <= first_start - end:
+            return end
+        return None
+
+    async def wait_for(self, size):
+        while True:
+            if self.closed:
+                raise BrokenPipeError("The other end of the shared stream has gone away.")
+            start = self.reserve(size) if size else (0 if len(self.live) < self.max_messages else None)
+            if start is not None:
+                return start
+            self.space_available.clear()
+            await self.space_available.wait()
+
+    async def put(self, message):
+        data = message['data']
+        if (message['type'] == 'data' and message['compression'] == 'none' and isinstance(data, np.ndarray)
+                and data.size > 0 and not data.dtype.hasobject):
+            data = np.ascontiguousarray(data).ravel()
+            size = -(-data.nbytes//ALIGNMENT)*ALIGNMENT
+            if size > self.buffer.size:
+                raise ValueError("A message of {} bytes does not fit in the shared ring of {} bytes, increase its capacity.".format(
+                                 data.nbytes, self.buffer.size))
+            start = await self.wait_for(size)
+            self.buffer[start:start+data.nbytes] = data.view(np.uint8)
+            self.live.append(True)
+            self.ranges.append((start, start+size))
+            self.bytes_used += size
+            header = ("shared", start, data.size, data.dtype, message.get('time'))
+        else:
+            await self.wait_for(0)
+            self.live.append(False)
+            header = message
+        self.high_water_messages = max(self.high_water_messages, len(self.live))
+        self.high_water_bytes    = max(self.high_water_bytes, self.bytes_used)
+        self.conn.send(header)
+
+    async def get(self):
+        raise RuntimeError("The producing end of a shared stream cannot be read from.")
+
+    def get_nowait(self):
+        raise asyncio.QueueEmpty()
+
+    def set_limits(self, max_depth=0, unit="messages", policy="block"):
+        pass
+
+    def qsize(self):
+        return 0
+
+    def empty(self):
+        return True
+
+    def __repr__(self):
+        return "<SharedStreamWriter(capacity={}, used={}, unread={})>".format(self.buffer.size, self.bytes_used, len(self.live))
+
+class SharedStreamReader(object):
+    """Consuming end of a stream between processes, standing in for the queue of the DataStream."""
+
+    def __init__(self, conn, buffer, loop=None):
+        self.conn       = conn
+        self.buffer     = buffer
+        self.loop       = loop
+        self.run_id     = 0
+        self.listening  = False
+        self.closed     = False
+        self.pending    = collections.deque()
+        self.num_leased = 0
+        self.high_water_messages = 0
+        self.high_water_bytes    = 0
+        self.data_available = asyncio.Event(loop=loop)
+
+    def start_run(self, run_id):
+        self.run_id     = run_id
+        self.num_leased = 0
+        if not self.listening:
+            self.loop.add_reader(self.conn.fileno(), self.receive)
+            self.listening = True
+
+    def close(self):
+        if self.listening:
+            self.loop.remove_reader(self.conn.fileno())
+            self.listening = False
+        self.conn.close()
+
+    def receive(self):
+        """Take any headers and messages waiting in the pipe."""
+        try:
+            while self.conn.poll():
+                self.pending.append(self.conn.recv())
+        except (EOFError, OSError):
+            self.closed = True
+            if self.listening:
+                self.loop.remove_reader(self.conn.fileno())
+                self.listening = False
+        self.high_water_messages = max(self.high_water_messages, len(self.pending))
+        self.data_available.set()
+
+    def release(self):
+        """Hand the slots held by the consumer back to the producer."""
+        if self.num_leased > 0:
+            self.conn.send(("release", self.run_id, self.num_leased))
+            self.num_leased = 0
+
+    async def get(self):
+        self.release()
+        while len(self.pending) == 0:
+            if self.closed:
+                raise EOFError("The other end of the shared stream has gone away.")
+            self.data_available.clear()
+            await self.data_available.wait()
+        return self.get_nowait()
+
+    def get_nowait(self):
+        if len(self.pending) == 0 and not self.closed:
+            self.receive()
+        if len(self.pending) == 0:
+            raise asyncio.QueueEmpty
+        entry = self.pending.popleft()
+        self.num_leased += 1
+        if isinstance(entry, tuple):
+            _, start, count, dtype, put_time = entry
+            data = self.buffer[start:start+count*dtype.itemsize].view(dtype).copy()
+            return {"type": "data", "compression": "none", "data": data, "time": put_time}
+        return entry
+
+    def set_limits(self, max_depth=0, unit="messages", policy="block"):
+        pass
+
+    def qsize(self):
+        return len(self.pending)
+
+    def empty(self):
+        if len(self.pending) == 0 and not self.closed:
+            self.receive()
+        return len(self.pending) == 0
+
+    def __repr__(self):
+        return "<SharedStreamReader(capacity={}, pending={})>".format(self.buffer.size, len(self.pending))
+
+class ProcessSubgraph(object):
+    """A set of filters that runs in a worker process. The worker is forked at the start of a
+    run, once the descriptors have been propagated through the whole graph, so the filters in
+    the worker start out exactly as configured in the experiment. The same worker serves later
+    runs as long as the descriptors of its input streams, the parameters of its filters and the
+    transports within it are unchanged, and is otherwise replaced by a fresh fork.
+
+    Filters in the worker report their profile back to the experiment at the end of each run.
+    Writers open their files there, under names chosen by the experiment so that parallel
+    workers never pick the same one, and may not share a file with writers outside the worker. Anything else they hold, such as the contents of a
+    DataBuffer, stays in the worker. Adaptive sweeps are not supported, since the worker does
+    not see the points added to the descriptors after the fork. Requires the fork start method."""
+
+    def __init__(self, experiment, nodes, capacity=2**25, max_messages=256):
+        self.experiment   = experiment
+        self.nodes        = list(nodes)
+        self.capacity     = -(-capacity//ALIGNMENT)*ALIGNMENT
+        self.max_messages = max_messages
+        for n in self.nodes:
+            if not isinstance(n, Filter):
+                raise TypeError("Only filters can be run in a worker process, got {}".format(n))
+
+        edges = experiment.graph.edges
+        self.inputs   = [e for e in edges if e.end_connector.parent in self.nodes and e.start_connector.parent not in self.nodes]
+        self.outputs  = [e for e in edges if e.start_connector.parent in self.nodes and e.end_connector.parent not in self.nodes]
+        self.internal = [e for e in edges if e.start_connector.parent in self.nodes and e.end_connector.parent in self.nodes]
+
+        self.process   = None
+        self.endpoints = []
+        self.key       = None
+        self.run_id    = 0
+        self.profiles  = {}
+        self.filenames = []
+        self.check_filenames()
+        self.connect()
+
+    def writers(self):
+        return [n for n in self.nodes if isinstance(n, WriteToHDF5)]
+
+    def check_filenames(self):
+        """HDF5 files cannot be written from two processes, so writers sharing a filename must
+        all run in the same one."""
+        inside = set(w.filename.value for w in self.writers())
+        for n in self.experiment.nodes:
+            if isinstance(n, WriteToHDF5) and n not in self.nodes and n.filename.value in inside:
+                raise ValueError("Writer {} shares the file {} with a writer in the worker for {}".format(
+                                 n, n.filename.value, self.nodes))
+
+    def connect(self):
+        """Set up fresh pipes and rings for every stream crossing the boundary, and put the
+        endpoints of this process in place."""
+        for endpoint in self.endpoints:
+            endpoint.close()
+        loop = self.experiment.loop
+        self.endpoints = []
+        self.child_ends = []
+        for edge in self.inputs + self.outputs:
+            parent_conn, child_conn = multiprocessing.Pipe()
+            buffer = np.frombuffer(mmap.mmap(-1, self.capacity), dtype=np.uint8)
+            if edge in self.inputs:
+                endpoint = SharedStreamWriter(parent_conn, buffer, loop=loop, max_messages=self.max_messages)
+            else:
+                endpoint = SharedStreamReader(parent_conn, buffer, loop=loop)
+            edge.set_transport("shared", endpoint=endpoint)
+            self.endpoints.append(endpoint)
+            self.child_ends.append((child_conn, buffer))
+        self.control, self.child_control = multiprocessing.Pipe()
+
+    def signature(self):
+        """Everything the state of the worker is derived from."""
+        descriptors = []
+        for edge in self.inputs:
+            d = edge.descriptor
+            axes = [(a.name, repr(a.unit), np.asarray(a.points).tobytes(), repr(a.metadata)) for a in d.axes]
+            descriptors.append((str(np.dtype(d.dtype)), axes, repr(sorted(d.params.items())), repr(d.metadata)))
+        parameters = [[(k, repr(p.value)) for k, p in sorted(n.parameters.items())] for n in self.nodes]
+        transports = [edge.transport for edge in self.internal]
+        return repr((descriptors, parameters, transports))
+
+    def start(self):
+        """Fork the worker."""
+        context = multiprocessing.get_context("fork")
+        self.process = context.Process(target=self.serve, name="auspex-subgraph", daemon=True)
+        self.process.start()
+        # The worker has its own copies of its ends of the pipes
+        for conn, _ in self.child_ends:
+            conn.close()
+        self.child_control.close()
+        logger.debug("Started worker %d for %s", self.process.pid, self.nodes)
+
+    def stop(self):
+        """Shut the worker down, and get new pipes and rings ready for the next one."""
+        if self.process is None:
+            return
+        try:
+            self.control.send(("stop",))
+        except OSError:
+            pass
+        self.process.join(1.0)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self.process = None
+        self.control.close()
+        self.connect()
+
+    def prepare(self):
+        """Start a run in the worker, forking a new one unless the current one can be reused.
+        Called by Experiment.run_sweeps before the event loop runs."""
+        key = self.signature()
+        if self.process is None or not self.process.is_alive() or key != self.key:
+            self.stop()
+            self.start()
+            self.key = key
+        self.run_id += 1
+        for endpoint in self.endpoints:
+            endpoint.start_run(self.run_id)
+        # Number the files here, as workers running side by side would race for the same name
+        filenames = {}
+        for w in self.writers():
+            if w.filename.value not in filenames:
+                filenames[w.filename.value] = w.new_filename()
+        self.control.send(("run", self.run_id, self.experiment.profiling, filenames))
+
+    async def wait(self):
+        """Wait for the worker to finish the run, and collect the profiles of its filters and
+        the names of the files it wrote."""
+        loop  = self.experiment.loop
+        reply = loop.create_future()
+        def receive():
+            loop.remove_reader(self.control.fileno())
+            try:
+                reply.set_result(self.control.recv())
+            except (EOFError, OSError):
+                reply.set_result(("failed", "the worker exited"))
+        loop.add_reader(self.control.fileno(), receive)
+        status, result = await reply
+        if status != "finished":
+            raise RuntimeError("Worker for {} failed: {}".format(self.nodes, result))
+        profiles, self.filenames = result
+        self.profiles = {self.nodes[i]: counters for i, counters in profiles.items()}
+
+    def serve(self):
+        """Main loop of the worker: run the subgraph whenever asked to."""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # Pools and the loop of the parent do not survive the fork
+        executors.clear()
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for endpoint in self.endpoints:
+            endpoint.conn.close()
+        self.control.close()
+
+        endpoints = []
+        for edge, (conn, buffer) in zip(self.inputs + self.outputs, self.child_ends):
+            if edge in self.inputs:
+                endpoint = SharedStreamReader(conn, buffer, loop=loop)
+            else:
+                endpoint = SharedStreamWriter(conn, buffer, loop=loop, max_messages=self.max_messages)
+            edge.loop = loop
+            edge.set_transport("shared", endpoint=endpoint)
+            endpoints.append(endpoint)
+        for edge in self.internal:
+            edge.loop = loop
+            edge.set_transport(edge.transport)
+        for n in self.nodes:
+            n.loop = loop
+        # Writers rename themselves after the file they open, the experiment knows them by these
+        filenames = {w: w.filename.value for w in self.writers()}
+
+        while True:
+            try:
+                command = self.child_control.recv()
+            except EOFError:
+                break
+            if command[0] == "stop":
+                break
+            try:
+                for w, filename in filenames.items():
+                    w.filename.value = filename
+                reply = ("finished", loop.run_until_complete(self.run_nodes(*command[1:], endpoints=endpoints)))
+            except Exception as e:
+                logger.exception("Worker for %s failed", self.nodes)
+                reply = ("failed", "{}: {}".format(type(e).__name__, e))
+            self.child_control.send(reply)
+        loop.close()
+
+    async def run_nodes(self, run_id, profiling, filenames, endpoints):
+        """One run of the subgraph within the worker, returning the profile of each filter and
+        the names of the files written."""
+        for endpoint in endpoints:
+            endpoint.start_run(run_id)
+        for edge in self.internal:
+            edge.reset()
+        for edge in self.inputs + self.outputs:
+            edge.points_taken = 0
+            edge.reset_perf_counters()
+
+        files = self.experiment.open_files(self.writers(), filenames)
+        try:
+            for n in self.nodes:
+                n.perf.reset()
+                if hasattr(n, 'final_init'):
+                    n.final_init()
+            fused = [edge.end_connector.parent for edge in self.internal if edge.transport == "direct"]
+            running = [n for n in self.nodes if n not in fused]
+            perf_clock.enabled = profiling
+            set_timestamps(profiling)
+            if profiling:
+                await asyncio.gather(*[ProfiledRun(n.run(), n.perf) for n in running])
+            else:
+                await asyncio.gather(*[n.run() for n in running])
+        finally:
+            for f in files:
+                f.close()
+        return {i: n.profile() for i, n in enumerate(self.nodes)}, sorted(filenames.values())
+
+    def __repr__(self):
+        return "<ProcessSubgraph(nodes={}, pid={})>".format(self.nodes, self.process.pid if self.process else None)
@@ -0,0 +1,75 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Benchmark of the Channelizer engines: libchannelizer (ipp, when it loads), the scipy
+# lfilter fallback, and the polyphase numpy engine. Also compares a ChannelizerBank against
+# one Channelizer per frequency for several multiplexed channels.
+#
+#     python test/benchmark_channelizer.py
+
+import time
+import asyncio
+import numpy as np
+
+import auspex.globals
+auspex.globals.auspex_dummy_mode = True
+
+from auspex.stream import DataAxis, DataStreamDescriptor, DataStream
+from auspex.filters.channelizer import Channelizer, ChannelizerBank, load_fallback
+
+def make_channelizer(engine, samples, records, decimation_factor, frequencies=10e6):
+    descriptor = DataStreamDescriptor()
+    descriptor.add_axis(DataAxis("time", 1e-9*np.arange(samples)))
+    descriptor.add_axis(DataAxis("records", np.arange(records)))
+
+    # Keep the channel bandwidth at a quarter of the decimated Nyquist band
+    bandwidth = 0.25/(2e-9*decimation_factor)
+    if np.isscalar(frequencies):
+        channelizer = Channelizer(frequency=frequencies, bandwidth=bandwidth, decimation_factor=decimation_factor, engine=engine)
+    else:
+        channelizer = ChannelizerBank(frequencies=frequencies, bandwidth=bandwidth, decimation_factor=decimation_factor, engine=engine)
+    channelizer.sink.add_input_stream(DataStream(name="raw"))
+    channelizer.sink.descriptor = descriptor
+    channelizer.update_descriptors()
+    return channelizer
+
+def time_channelizers(channelizers, samples, records, repeats):
+    data = np.random.random(samples*records).astype(np.float32)
+    loop = asyncio.get_event_loop()
+
+    start = time.perf_counter()
+    for i in range(repeats):
+        for channelizer in channelizers:
+            loop.run_until_complete(channelizer.process_data(data))
+    return (time.perf_counter() - start)/repeats
+
+def time_engine(engine, samples=4096, records=256, decimation_factor=16, repeats=10):
+    channelizer = make_channelizer(engine, samples, records, decimation_factor)
+    return time_channelizers([channelizer], samples, records, repeats)
+
+def time_bank(engine, num_channels, samples=4096, records=256, decimation_factor=16, repeats=10):
+    """Time a ChannelizerBank against one Channelizer per frequency."""
+    frequencies  = list(np.linspace(10e6, 40e6, num_channels))
+    bank         = make_channelizer(engine, samples, records, decimation_factor, frequencies)
+    channelizers = [make_channelizer(engine, samples, records, decimation_factor, f) for f in frequencies]
+    return (time_channelizers(channelizers, samples, records, repeats),
+            time_channelizers([bank], samples, records, repeats))
+
+if __name__ == '__main__':
+    engines = ["lfilter", "numpy"] if load_fallback else ["ipp", "lfilter", "numpy"]
+    for decimation_factor in [4, 16, 64]:
+        for engine in engines:
+            elapsed = time_engine(engine, decimation_factor=decimation_factor)
+            print("Decimation {:3d}, {:8s}: {:8.2f} ms per 256 records of 4096 samples".format(
+                  decimation_factor, engine, 1e3*elapsed))
+
+    for engine in engines:
+        for num_channels in [2, 4, 8]:
+            separate, bank = time_bank(engine, num_channels)
+            print("{:d} channels, {:8s}: {:8.2f} ms separately, {:8.2f} ms as a bank".format(
+                  num_channels, engine, 1e3*separate, 1e3*bank))
@@ -0,0 +1,50 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Micro-benchmark of DataStreamDescriptor shape queries, comparing the cached shape metadata
+# against recomputing it on every call. Only the queries themselves get faster: a graph pushing
+# many small messages, even through an Averager, runs no faster end to end, since the stream
+# and scheduler overhead of each message dwarfs its shape queries.
+#
+#     python test/benchmark_descriptor.py
+
+import time
+import numpy as np
+
+import auspex.globals
+auspex.globals.auspex_dummy_mode = True
+
+from auspex.stream import DataAxis, DataStreamDescriptor
+
+def uncached(self):
+    return {}
+
+def time_queries(desc, calls=20000):
+    start = time.perf_counter()
+    for i in range(calls):
+        desc.num_points()
+        desc.num_points_through_axis(1)
+        desc.axis_num("samples")
+        desc.dims()
+        desc.data_dims()
+    return (time.perf_counter() - start)/calls
+
+if __name__ == '__main__':
+    desc = DataStreamDescriptor()
+    for i in range(6):
+        desc.add_axis(DataAxis("axis_{}".format(i), np.arange(3)))
+    desc.add_axis(DataAxis("samples", np.arange(8)))
+
+    cached_query = time_queries(desc)
+
+    shape_cache = DataStreamDescriptor.shape_cache
+    DataStreamDescriptor.shape_cache = uncached
+    uncached_query = time_queries(desc)
+    DataStreamDescriptor.shape_cache = shape_cache
+
+    print("Shape queries: {:8.2f} us uncached, {:8.2f} us cached".format(1e6*uncached_query, 1e6*cached_query))
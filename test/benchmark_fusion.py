@@ -0,0 +1,80 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Benchmark of fused filter chains (Experiment.fuse_chains) against separate filter
+# coroutines connected by queues. Each message carries the time it was pushed, so the
+# last filter in the chain can record the latency through the chain.
+#
+#     python test/benchmark_fusion.py
+
+import time
+import asyncio
+import numpy as np
+
+import auspex.globals
+auspex.globals.auspex_dummy_mode = True
+
+from auspex.experiment import Experiment
+from auspex.stream import DataAxis, InputConnector, OutputConnector
+from auspex.filters import Passthrough
+from auspex.filters.filter import Filter
+
+class TimestampExperiment(Experiment):
+
+    # DataStreams
+    chan1 = OutputConnector()
+
+    # Constants
+    messages = 20000
+    points   = 64
+
+    def init_streams(self):
+        self.chan1.add_axis(DataAxis("samples", np.arange(self.points)))
+        self.chan1.add_axis(DataAxis("messages", np.arange(self.messages)))
+
+    async def run(self):
+        data = np.zeros(self.points)
+        for i in range(self.messages):
+            data[0] = time.perf_counter()
+            await self.chan1.push(data.copy())
+
+class LatencyRecorder(Filter):
+    sink = InputConnector()
+
+    def __init__(self, **kwargs):
+        super(LatencyRecorder, self).__init__(**kwargs)
+        self.latencies = []
+
+    async def process_data(self, data):
+        self.latencies.append(time.perf_counter() - data[0])
+
+def time_chain(fuse, depth=4):
+    exp      = TimestampExperiment()
+    filters  = [Passthrough(name="Passthrough{}".format(i)) for i in range(depth)]
+    recorder = LatencyRecorder()
+
+    edges  = [(exp.chan1, filters[0].sink)]
+    edges += [(a.source, b.sink) for a, b in zip(filters[:-1], filters[1:])]
+    edges += [(filters[-1].source, recorder.sink)]
+    exp.set_graph(edges)
+    # Bound the queues so the latency is not dominated by the backlog of the producer
+    exp.set_stream_limits(16)
+    exp.fuse_chains(fuse)
+
+    start = time.perf_counter()
+    exp.run_sweeps()
+    # run_sweeps waits a second after the graph is done
+    elapsed = time.perf_counter() - start - 1.0
+    return exp.messages/elapsed, np.median(recorder.latencies)
+
+if __name__ == '__main__':
+    for depth in [2, 4, 8]:
+        for fuse in [False, True]:
+            throughput, latency = time_chain(fuse, depth)
+            print("Chain of {:d}, {:9s}: {:9.0f} messages/s, median latency {:8.1f} us".format(
+                  depth, "fused" if fuse else "separate", throughput, 1e6*latency))
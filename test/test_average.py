@@ -67,6 +67,7 @@ class VarianceExperiment(Experiment):
     trials  = 5
     repeats = 10
     idx     = 0
+    chunk   = samples*trials*repeats
     
     # For variance comparison
     vals = np.random.random((samples*trials*repeats))
@@ -79,9 +80,10 @@ class VarianceExperiment(Experiment):
     async def run(self):
         logger.debug("Data taker running (inner loop)")
         await asyncio.sleep(0.002)
-        data_row = self.vals[self.idx:self.idx+(self.samples*self.trials*self.repeats)]
-        self.idx += (self.samples*self.trials*self.repeats)
-        await self.chan1.push(data_row)
+        for i in range(0, self.samples*self.trials*self.repeats, self.chunk):
+            data_row = self.vals[self.idx:self.idx+self.chunk]
+            self.idx += self.chunk
+            await self.chan1.push(data_row)
         logger.debug("Stream pushed points {}.".format(data_row))
         logger.debug("Stream has filled {} of {} points".format(self.chan1.points_taken, self.chan1.num_points() ))
 
@@ -120,6 +122,74 @@ class AverageTestCase(unittest.TestCase):
         self.assertTrue(np.abs(np.sum(mean_data - np.mean(orig_data, axis=0))) <= 1e-3)
         self.assertTrue(np.abs(np.sum(var_data - np.var(orig_data, axis=0, ddof=1))) <= 1e-3)
 
+    def test_welford_variance(self):
+        for chunk in [3*5, 7, 3*5*10 - 1]:
+            results = []
+            for accumulator in ["frame", "welford"]:
+                exp       = VarianceExperiment()
+                exp.chunk = chunk
+                avgr      = Averager('repeats', accumulator=accumulator, name="TestAverager")
+                var_buff  = DataBuffer(name='Variance Buffer')
+                mean_buff = DataBuffer(name='Mean Buffer')
+
+                edges = [(exp.chan1,           avgr.sink),
+                         (avgr.final_variance, var_buff.sink),
+                         (avgr.final_average,  mean_buff.sink)]
+
+                exp.set_graph(edges)
+                exp.run_sweeps()
+                results.append((mean_buff.get_data()['chan1'], var_buff.get_data()['Variance']))
+
+            orig_data = exp.vals.reshape(exp.chan1.descriptor.data_dims())
+            for mean_data, var_data in results:
+                self.assertTrue(np.allclose(mean_data, np.mean(orig_data, axis=0).ravel(), atol=1e-6))
+                self.assertTrue(np.allclose(var_data, np.var(orig_data, axis=0, ddof=1).ravel(), atol=1e-6))
+
+    def test_execution_policies(self):
+        for execution in ["thread", "process"]:
+            for accumulator in ["frame", "welford"]:
+                exp       = VarianceExperiment()
+                exp.chunk = 7
+                avgr      = Averager('repeats', accumulator=accumulator, execution=execution, name="TestAverager")
+                var_buff  = DataBuffer(name='Variance Buffer')
+                mean_buff = DataBuffer(name='Mean Buffer')
+
+                edges = [(exp.chan1,           avgr.sink),
+                         (avgr.final_variance, var_buff.sink),
+                         (avgr.final_average,  mean_buff.sink)]
+
+                exp.set_graph(edges)
+                exp.run_sweeps()
+
+                orig_data = exp.vals.reshape(exp.chan1.descriptor.data_dims())
+                self.assertTrue(np.allclose(mean_buff.get_data()['chan1'], np.mean(orig_data, axis=0).ravel(), atol=1e-6))
+                self.assertTrue(np.allclose(var_buff.get_data()['Variance'], np.var(orig_data, axis=0, ddof=1).ravel(), atol=1e-6))
+
+        with self.assertRaises(ValueError):
+            Averager('repeats', execution="gpu")
+
+    def test_multi_axis_average(self):
+        for chunk in [3, 3*5*10]:
+            for accumulator in ["frame", "welford"]:
+                exp       = VarianceExperiment()
+                exp.chunk = chunk
+                avgr      = Averager(['repeats', 'samples'], accumulator=accumulator, name="TestAverager")
+                var_buff  = DataBuffer(name='Variance Buffer')
+                mean_buff = DataBuffer(name='Mean Buffer')
+
+                edges = [(exp.chan1,           avgr.sink),
+                         (avgr.final_variance, var_buff.sink),
+                         (avgr.final_average,  mean_buff.sink)]
+
+                exp.set_graph(edges)
+                exp.run_sweeps()
+
+                self.assertTrue([a.name for a in mean_buff.descriptor.axes] == ['trials'])
+                orig_data = exp.vals.reshape(exp.chan1.descriptor.data_dims())
+                mean_data = mean_buff.get_data()['chan1']
+                var_data  = var_buff.get_data()['Variance']
+                self.assertTrue(np.allclose(mean_data, np.mean(orig_data, axis=(0,2)), atol=1e-6))
+                self.assertTrue(np.allclose(var_data, np.var(orig_data, axis=(0,2), ddof=1), atol=1e-6))
 
     def test_partial_average_runs(self):
         exp             = TestExperiment()
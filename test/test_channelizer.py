@@ -0,0 +1,136 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import unittest
+import asyncio
+import numpy as np
+import scipy.signal
+
+import auspex.globals
+auspex.globals.auspex_dummy_mode = True
+
+from auspex.experiment import Experiment
+from auspex.stream import DataAxis, DataStreamDescriptor, OutputConnector
+from auspex.filters.channelizer import Channelizer, ChannelizerBank, PolyphaseDecimator, cached_plan
+from auspex.filters.io import DataBuffer
+from auspex.log import logger
+
+class ToneExperiment(Experiment):
+
+    # DataStreams
+    voltage = OutputConnector()
+
+    # Constants
+    samples   = 1024
+    records   = 16
+    time_step = 1e-9
+    frequency = 10e6
+    chunk     = samples*records
+
+    def init_streams(self):
+        self.voltage.add_axis(DataAxis("time", self.time_step*np.arange(self.samples)))
+        self.voltage.add_axis(DataAxis("records", np.arange(self.records)))
+
+    async def run(self):
+        times = self.time_step*np.arange(self.samples)
+        tone  = np.cos(2*np.pi*self.frequency*times, dtype=np.float32)
+        data  = np.tile(tone, self.records)
+        for i in range(0, data.size, self.chunk):
+            await self.voltage.push(data[i:i+self.chunk])
+
+class ChannelizerTestCase(unittest.TestCase):
+
+    def test_polyphase_decimator(self):
+        records = np.random.random((5, 203)).astype(np.float32)
+        for decim_factor in [1, 2, 3, 8]:
+            taps     = np.float32(scipy.signal.firwin(8*decim_factor+1, 0.8/decim_factor))
+            expected = scipy.signal.lfilter(taps, 1, records)[:, ::decim_factor]
+            result   = PolyphaseDecimator(taps, decim_factor)(records)
+            self.assertTrue(result.shape == expected.shape)
+            self.assertTrue(np.allclose(result, expected, atol=1e-5))
+
+    def test_engines(self):
+        amplitudes = {}
+        for engine in ["lfilter", "numpy"]:
+            exp = ToneExperiment()
+            exp.chunk = 1000 # not a whole number of records
+            channelizer = Channelizer(frequency=10e6, bandwidth=20e6, decimation_factor=8, engine=engine)
+            buf = DataBuffer()
+
+            exp.set_graph([(exp.voltage, channelizer.sink), (channelizer.source, buf.sink)])
+            exp.run_sweeps()
+
+            data = buf.get_data()['Data'].reshape(exp.records, -1)
+            self.assertTrue(data.shape[1] == exp.samples//8)
+            # Amplitude of the demodulated tone once the filters have settled
+            amplitudes[engine] = np.abs(data[:, 64:]).mean()
+
+        self.assertTrue(abs(amplitudes["numpy"] - amplitudes["lfilter"]) < 0.02*amplitudes["lfilter"])
+
+    def test_bank(self):
+        frequencies = [10e6, 15e6]
+        for engine in ["lfilter", "numpy"]:
+            exp  = ToneExperiment()
+            bank = ChannelizerBank(frequencies=frequencies, bandwidth=20e6, decimation_factor=4, engine=engine)
+            channelizers = [Channelizer(frequency=f, bandwidth=20e6, decimation_factor=4, engine=engine) for f in frequencies]
+            bank_bufs    = [DataBuffer() for f in frequencies]
+            single_bufs  = [DataBuffer() for f in frequencies]
+
+            edges  = [(exp.voltage, bank.sink)]
+            edges += [(bank.output_connectors["channel_{}".format(i)], buf.sink) for i, buf in enumerate(bank_bufs)]
+            edges += [(exp.voltage, ch.sink) for ch in channelizers]
+            edges += [(ch.source, buf.sink) for ch, buf in zip(channelizers, single_bufs)]
+            exp.set_graph(edges)
+            exp.run_sweeps()
+
+            for bank_buf, single_buf in zip(bank_bufs, single_bufs):
+                expected = single_buf.get_data()['Data']
+                self.assertTrue(np.allclose(bank_buf.get_data()['Data'], expected, atol=1e-4*np.abs(expected).max()))
+
+    def test_execution_policies(self):
+        exp   = ToneExperiment()
+        banks = {policy: ChannelizerBank(frequencies=[10e6, 15e6], bandwidth=20e6, decimation_factor=4,
+                                         engine="numpy", execution=policy) for policy in ["inline", "thread"]}
+        channelizers = {policy: Channelizer(frequency=10e6, bandwidth=20e6, decimation_factor=4,
+                                            engine="lfilter", execution=policy) for policy in ["inline", "process"]}
+        bufs  = {node: DataBuffer() for node in list(banks.values()) + list(channelizers.values())}
+
+        edges  = [(exp.voltage, node.sink) for node in bufs]
+        edges += [(bank.channel_0, bufs[bank].sink) for bank in banks.values()]
+        edges += [(ch.source, bufs[ch].sink) for ch in channelizers.values()]
+        exp.set_graph(edges)
+        exp.run_sweeps()
+
+        # Work handed to the thread and process pools gives the same results as inline
+        for nodes in [banks, channelizers]:
+            results = [bufs[node].get_data()['Data'] for node in nodes.values()]
+            self.assertTrue(np.allclose(results[0], results[1]))
+
+        with self.assertRaises(ValueError):
+            Channelizer(frequency=10e6, bandwidth=20e6, decimation_factor=4, execution="gpu")
+
+    def test_plan_cache(self):
+        def connect(frequency):
+            descriptor = DataStreamDescriptor()
+            descriptor.add_axis(DataAxis("time", 1e-9*np.arange(1024)))
+            channelizer = Channelizer(frequency=frequency, bandwidth=20e6, decimation_factor=8, engine="numpy")
+            channelizer.sink.descriptor = descriptor
+            channelizer.update_descriptors()
+            return channelizer.plan
+
+        plan = connect(10e6)
+        hits = cached_plan.cache_info().hits
+
+        # A new graph with the same settings reuses the plan, and a different one does not
+        self.assertTrue(connect(10e6) is plan)
+        self.assertTrue(cached_plan.cache_info().hits > hits)
+        self.assertTrue(connect(12e6) is not plan)
+        self.assertFalse(plan.references.flags.writeable)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,7 +12,8 @@ auspex.globals.auspex_dummy_mode = True
 from auspex.experiment import Experiment
 from auspex.stream import DataStream, DataAxis, DataStreamDescriptor, OutputConnector
 from auspex.filters.debug import Print, Passthrough
-from auspex.filters.correlator import Correlator
+from auspex.filters.correlator import Correlator, CorrelatorBank
+from auspex.filters.elementwise import AlignmentBuffer
 from auspex.filters.io import DataBuffer
 from auspex.log import logger
 
@@ -57,6 +58,28 @@ class CorrelatorExperiment(Experiment):
             await asyncio.sleep(0.002)
             logger.debug("Idx_1: %d, Idx_2: %d", self.idx_1, self.idx_2)
 
+class ThreeChannelExperiment(Experiment):
+
+    # DataStreams
+    chan1 = OutputConnector()
+    chan2 = OutputConnector()
+    chan3 = OutputConnector()
+
+    # Constants
+    samples = 50
+    vals    = np.random.random((3, samples))
+
+    def init_streams(self):
+        for chan in [self.chan1, self.chan2, self.chan3]:
+            chan.add_axis(DataAxis("samples", list(range(self.samples))))
+
+    async def run(self):
+        # Push in chunks of different sizes on each stream
+        for i, chunk in enumerate([7, 10, 25]):
+            chan = [self.chan1, self.chan2, self.chan3][i]
+            for j in range(0, self.samples, chunk):
+                await chan.push(self.vals[i, j:j+chunk])
+
 class CorrelatorTestCase(unittest.TestCase):
 
     def test_correlator(self):
@@ -75,6 +98,32 @@ class CorrelatorTestCase(unittest.TestCase):
         expected_data = exp.vals*exp.vals
         self.assertTrue(np.abs(np.sum(corr_data - expected_data)) <= 1e-4)
 
+    def test_alignment_buffer(self):
+        buf = AlignmentBuffer(capacity=16)
+        buf.append(np.arange(12.0))
+        self.assertTrue(np.all(buf.peek(4) == np.arange(4.0)))
+        buf.consume(10)
+        buf.append(np.arange(12.0, 18.0)) # moves the remainder back to the front
+        self.assertTrue(len(buf) == 8 and buf.buffer.size == 16)
+        buf.append(1j*np.ones(3)) # grows and promotes
+        self.assertTrue(buf.buffer.dtype == np.complex128)
+        self.assertTrue(np.all(buf.peek(len(buf)) == np.concatenate((np.arange(10.0, 18.0), 1j*np.ones(3)))))
+
+    def test_correlator_bank(self):
+        exp   = ThreeChannelExperiment()
+        bank  = CorrelatorBank(correlators="all", num_streams=3)
+        names = ["correlator_0_1", "correlator_0_2", "correlator_1_2", "correlator_0_1_2"]
+        bufs  = [DataBuffer() for name in names]
+        self.assertTrue(bank.correlators == [(0, 1), (0, 2), (1, 2), (0, 1, 2)])
+
+        edges  = [(exp.chan1, bank.sink), (exp.chan2, bank.sink), (exp.chan3, bank.sink)]
+        edges += [(bank.output_connectors[name], buf.sink) for name, buf in zip(names, bufs)]
+        exp.set_graph(edges)
+        exp.run_sweeps()
+
+        for c, name, buf in zip(bank.correlators, names, bufs):
+            expected = np.prod(exp.vals[list(c)], axis=0)
+            self.assertTrue(np.allclose(buf.get_data()[name], expected))
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,91 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import os
+import unittest
+import asyncio
+import numpy as np
+import h5py
+
+import auspex.globals
+auspex.globals.auspex_dummy_mode = True
+
+from auspex.experiment import Experiment
+from auspex.stream import DataAxis, OutputConnector
+from auspex.filters.discriminator import Discriminator, unpack_states
+from auspex.filters.io import DataBuffer, WriteToHDF5
+from auspex.log import logger
+
+class SingleShotExperiment(Experiment):
+    """Integrated single shots of 18 data segments followed by two calibration segments."""
+
+    # DataStreams
+    voltage = OutputConnector()
+
+    # Constants
+    segments     = 20
+    round_robins = 50
+    chunk        = 77 # not a whole number of round robins
+
+    # Data segments alternate between ground and excited, the cals are "0" and "1"
+    prepared = np.array([i % 2 for i in range(18)] + [0, 1])
+    states   = np.tile(prepared, round_robins)
+    centers  = np.array([0.5 - 0.2j, 1.5 + 0.8j])
+    vals     = centers[states] + 0.1*(np.random.randn(states.size) + 1j*np.random.randn(states.size))
+
+    def init_streams(self):
+        metadata = ["data"]*18 + ["0", "1"]
+        self.voltage.add_axis(DataAxis("segments", np.arange(self.segments), metadata=metadata))
+        self.voltage.add_axis(DataAxis("round_robins", np.arange(self.round_robins)))
+        self.voltage.descriptor.dtype = np.complex128
+
+    async def run(self):
+        for i in range(0, self.vals.size, self.chunk):
+            await self.voltage.push(self.vals[i:i+self.chunk])
+
+class DiscriminatorTestCase(unittest.TestCase):
+
+    def test_calibrated_states(self):
+        exp  = SingleShotExperiment()
+        disc = Discriminator(calibrate=True)
+        states    = DataBuffer()
+        confusion = DataBuffer()
+
+        exp.set_graph([(exp.voltage, disc.sink), (disc.source, states.sink), (disc.confusion, confusion.sink)])
+        exp.run_sweeps()
+
+        # Three bytes hold the 20 segments of each round robin
+        packed = states.get_data()['voltage']
+        self.assertTrue(packed.dtype == np.uint8 and packed.size == 3*exp.round_robins)
+        self.assertTrue(states.descriptor.metadata["packed_bits"] == exp.segments)
+        self.assertTrue(np.all(unpack_states(packed.reshape(exp.round_robins, 3), exp.segments).ravel() == exp.states))
+
+        # The threshold learned from the cals sits between the two centers
+        self.assertTrue(np.isclose(disc.angle.value, np.angle(exp.centers[1] - exp.centers[0]), atol=0.05))
+        matrices = confusion.get_data()['voltage'].reshape(exp.round_robins, 2, 2)
+        self.assertTrue(np.allclose(matrices[-1], np.eye(2)))
+
+    def test_write_packed(self):
+        exp  = SingleShotExperiment()
+        if os.path.exists("test_writehdf5_packed-0000.h5"):
+            os.remove("test_writehdf5_packed-0000.h5")
+        disc = Discriminator(threshold=1.0, packed=True)
+        wr   = WriteToHDF5("test_writehdf5_packed.h5")
+
+        exp.set_graph([(exp.voltage, disc.sink), (disc.source, wr.sink)])
+        exp.run_sweeps()
+        with h5py.File("test_writehdf5_packed-0000.h5", 'r') as f:
+            dset = f['main/data/voltage']
+            self.assertTrue(dset.dtype == np.uint8)
+            self.assertTrue(dset.attrs['packed_bits'] == exp.segments)
+            states = unpack_states(dset[:].reshape(exp.round_robins, -1), dset.attrs['packed_bits'])
+            self.assertTrue(np.all(states.ravel() == (exp.vals.real > 1.0)))
+        os.remove("test_writehdf5_packed-0000.h5")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,8 +19,10 @@ auspex.globals.auspex_dummy_mode = True
 from auspex.instruments.instrument import SCPIInstrument, StringCommand, FloatCommand, IntCommand
 from auspex.experiment import Experiment
 from auspex.parameter import FloatParameter
-from auspex.stream import DataStream, DataAxis, DataStreamDescriptor, OutputConnector
-from auspex.filters import Print, Passthrough
+from auspex.stream import DataStream, DataAxis, DataStreamDescriptor, InputConnector, OutputConnector
+from auspex.filters import Print, Passthrough, DataBuffer
+from auspex.filters.filter import Filter
+from auspex.filters.correlator import Correlator
 from auspex.log import logger
 
 class TestInstrument1(SCPIInstrument):
@@ -77,6 +79,69 @@ class TestExperiment(Experiment):
         logger.debug("Stream pushed points {}.".format(data_row))
         logger.debug("Stream has filled {} of {} points".format(self.chan1.points_taken, self.chan1.num_points() ))
 
+class ChunkedExperiment(Experiment):
+    """Pushes each record one point at a time."""
+
+    # DataStreams
+    chan1 = OutputConnector()
+
+    # Constants
+    samples = 20
+
+    def init_streams(self):
+        self.chan1.add_axis(DataAxis("samples", list(range(self.samples))))
+
+    async def run(self):
+        for i in range(self.samples):
+            await self.chan1.push(np.array([float(i)]))
+
+class BlockingExperiment(Experiment):
+    """Holds the event loop with a blocking call, like a slow instrument."""
+
+    # DataStreams
+    chan1 = OutputConnector()
+
+    def init_streams(self):
+        self.chan1.add_axis(DataAxis("samples", [0.0]))
+
+    async def run(self):
+        await asyncio.sleep(0.05)
+        time.sleep(0.2)
+        await self.chan1.push(np.array([1.0]))
+
+def drain_socket():
+    time.sleep(0.2)
+
+class ReaderExperiment(Experiment):
+    """Holds the event loop from a plain callback, like a slow socket reader."""
+
+    # DataStreams
+    chan1 = OutputConnector()
+
+    def init_streams(self):
+        self.chan1.add_axis(DataAxis("samples", [0.0]))
+
+    async def run(self):
+        await asyncio.sleep(0.05)
+        self.loop.call_soon(drain_socket)
+        await asyncio.sleep(0.05)
+        await self.chan1.push(np.array([1.0]))
+
+class BatchRecorder(Filter):
+    sink = InputConnector()
+
+    def __init__(self, **kwargs):
+        super(BatchRecorder, self).__init__(**kwargs)
+        self.batch_sizes = []
+        self.received    = []
+
+    async def process_batch(self, batch):
+        self.batch_sizes.append(len(batch))
+        await super(BatchRecorder, self).process_batch(batch)
+
+    async def process_data(self, data):
+        self.received.append(data)
+
 class ExperimentTestCase(unittest.TestCase):
 
     def test_parameters(self):
@@ -186,6 +251,22 @@ class ExperimentTestCase(unittest.TestCase):
         exp.set_stream_compression("zlib")
         exp.run_sweeps()
 
+    def test_batched_filter(self):
+        for transport in ["queue", "ring"]:
+            exp      = ChunkedExperiment()
+            recorder = BatchRecorder(max_batch_size=None, max_batch_latency=0.01)
+
+            edges = [(exp.chan1, recorder.sink)]
+
+            exp.set_graph(edges)
+            # A small ring has its slots reused while the batch waits for more messages
+            exp.set_stream_transport(transport, **({"capacity": 4, "coalesce": False} if transport == "ring" else {}))
+            exp.run_sweeps()
+
+            self.assertTrue(sum(recorder.batch_sizes) == exp.samples)
+            self.assertTrue(len(recorder.batch_sizes) < exp.samples)
+            self.assertTrue(np.all(np.concatenate(recorder.received) == np.arange(exp.samples)))
+
     def test_depth(self):
         exp         = TestExperiment()
         passthrough = Passthrough(name="Passthrough")
@@ -196,5 +277,90 @@ class ExperimentTestCase(unittest.TestCase):
         exp.set_graph(edges)
         exp.run_sweeps()
 
+    def test_fused_chain(self):
+        received = []
+        for fuse in [False, True]:
+            exp      = ChunkedExperiment()
+            first    = Passthrough(name="First")
+            second   = Passthrough(name="Second")
+            recorder = BatchRecorder()
+
+            edges = [(exp.chan1, first.sink), (first.source, second.sink), (second.source, recorder.sink)]
+
+            exp.set_graph(edges)
+            chains = exp.fuse_chains(fuse)
+            exp.run_sweeps()
+            received.append(np.concatenate(recorder.received))
+
+        # The experiment stream stays a queue, so the first passthrough heads the chain
+        self.assertTrue(chains == [[first, second, recorder]])
+        self.assertTrue(np.all(received[0] == received[1]))
+        self.assertTrue(np.all(received[1] == np.arange(exp.samples)))
+
+    def test_profile(self):
+        exp         = ChunkedExperiment()
+        passthrough = Passthrough(name="Passthrough")
+        buf         = DataBuffer(name="Buffer")
+
+        edges = [(exp.chan1, passthrough.sink), (passthrough.source, buf.sink)]
+
+        exp.set_graph(edges)
+        exp.enable_profiling()
+        exp.run_sweeps()
+
+        # DataBuffer overrides run, and is counted all the same
+        profile = {c["name"]: c for c in exp.profile()}
+        for name in ["Passthrough", "Buffer"]:
+            self.assertTrue(profile[name]["messages"] == exp.samples + 1) # and the done event
+            self.assertTrue(profile[name]["points"] == exp.samples)
+            self.assertTrue(profile[name]["wall_time"] > 0.0)
+        self.assertTrue(profile["Passthrough"]["bytes_out"] == 8*exp.samples)
+        self.assertTrue("Passthrough" in exp.format_profile())
+
+    def test_profile_readers(self):
+        exp         = ChunkedExperiment()
+        passthrough = Passthrough(name="Passthrough")
+        corr        = Correlator(name="Correlator")
+
+        edges = [(exp.chan1, passthrough.sink), (exp.chan1, corr.sink), (passthrough.source, corr.sink)]
+
+        exp.set_graph(edges)
+        # Make the readers of the correlator do the bulk of its work
+        def slow(unpack):
+            def slow_unpack(message):
+                time.sleep(0.002)
+                return unpack(message)
+            return slow_unpack
+        for stream in corr.sink.input_streams:
+            stream.unpack = slow(stream.unpack)
+        exp.enable_profiling()
+        exp.run_sweeps()
+
+        profile = {c["name"]: c for c in exp.profile()}
+        self.assertTrue(profile["Correlator"]["messages"] == 2*(exp.samples + 1))
+        self.assertTrue(profile["Correlator"]["wall_time"] > 0.9*0.002*profile["Correlator"]["messages"])
+
+    def test_loop_lag_monitor(self):
+        exp = BlockingExperiment()
+        exp.set_graph([(exp.chan1, Print().sink)])
+        exp.monitor_loop_lag(interval=0.005, threshold=0.1)
+        exp.run_sweeps()
+
+        stats = exp.lag_monitor.stats()
+        self.assertTrue(stats["samples"] > 10)
+        self.assertTrue(stats["max_lag"] > 0.15)
+        self.assertTrue(sum(stats["histogram"][1]) == stats["samples"])
+        self.assertTrue(len(stats["stalls"]) == 1)
+        self.assertTrue("BlockingExperiment" in stats["stalls"][0]["node"])
+
+        # Callbacks are named themselves, rather than after whoever runs the loop
+        exp = ReaderExperiment()
+        exp.set_graph([(exp.chan1, Print().sink)])
+        exp.monitor_loop_lag(interval=0.005, threshold=0.1)
+        exp.run_sweeps()
+        stalls = exp.lag_monitor.stats()["stalls"]
+        self.assertTrue(len(stalls) == 1)
+        self.assertTrue(stalls[0]["node"] == "drain_socket")
+
 if __name__ == '__main__':
     unittest.main()
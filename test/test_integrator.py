@@ -0,0 +1,87 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import os
+import tempfile
+import unittest
+import asyncio
+import numpy as np
+
+import auspex.globals
+auspex.globals.auspex_dummy_mode = True
+
+from auspex.experiment import Experiment
+from auspex.stream import DataAxis, OutputConnector
+from auspex.filters.integrator import KernelIntegrator, load_kernel
+from auspex.filters.io import DataBuffer
+from auspex.log import logger
+
+class RecordExperiment(Experiment):
+
+    # DataStreams
+    voltage = OutputConnector()
+
+    # Constants
+    samples = 16
+    records = 10
+    chunk   = 37 # not a whole number of records
+
+    vals = np.random.random(samples*records) + 1j*np.random.random(samples*records)
+
+    def init_streams(self):
+        self.voltage.add_axis(DataAxis("time", np.arange(self.samples)))
+        self.voltage.add_axis(DataAxis("records", np.arange(self.records)))
+
+    async def run(self):
+        for i in range(0, self.vals.size, self.chunk):
+            await self.voltage.push(self.vals[i:i+self.chunk])
+
+def integrator_settings(kernel):
+    return dict(kernel=kernel, bias=0, simple_kernel=False, box_car_start=0, box_car_stop=0, frequency=0)
+
+class IntegratorTestCase(unittest.TestCase):
+
+    def test_load_kernel(self):
+        self.assertTrue(np.all(load_kernel("[1, 1j, 0]") == np.array([[1, 1j, 0]])))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, "kernel.npy")
+            np.save(filename, np.eye(3))
+            self.assertTrue(np.all(load_kernel(filename) == np.eye(3)))
+        with self.assertRaises(ValueError):
+            load_kernel("__import__('os')")
+
+    def test_defaults(self):
+        # Settings not given fall back to defaults, whatever else is passed
+        for kwargs in [{}, {"name": "ki"}, {"execution": "thread"}, {"kernel_names": ["box"]}]:
+            ki = KernelIntegrator(**kwargs)
+            self.assertTrue(ki.kernel.value is None)
+            self.assertTrue(ki.simple_kernel.value is False)
+            self.assertTrue(ki.pre_int_op is None and ki.post_int_op is None)
+
+    def test_kernel_matrix(self):
+        exp     = RecordExperiment()
+        kernels = np.random.random((3, 12)) + 1j*np.random.random((3, 12))
+        ki      = KernelIntegrator(kernel_names=["box", "optimal", "tone"], **integrator_settings(kernels))
+        stacked = DataBuffer()
+        named   = [DataBuffer() for k in kernels]
+
+        edges  = [(exp.voltage, ki.sink), (ki.source, stacked.sink)]
+        edges += [(ki.output_connectors[name], buf.sink) for name, buf in zip(ki.kernel_names, named)]
+        exp.set_graph(edges)
+        exp.run_sweeps()
+
+        # Kernels are zero padded to the record length
+        records  = exp.vals.reshape(exp.records, exp.samples)
+        expected = np.inner(records[:, :12], kernels)
+        self.assertTrue(np.allclose(stacked.get_data()['Data'].reshape(exp.records, 3), expected))
+        self.assertTrue(stacked.descriptor.axes[-1].name == "kernel")
+        for ct, buf in enumerate(named):
+            self.assertTrue(np.allclose(buf.get_data()['Data'], expected[:, ct]))
+
+if __name__ == '__main__':
+    unittest.main()
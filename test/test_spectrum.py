@@ -0,0 +1,72 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import unittest
+import asyncio
+import numpy as np
+import scipy.signal
+
+import auspex.globals
+auspex.globals.auspex_dummy_mode = True
+
+from auspex.experiment import Experiment
+from auspex.stream import DataAxis, OutputConnector
+from auspex.filters.spectrum import SpectrumAnalyzer
+from auspex.filters.io import DataBuffer
+from auspex.log import logger
+
+class NoiseExperiment(Experiment):
+
+    # DataStreams
+    voltage = OutputConnector()
+
+    # Constants
+    samples   = 1000
+    records   = 12
+    time_step = 1e-3
+    chunk     = 1500 # not a whole number of records
+    is_complex = False
+
+    def init_streams(self):
+        self.voltage.add_axis(DataAxis("time", self.time_step*np.arange(self.samples)))
+        self.voltage.add_axis(DataAxis("records", np.arange(self.records)))
+
+    async def run(self):
+        times = self.time_step*np.arange(self.samples*self.records)
+        self.vals = np.random.randn(times.size) + 0.5*np.sin(2*np.pi*50*times)
+        if self.is_complex:
+            self.vals = self.vals + 1j*np.random.randn(times.size)
+        for i in range(0, self.vals.size, self.chunk):
+            await self.voltage.push(self.vals[i:i+self.chunk])
+
+class SpectrumAnalyzerTestCase(unittest.TestCase):
+
+    def test_welch(self):
+        for is_complex in [False, True]:
+            exp = NoiseExperiment()
+            exp.is_complex = is_complex
+            spec = SpectrumAnalyzer(nperseg=128, noverlap=32)
+            spectra, average = DataBuffer(), DataBuffer()
+
+            exp.set_graph([(exp.voltage, spec.sink), (spec.source, spectra.sink), (spec.final_average, average.sink)])
+            if is_complex:
+                exp.voltage.descriptor.dtype = np.complex128
+                exp.update_descriptors()
+            exp.run_sweeps()
+
+            records = exp.vals.reshape(exp.records, exp.samples)
+            freqs, expected = scipy.signal.welch(records, fs=1/exp.time_step, nperseg=128, noverlap=32, return_onesided=not is_complex)
+            if is_complex:
+                freqs, expected = np.fft.fftshift(freqs), np.fft.fftshift(expected, axes=-1)
+
+            self.assertTrue(np.allclose(spectra.descriptor.axes[-1].points, freqs))
+            self.assertTrue(np.allclose(spectra.get_data()['voltage'].reshape(exp.records, -1), expected))
+            self.assertTrue(np.allclose(average.get_data()['voltage'], expected.mean(axis=0)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,280 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import unittest
+import asyncio
+import itertools
+import numpy as np
+
+import auspex.globals
+auspex.globals.auspex_dummy_mode = True
+
+from auspex.experiment import Experiment
+from auspex.parameter import FloatParameter
+from auspex.stream import cartesian, DataStream, DataAxis, DataStreamDescriptor, OutputConnector, RingBuffer, BoundedQueue, TupleStore, RecordAssembler
+from auspex.filters.debug import Passthrough
+from auspex.filters.io import DataBuffer
+from auspex.compression import get_codec
+from auspex.log import logger
+
+class StreamExperiment(Experiment):
+
+    # Parameters
+    field = FloatParameter(unit="Oe")
+
+    # DataStreams
+    voltage = OutputConnector()
+
+    # Constants
+    samples = 5
+    idx     = 0
+
+    vals = np.arange(11*samples, dtype=np.float64)
+
+    def init_instruments(self):
+        self.field.assign_method(lambda x: logger.debug("Field got value " + str(x)))
+
+    def init_streams(self):
+        self.voltage.add_axis(DataAxis("samples", list(range(self.samples))))
+
+    async def run(self):
+        await self.voltage.push(self.vals[self.idx:self.idx+self.samples])
+        self.idx += self.samples
+
+class StreamTestCase(unittest.TestCase):
+
+    def test_ring_buffer(self):
+        loop   = asyncio.get_event_loop()
+        stream = DataStream(name="ring", loop=loop)
+        desc   = DataStreamDescriptor(dtype=np.float64)
+        desc.add_axis(DataAxis("samples", list(range(4))))
+        stream.set_descriptor(desc)
+        stream.set_transport("ring", coalesce=True)
+        ring = stream.queue
+        self.assertTrue(isinstance(ring, RingBuffer))
+
+        async def exercise():
+            await stream.push(np.arange(4.0))
+            await stream.push(np.arange(4.0, 8.0))
+            await stream.push_event("done")
+
+            # Adjacent chunks are coalesced into one zero-copy view
+            message = await ring.get()
+            self.assertTrue(message['type'] == 'data')
+            self.assertTrue(np.all(message['data'] == np.arange(8.0)))
+            self.assertTrue(np.shares_memory(message['data'], ring.buffer))
+
+            message = await ring.get()
+            self.assertTrue(message['type'] == 'event')
+            self.assertTrue(ring.points_used == 0)
+
+            # Fill the ring so that subsequent writes wrap around
+            ring.coalesce = False
+            for i in range(ring.buffer.size//4):
+                await stream.push(np.full(4, float(i)))
+            received = []
+            for i in range(ring.buffer.size//4):
+                message = await ring.get()
+                received.append(message['data'].copy())
+                ring.release()
+                await stream.push(np.full(4, float(100+i)))
+            while not ring.empty():
+                received.append((await ring.get())['data'].copy())
+            return np.concatenate(received)
+
+        received = loop.run_until_complete(exercise())
+        n = ring.buffer.size//4
+        expected = np.concatenate([np.full(4, float(i)) for i in range(n)] + [np.full(4, float(100+i)) for i in range(n)])
+        self.assertTrue(np.all(received == expected))
+        self.assertTrue(ring.high_water_points <= ring.buffer.size)
+
+    def test_ring_transport(self):
+        exp = StreamExperiment()
+        pt  = Passthrough()
+        buf = DataBuffer()
+
+        edges = [(exp.voltage, pt.sink), (pt.source, buf.sink)]
+        exp.set_graph(edges)
+        exp.set_stream_transport("ring", slots=2)
+        exp.add_sweep(exp.field, np.linspace(0,100.0,11))
+        exp.run_sweeps()
+
+        data = buf.get_data()
+        self.assertTrue(np.all(data['voltage'] == exp.vals))
+
+    def test_mixed_transports(self):
+        exp = StreamExperiment()
+        pt  = Passthrough()
+        buf = DataBuffer()
+
+        # Passthrough forwards views into the ring to a queue, they must outlive their slots
+        exp.set_graph([(exp.voltage, pt.sink), (pt.source, buf.sink)])
+        [e for e in exp.graph.edges if e.end_connector.parent is pt][0].set_transport("ring", slots=2)
+        exp.add_sweep(exp.field, np.linspace(0,100.0,11))
+        exp.run_sweeps()
+
+        data = buf.get_data()
+        self.assertTrue(np.all(data['voltage'] == exp.vals))
+
+    def test_bounded_queue_policies(self):
+        loop = asyncio.get_event_loop()
+        data = lambda x: {"type": "data", "compression": "none", "data": np.full(10, float(x))}
+
+        queue = BoundedQueue(max_depth=2, policy="drop_oldest", loop=loop)
+        for i in range(5):
+            queue.put_nowait(data(i))
+        queue.put_nowait({"type": "event", "compression": "none", "event_type": "done", "data": None})
+        self.assertTrue(queue.dropped_messages == 3)
+        self.assertTrue(queue.dropped_points == 30)
+        self.assertTrue(queue.get_nowait()['data'][0] == 3.0)
+        self.assertTrue(queue.get_nowait()['data'][0] == 4.0)
+        self.assertTrue(queue.get_nowait()['type'] == 'event')
+
+        with self.assertRaises(ValueError):
+            BoundedQueue(max_depth=160, unit="bytes", policy="coalesce", loop=loop)
+        queue = BoundedQueue(max_depth=2, policy="coalesce", loop=loop)
+        for i in range(5):
+            queue.put_nowait(data(i))
+        self.assertTrue(queue.qsize() == 2)
+        self.assertTrue(queue.high_water_messages <= 2)
+        merged = np.concatenate([queue.get_nowait()['data'] for i in range(2)])
+        self.assertTrue(np.all(merged == np.repeat(np.arange(5.0), 10)))
+        self.assertTrue(queue.nbytes == 0)
+
+        queue = BoundedQueue(max_depth=1, loop=loop)
+        queue.put_nowait(data(0))
+        self.assertTrue(queue.full())
+
+    def test_backpressure(self):
+        exp = StreamExperiment()
+        pt  = Passthrough()
+        buf = DataBuffer()
+
+        edges = [(exp.voltage, pt.sink), (pt.source, buf.sink)]
+        exp.set_graph(edges)
+        exp.set_stream_limits(1)
+        exp.add_sweep(exp.field, np.linspace(0,100.0,11))
+        exp.run_sweeps()
+
+        data = buf.get_data()
+        self.assertTrue(np.all(data['voltage'] == exp.vals))
+        for marks in exp.stream_high_water_marks().values():
+            self.assertTrue(marks['messages'] <= 1)
+
+    def test_codecs(self):
+        arrays = [np.random.random((3,4)), np.random.random((3,4))[:,::2], np.float64(3.5),
+                  (np.random.random(7) + 1j*np.random.random(7)).astype(np.complex64), np.arange(5, dtype=np.uint8)]
+        for spec in ["zlib", "zlib:1", "shuffle+zlib:9"]:
+            codec = get_codec(spec)
+            for array in arrays:
+                decoded = codec.decode(codec.encode(array))
+                self.assertTrue(decoded.dtype == np.asarray(array).dtype)
+                self.assertTrue(decoded.shape == np.shape(array))
+                self.assertTrue(np.all(decoded == array))
+        with self.assertRaises(ValueError):
+            get_codec("bogus")
+
+    def test_stream_compression(self):
+        exp = StreamExperiment()
+        pt  = Passthrough()
+        buf = DataBuffer()
+
+        edges = [(exp.voltage, pt.sink), (pt.source, buf.sink)]
+        exp.set_graph(edges)
+        exp.set_stream_compression({"voltage": "shuffle+zlib:9"})
+        exp.add_sweep(exp.field, np.linspace(0,100.0,11))
+        exp.run_sweeps()
+
+        data = buf.get_data()
+        self.assertTrue(np.all(data['voltage'] == exp.vals))
+        stats = list(exp.compression_report().values())[0]
+        self.assertTrue(stats['codec'] == "shuffle+zlib:9")
+        self.assertTrue(stats['raw_bytes'] == exp.vals.nbytes)
+        self.assertTrue(stats['compressed_bytes'] > 0)
+
+    def test_expected_tuples(self):
+        desc = DataStreamDescriptor()
+        desc.add_axis(DataAxis("segment", np.arange(6.0), metadata=["a", "b", "a", "c", "c", "d"]))
+        desc.add_axis(DataAxis("y", np.linspace(0, 1, 3)))
+        desc.add_axis(DataAxis("x", [1.0, 2.0]))
+
+        vals     = [a.points_with_metadata() for a in desc.axes]
+        records  = [tuple(v for point in line for v in point) for line in itertools.product(*vals)]
+        expected = np.rec.fromrecords(records, dtype=desc.axis_data_type(with_metadata=True))
+
+        tuples = desc.expected_tuples()
+        self.assertTrue(tuples.dtype.names == ("x", "y", "segment", "segment_metadata"))
+        for name in tuples.dtype.names:
+            self.assertTrue(np.all(tuples[name] == expected[name]))
+        self.assertTrue(np.all(desc.expected_tuples(as_structured_array=False) == np.array(records)))
+        self.assertTrue(np.all(cartesian([[1, 2], [3, 4, 5]]) == np.array(list(itertools.product([1, 2], [3, 4, 5])))))
+
+    def test_coordinates(self):
+        desc = DataStreamDescriptor()
+        desc.add_axis(DataAxis("segment", np.arange(4.0), metadata=["a", "b", "a", "c"]))
+        desc.add_axis(DataAxis("y", np.linspace(0, 1, 3)))
+        desc.add_axis(DataAxis("x", [1.0, 2.0, 3.0, 4.0, 5.0]))
+
+        expected = desc.expected_tuples()
+        coords   = desc.coordinates(7, 29)
+        self.assertTrue(coords.dtype == expected.dtype)
+        for name in expected.dtype.names:
+            self.assertTrue(np.all(coords[name] == expected[name][7:29]))
+        self.assertTrue(len(desc.coordinates(55)) == 5)
+
+        for index in [0, 13, 59]:
+            point = {name: expected[name][index] for name in desc.axis_names()}
+            self.assertTrue(desc.index_of(**point) == index)
+        with self.assertRaises(ValueError):
+            desc.index_of(x=1.0, y=0.0, segment=7.0)
+
+    def test_shape_cache(self):
+        desc = DataStreamDescriptor()
+        desc.add_axis(DataAxis("samples", np.arange(4)))
+        axis = DataAxis("freq", [1.0, 2.0])
+        desc.add_axis(axis)
+        self.assertTrue(desc.num_points() == 8)
+        self.assertTrue(desc.axis_num("samples") == 1)
+
+        axis.add_points([3.0])
+        self.assertTrue(desc.num_points() == 12)
+        self.assertTrue(desc.dims() == [3, 4])
+        axis.reset()
+        self.assertTrue(desc.num_points_through_axis(0) == 8)
+
+        copy = desc.copy()
+        copy.pop_axis("freq")
+        self.assertTrue(copy.num_points() == 4 and desc.num_points() == 8)
+        self.assertTrue(copy.axis_num("samples") == 0)
+        desc.add_axis(DataAxis("repeats", np.arange(3)))
+        self.assertTrue(desc.data_dims() == [3, 2, 4])
+
+    def test_tuple_store(self):
+        store = TupleStore([("field", 'f'), ("freq", 'f')], capacity=4)
+        store.append([(1.0, 10.0), (2.0, 20.0)])
+        store.append(np.rec.fromrecords([(3.0, 30.0)], dtype=store.dtype))
+        store.append_product([np.array([[4.0]]), np.array([[40.0], [50.0], [60.0]])])
+        self.assertTrue(len(store) == 6)
+        self.assertTrue(len(store.columns[0]) >= 6)
+        self.assertTrue(np.all(store['field'] == [1, 2, 3, 4, 4, 4]))
+        self.assertTrue(np.all(store[2:4]['freq'] == [30.0, 40.0]))
+        self.assertTrue(store[-1:].dtype.names == ("field", "freq"))
+
+    def test_record_assembler(self):
+        assembler = RecordAssembler(7)
+        data      = np.arange(100.0)
+        records   = []
+        for start, stop in [(0, 3), (3, 5), (5, 30), (30, 30), (30, 44), (44, 100)]:
+            records += [r.copy() for r in assembler.assemble(data[start:stop])]
+        records = np.concatenate(records)
+        self.assertTrue(records.shape == (14, 7))
+        self.assertTrue(np.all(records.ravel() == data[:98]))
+        self.assertTrue(assembler.carry_size == 2)
+
+if __name__ == '__main__':
+    unittest.main()
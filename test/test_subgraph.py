@@ -0,0 +1,106 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import unittest
+import asyncio
+import os
+import tempfile
+import numpy as np
+import h5py
+
+import auspex.globals
+auspex.globals.auspex_dummy_mode = True
+
+from auspex.experiment import Experiment
+from auspex.stream import DataAxis, OutputConnector
+from auspex.filters.debug import Passthrough
+from auspex.filters.average import Averager
+from auspex.filters.io import DataBuffer, WriteToHDF5
+from auspex.log import logger
+
+class RepeatExperiment(Experiment):
+
+    # DataStreams
+    chan1 = OutputConnector()
+
+    # Constants
+    samples = 16
+    trials  = 5
+    repeats = 40
+    chunk   = 16*5 + 3 # not a whole number of frames
+
+    def init_streams(self):
+        self.chan1.add_axis(DataAxis("samples", list(range(self.samples))))
+        self.chan1.add_axis(DataAxis("trials", list(range(self.trials))))
+        self.chan1.add_axis(DataAxis("repeats", list(range(self.repeats))))
+
+    async def run(self):
+        self.vals = np.random.random(self.samples*self.trials*self.repeats)
+        for i in range(0, self.vals.size, self.chunk):
+            await self.chan1.push(self.vals[i:i+self.chunk])
+
+class SubgraphTestCase(unittest.TestCase):
+
+    def test_run_in_process(self):
+        exp  = RepeatExperiment()
+        pt   = Passthrough()
+        avgr = Averager('repeats', accumulator="welford")
+        raw_buff, mean_buff = DataBuffer(), DataBuffer()
+
+        exp.set_graph([(exp.chan1, pt.sink), (pt.source, avgr.sink), (pt.source, raw_buff.sink),
+                       (avgr.final_average, mean_buff.sink)])
+        # A ring of only a few messages makes the producers wait for the worker
+        subgraph = exp.run_in_process([pt, avgr], capacity=1024)
+
+        pids = []
+        for axis in ['repeats', 'repeats', 'trials']:
+            avgr.axis.value = axis
+            exp.run_sweeps()
+            pids.append(subgraph.process.pid)
+
+            orig_data = exp.vals.reshape(exp.chan1.descriptor.data_dims())
+            mean_axis = 0 if axis == 'repeats' else 1
+            self.assertTrue(np.allclose(raw_buff.get_data()['chan1'], exp.vals))
+            self.assertTrue(np.allclose(mean_buff.get_data()['chan1'], np.mean(orig_data, axis=mean_axis).ravel()))
+            self.assertTrue(avgr.profile()["messages"] == 0)
+            self.assertTrue([c for c in exp.profile() if c["filter"] is avgr][0]["messages"] > 0)
+
+        # The worker is reused until the averaging axis changes
+        self.assertTrue(pids[0] == pids[1])
+        self.assertTrue(pids[2] != pids[1])
+        subgraph.stop()
+
+    def test_writers_in_process(self):
+        exp = RepeatExperiment()
+        tmp = tempfile.mkdtemp()
+        wr1 = WriteToHDF5(os.path.join(tmp, "one.h5"), save_settings=False)
+        wr2 = WriteToHDF5(os.path.join(tmp, "two.h5"), save_settings=False)
+        exp.set_graph([(exp.chan1, wr1.sink), (exp.chan1, wr2.sink)])
+
+        # Workers cannot share a file
+        wr2.filename.value = wr1.filename.value
+        with self.assertRaises(ValueError):
+            exp.run_in_process([wr1])
+        wr2.filename.value = os.path.join(tmp, "two.h5")
+
+        # Each worker writes the file chosen for it by the experiment
+        subgraphs = [exp.run_in_process([wr1]), exp.run_in_process([wr2])]
+        written = []
+        for i in range(2):
+            exp.run_sweeps()
+            self.assertTrue([os.path.basename(f)[:3] for f in sorted(exp.filenames)] == ["one", "two"])
+            self.assertTrue(not set(exp.filenames) & set(written))
+            written.extend(exp.filenames)
+            for filename in exp.filenames:
+                with h5py.File(filename, 'r') as f:
+                    self.assertTrue(np.allclose(f['main/data/chan1'][:], exp.vals))
+        for subgraph in subgraphs:
+            subgraph.stop()
+
+if __name__ == '__main__':
+    unittest.main()
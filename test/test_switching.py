@@ -0,0 +1,74 @@
+# Copyright 2016 Raytheon BBN Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+import unittest
+import asyncio
+import numpy as np
+from scipy.stats import beta
+
+import auspex.globals
+auspex.globals.auspex_dummy_mode = True
+
+from auspex.experiment import Experiment
+from auspex.stream import DataAxis, OutputConnector
+from auspex.filters.switching import SwitchingCounter
+from auspex.filters.io import DataBuffer
+from auspex.log import logger
+
+class PulseSwitchingExperiment(Experiment):
+    """Initial and final voltages of a junction switched with increasing probability."""
+
+    # DataStreams
+    voltage = OutputConnector()
+
+    # Constants
+    durations = np.linspace(1e-9, 5e-9, 6)
+    attempts  = 64
+    chunk     = 100 # not a whole number of sweep points
+
+    probabilities = np.linspace(0.05, 0.95, durations.size)
+    initial  = np.random.random((durations.size, attempts)) > 0.5
+    switched = np.random.random((durations.size, attempts)) < probabilities[:, np.newaxis]
+    states   = np.stack([initial, initial ^ switched], axis=-1)
+    vals     = 0.2 + 0.5*states + 0.02*np.random.randn(*states.shape)
+
+    def init_streams(self):
+        self.voltage.add_axis(DataAxis("state", [0, 1]))
+        self.voltage.add_axis(DataAxis("attempt", np.arange(self.attempts)))
+        self.voltage.add_axis(DataAxis("pulse_duration", self.durations))
+
+    async def run(self):
+        vals = self.vals.ravel()
+        for i in range(0, vals.size, self.chunk):
+            await self.voltage.push(vals[i:i+self.chunk])
+
+class SwitchingCounterTestCase(unittest.TestCase):
+
+    def test_counts(self):
+        for threshold in [0.45, None]:
+            exp     = PulseSwitchingExperiment()
+            counter = SwitchingCounter(threshold=threshold)
+            counts, probability = DataBuffer(), DataBuffer()
+
+            exp.set_graph([(exp.voltage, counter.sink), (counter.counts, counts.sink), (counter.probability, probability.sink)])
+            exp.run_sweeps()
+
+            expected = np.zeros((exp.durations.size, 2, 2))
+            for i in range(2):
+                for j in range(2):
+                    expected[:, i, j] = np.sum((exp.states[..., 0] == i) & (exp.states[..., 1] == j), axis=-1)
+            self.assertTrue(np.all(counts.get_data()['voltage'].reshape(-1, 2, 2) == expected))
+
+            # Same estimate as analysis.switching.switching_phase from a ground start state
+            estimate = probability.get_data()['voltage'].reshape(-1, 2)[:, 0]
+            self.assertTrue(np.allclose(estimate, beta.mean(1 + expected[:, 0, 1], 1 + expected[:, 0, 0])))
+            if threshold is None:
+                self.assertTrue(0.3 < counter.threshold.value < 0.6)
+
+if __name__ == '__main__':
+    unittest.main()